@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Sequence
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any
+
+import torch
+
+
+MAX_BATCH = 8
+MAX_WAIT_MS = 5.0
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # one scan, someone is looking at the screen
+    SERIES = 1  # series analysis, volume and streamed uploads
+    OFFLINE = 2  # bulk jobs with nobody waiting
+
+
+# Share of forward passes each class gets while all of them are backlogged.
+PRIORITY_WEIGHTS: dict[Priority, float] = {
+    Priority.INTERACTIVE: 8.0,
+    Priority.SERIES: 2.0,
+    Priority.OFFLINE: 1.0,
+}
+
+
+def _shape_key(x: torch.Tensor) -> Hashable:
+    return tuple(x.shape)
+
+
+@dataclass
+class _Request:
+    x: Any
+    future: Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class MicroBatcher:
+    # Collects single-item forward passes from concurrent request threads and runs
+    # them as one batch. Requests are bucketed by `key` (the input shape by default),
+    # so only items that can be collated end up in the same batch.
+    #
+    # Each request carries a priority class. Ready buckets are picked by weighted fair
+    # queuing over the classes (virtual time advances by batch size / weight), so a
+    # backlog of bulk work cannot starve interactive requests, yet still gets the
+    # capacity they leave. Spare slots in a batch are backfilled with same-key
+    # requests from lower classes.
+
+    def __init__(
+        self,
+        fn: Callable[[Any], Sequence[Any]],
+        *,
+        max_batch: int = MAX_BATCH,
+        max_wait_ms: float = MAX_WAIT_MS,
+        name: str = "unet-batcher",
+        collate: Callable[[list[Any]], Any] = torch.stack,
+        key: Callable[[Any], Hashable] = _shape_key,
+        weights: dict[Priority, float] | None = None,
+    ) -> None:
+        self._fn = fn
+        self._max_batch = max_batch
+        self._max_wait = max_wait_ms / 1000.0
+        self._collate = collate
+        self._key = key
+        self._weights = dict(PRIORITY_WEIGHTS if weights is None else weights)
+        self._queues: dict[Priority, OrderedDict[Hashable, list[_Request]]] = {
+            p: OrderedDict() for p in Priority
+        }
+        self._vtime = {p: 0.0 for p in Priority}
+        self._clock = 0.0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        with self._cond:
+            return sum(len(b) for buckets in self._queues.values() for b in buckets.values())
+
+    def queue_depths(self) -> dict[str, int]:
+        with self._cond:
+            return {
+                p.name.lower(): sum(len(b) for b in self._queues[p].values()) for p in Priority
+            }
+
+    def submit(self, x: Any, priority: Priority = Priority.INTERACTIVE) -> Future:
+        request = _Request(x=x, future=Future())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            buckets = self._queues[priority]
+            if not buckets:
+                # A class that was idle starts at the current virtual time instead of
+                # cashing in the credit it did not use.
+                self._vtime[priority] = max(self._vtime[priority], self._clock)
+            buckets.setdefault(self._key(x), []).append(request)
+            self._cond.notify()
+        return request.future
+
+    def __call__(self, x: Any, priority: Priority = Priority.INTERACTIVE) -> Any:
+        return self.submit(x, priority).result()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _take(self, priority: Priority, key: Hashable, n: int) -> list[_Request]:
+        buckets = self._queues[priority]
+        bucket = buckets[key]
+        taken, rest = bucket[:n], bucket[n:]
+        if rest:
+            buckets[key] = rest
+        else:
+            del buckets[key]
+        return taken
+
+    def _next_batch(self) -> list[_Request] | None:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready: dict[Priority, Hashable] = {}
+                next_deadline: float | None = None
+                for p, buckets in self._queues.items():
+                    # Within a class, the ready bucket whose head has waited longest goes first.
+                    for key, bucket in sorted(buckets.items(), key=lambda kv: kv[1][0].enqueued_at):
+                        deadline = bucket[0].enqueued_at + self._max_wait
+                        if len(bucket) >= self._max_batch or deadline <= now or self._closed:
+                            ready[p] = key
+                            break
+                        next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+
+                if not ready:
+                    if next_deadline is None:
+                        if self._closed:
+                            return None
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(timeout=next_deadline - now)
+                    continue
+
+                priority = min(ready, key=lambda p: (self._vtime[p], p))
+                key = ready[priority]
+                batch = self._take(priority, key, self._max_batch)
+                self._clock = self._vtime[priority]
+                self._vtime[priority] += len(batch) / self._weights[priority]
+
+                for p in Priority:
+                    if p <= priority or len(batch) >= self._max_batch:
+                        continue
+                    if key in self._queues[p]:
+                        batch += self._take(p, key, self._max_batch - len(batch))
+                return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                out = self._fn(self._collate([r.x for r in batch]))
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            for i, r in enumerate(batch):
+                r.future.set_result(out[i])
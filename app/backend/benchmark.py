@@ -0,0 +1,520 @@
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+from responses import brotli, dumps, orjson
+
+
+def _synthetic_detections(n_detections: int, n_points: int, seed: int) -> list[dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    detections = []
+    for i in range(n_detections):
+        angles = np.linspace(0.0, 2.0 * np.pi, n_points, endpoint=False)
+        center = rng.uniform(0.2, 0.8, size=2)
+        radius = rng.uniform(0.02, 0.15)
+        seg = np.stack(
+            [center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)],
+            axis=1,
+        ) + rng.normal(0.0, 1e-3, size=(n_points, 2))
+        x1, y1 = seg.min(axis=0) * 1000
+        x2, y2 = seg.max(axis=0) * 1000
+        detections.append(
+            {
+                "class": "tumor" if i % 2 else "fluid",
+                "conf": float(rng.uniform(0.5, 1.0)),
+                "box": [float(x1), float(y1), float(x2), float(y2)],
+                "segments": seg,
+            }
+        )
+    return detections
+
+
+def _detections_from_image(image: str, model: str) -> list[dict[str, Any]]:
+    from PIL import Image
+
+    from inference_service import InferenceService
+
+    service = InferenceService()
+    return service.infer(model, Image.open(image).convert("RGB")).detections
+
+
+def _as_python(detections: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    # What the endpoint used to hand to FastAPI: plain lists of full-precision floats.
+    return [
+        {k: (np.asarray(v).tolist() if isinstance(v, np.ndarray) else v) for k, v in det.items()}
+        for det in detections
+    ]
+
+
+def _fastapi_default(payload: dict[str, Any]) -> bytes:
+    from fastapi.encoders import jsonable_encoder
+
+    return json.dumps(
+        jsonable_encoder(payload),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _cpu_time(fn: Callable[[], bytes], repeats: int) -> tuple[float, bytes]:
+    out = fn()
+    start = time.process_time()
+    for _ in range(repeats):
+        out = fn()
+    return (time.process_time() - start) / repeats * 1000.0, out
+
+
+def bench_serialization(args: argparse.Namespace) -> None:
+    from inference_service import round_segments
+
+    if args.image:
+        raw = _detections_from_image(args.image, args.model)
+    else:
+        raw = _synthetic_detections(args.detections, args.points, args.seed)
+
+    baseline_payload = {"detections": _as_python(raw)}
+    fast_payload = {
+        "detections": [
+            {**det, "segments": round_segments(det["segments"])} if "segments" in det else det
+            for det in raw
+        ]
+    }
+
+    rows = [
+        ("default", *_cpu_time(lambda: _fastapi_default(baseline_payload), args.repeats)),
+        ("fast", *_cpu_time(lambda: dumps(fast_payload), args.repeats)),
+    ]
+
+    print(f"encoder: {'orjson' if orjson is not None else 'json (orjson not installed)'}")
+    print(f"{'path':<10}{'cpu ms':>10}{'raw B':>12}{'gzip B':>12}{'br B':>12}")
+    for name, ms, body in rows:
+        gz = len(gzip.compress(body, compresslevel=6))
+        br = len(brotli.compress(body, quality=4)) if brotli is not None else float("nan")
+        print(f"{name:<10}{ms:>10.3f}{len(body):>12}{gz:>12}{br:>12}")
+
+
+def _load_service(args: argparse.Namespace, **kwargs: Any):
+    from inference_service import InferenceService
+
+    return InferenceService(yolo_weights=args.yolo_weights, unet_weights_filename=args.unet_weights, **kwargs)
+
+
+def _split_rows(args: argparse.Namespace) -> list[dict[str, str]]:
+    import csv
+
+    with open(args.split_csv, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    return rows[: args.limit] if args.limit else rows
+
+
+def _gt_masks(row: dict[str, str], root_dir: str, size: int | None = None) -> np.ndarray:
+    import os
+
+    from PIL import Image
+
+    masks = []
+    for col in ("fluid_mask_path", "tumor_mask_path"):
+        m = Image.open(os.path.join(root_dir, row[col])).convert("L")
+        if size is not None:
+            m = m.resize((size, size), Image.NEAREST)
+        masks.append(np.asarray(m) > 127)
+    return np.stack(masks)
+
+
+def _to_size(mask: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    import cv2
+
+    return np.stack([cv2.resize(m.astype(np.uint8), size, interpolation=cv2.INTER_NEAREST) > 0 for m in mask])
+
+
+class _DiceCounter:
+    def __init__(self) -> None:
+        self.tp = np.zeros(2)
+        self.fp = np.zeros(2)
+        self.fn = np.zeros(2)
+
+    def update(self, pred: np.ndarray, target: np.ndarray) -> None:
+        axes = tuple(range(1, pred.ndim))
+        self.tp += (pred & target).sum(axis=axes)
+        self.fp += (pred & ~target).sum(axis=axes)
+        self.fn += (~pred & target).sum(axis=axes)
+
+    def dice(self) -> np.ndarray:
+        return 2 * self.tp / np.maximum(2 * self.tp + self.fp + self.fn, 1e-7)
+
+
+def _print_dice_table(rows: list[tuple[str, _DiceCounter]]) -> None:
+    print(f"{'dice':<26}{'fluid':>10}{'tumor':>10}{'macro':>10}")
+    for name, counter in rows:
+        d = counter.dice()
+        print(f"{name:<26}{d[0]:>10.4f}{d[1]:>10.4f}{d.mean():>10.4f}")
+
+
+def bench_roi(args: argparse.Namespace) -> None:
+    import os
+
+    from PIL import Image
+
+    from inference_service import UNET_INPUT_SIZE, UNET_THRESHOLD
+    from prob_cache import threshold_level
+    from roi import align_band, find_retina_band
+
+    service = _load_service(args)
+    level = threshold_level(UNET_THRESHOLD)
+    full_vs_gt, roi_vs_gt, roi_vs_full = _DiceCounter(), _DiceCounter(), _DiceCounter()
+    times = {"full": [], "roi": []}
+    band_fractions = []
+
+    for row in _split_rows(args):
+        pil_img = Image.open(os.path.join(args.root_dir, row["image_path"])).convert("RGB")
+        resized = np.asarray(pil_img.resize((UNET_INPUT_SIZE, UNET_INPUT_SIZE), Image.BILINEAR))
+        top, bottom = find_retina_band(resized.mean(axis=2) / 255.0)
+        band_fractions.append(align_band(top, bottom, UNET_INPUT_SIZE)[1] / UNET_INPUT_SIZE)
+
+        preds = {}
+        for mode in ("full", "roi"):
+            start = time.perf_counter()
+            probs = service.unet_probabilities(pil_img, roi_crop=mode == "roi")
+            times[mode].append((time.perf_counter() - start) * 1000.0)
+            preds[mode] = probs > level
+
+        gt = _gt_masks(row, args.root_dir, UNET_INPUT_SIZE)
+        full_vs_gt.update(preds["full"], gt)
+        roi_vs_gt.update(preds["roi"], gt)
+        roi_vs_full.update(preds["roi"], preds["full"])
+
+    fraction = float(np.mean(band_fractions))
+    print(f"images: {len(band_fractions)}")
+    print(f"mean band height: {fraction:.1%} of the frame -> ~{1 - fraction:.1%} fewer UNet FLOPs")
+    for mode, ms in times.items():
+        print(f"{mode:<6} latency ms: mean {np.mean(ms):.1f}  p50 {np.median(ms):.1f}  p95 {np.percentile(ms, 95):.1f}")
+    _print_dice_table([("full vs ground truth", full_vs_gt), ("roi vs ground truth", roi_vs_gt),
+                       ("roi vs full (parity)", roi_vs_full)])
+
+
+def bench_resize(args: argparse.Namespace) -> None:
+    import os
+
+    from PIL import Image
+
+    from inference_service import UNET_RESIZE_MODES, UNET_THRESHOLD
+    from prob_cache import threshold_level
+
+    service = _load_service(args)
+    level = threshold_level(UNET_THRESHOLD)
+    dice = {mode: _DiceCounter() for mode in UNET_RESIZE_MODES}
+    times: dict[str, list[float]] = {mode: [] for mode in UNET_RESIZE_MODES}
+    pixels: dict[str, list[int]] = {mode: [] for mode in UNET_RESIZE_MODES}
+
+    for row in _split_rows(args):
+        pil_img = Image.open(os.path.join(args.root_dir, row["image_path"])).convert("RGB")
+        # Dice is measured at the original resolution, where both modes can be compared.
+        gt = _gt_masks(row, args.root_dir)
+        for mode in UNET_RESIZE_MODES:
+            start = time.perf_counter()
+            probs = service.unet_probabilities(pil_img, resize=mode)
+            times[mode].append((time.perf_counter() - start) * 1000.0)
+            pixels[mode].append(probs.shape[1] * probs.shape[2])
+            dice[mode].update(_to_size(probs > level, pil_img.size), gt)
+
+    print(f"images: {len(times['square'])}")
+    for mode in UNET_RESIZE_MODES:
+        ms = times[mode]
+        print(f"{mode:<10} latency ms: mean {np.mean(ms):.1f}  p50 {np.median(ms):.1f}  "
+              f"p95 {np.percentile(ms, 95):.1f}  mean output px {np.mean(pixels[mode]):.0f}")
+    _print_dice_table([(f"{mode} vs ground truth", dice[mode]) for mode in UNET_RESIZE_MODES])
+
+
+def _run_load(service: Any, images: list[Any], args: argparse.Namespace) -> tuple[list[float], list[str], float]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Closed loop: each client sends its next request as soon as the previous one is
+    # answered, so offered load is set by --concurrency.
+    def one(i: int) -> tuple[float, str]:
+        start = time.perf_counter()
+        result = service.infer(args.model, images[i % len(images)])
+        return (time.perf_counter() - start) * 1000.0, result.variant
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        out = list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - start
+    return [ms for ms, _ in out], [v for _, v in out], wall
+
+
+def bench_load(args: argparse.Namespace) -> None:
+    import os
+
+    from PIL import Image
+
+    from load_control import VARIANT_REDUCED, LoadController, LoadWatermarks
+
+    images = [
+        Image.open(os.path.join(args.root_dir, row["image_path"])).convert("RGB")
+        for row in _split_rows(args)
+    ]
+    watermarks = LoadWatermarks(
+        high_inflight=args.high_inflight,
+        low_inflight=args.low_inflight,
+        high_latency_ms=args.high_latency_ms,
+        low_latency_ms=args.low_latency_ms,
+    )
+
+    print(f"images: {len(images)}  model: {args.model}  concurrency: {args.concurrency}  "
+          f"requests: {args.requests}")
+    print(f"{'controller':<12}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'reduced':>10}")
+    for name, controller in (("off", None), ("adaptive", LoadController(watermarks))):
+        # The probability cache is off, otherwise repeated images would skip the network.
+        service = _load_service(
+            args,
+            prob_cache_bytes=0,
+            unet_max_batch=args.max_batch,
+            load_controller=controller,
+        )
+        service.infer(args.model, images[0])  # warm-up
+        ms, variants, wall = _run_load(service, images, args)
+        reduced = sum(v == VARIANT_REDUCED for v in variants) / len(variants)
+        print(f"{name:<12}{len(ms) / wall:>8.1f}{np.percentile(ms, 50):>10.1f}{np.percentile(ms, 95):>10.1f}"
+              f"{np.percentile(ms, 99):>10.1f}{max(ms):>10.1f}{reduced:>10.1%}")
+        if controller is not None:
+            print(f"{'':<12}controller switches: {controller.snapshot()['switches']}")
+
+
+def bench_priority(args: argparse.Namespace) -> None:
+    import itertools
+    import os
+    import threading
+
+    from PIL import Image
+
+    from batcher import Priority
+
+    images = [
+        Image.open(os.path.join(args.root_dir, row["image_path"])).convert("RGB")
+        for row in _split_rows(args)
+    ]
+    service = _load_service(args, prob_cache_bytes=0, unet_max_batch=args.max_batch)
+    service.infer(args.model, images[0])  # warm-up
+
+    def interactive_latencies() -> list[float]:
+        ms = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            service.infer(args.model, images[i % len(images)])
+            ms.append((time.perf_counter() - start) * 1000.0)
+            time.sleep(args.interval_ms / 1000.0)
+        return ms
+
+    def saturate(priority: Priority, stop: threading.Event) -> None:
+        # Each job queues a whole volume at once, like /inference/stream does.
+        while not stop.is_set():
+            frames = itertools.islice(itertools.cycle(images), args.bulk_frames)
+            for _ in service.infer_stream(args.model, frames, batch_size=args.bulk_frames, priority=priority):
+                pass
+
+    # "fifo" submits the bulk jobs in the interactive class, i.e. no priorities at all.
+    runs = [("idle", None), ("fifo", Priority.INTERACTIVE), ("priority", Priority.OFFLINE)]
+    print(f"images: {len(images)}  model: {args.model}  bulk jobs: {args.bulk_jobs} x {args.bulk_frames} frames")
+    print(f"{'bulk load':<12}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, priority in runs:
+        stop = threading.Event()
+        jobs = [] if priority is None else [
+            threading.Thread(target=saturate, args=(priority, stop), daemon=True) for _ in range(args.bulk_jobs)
+        ]
+        for job in jobs:
+            job.start()
+        ms = interactive_latencies()
+        stop.set()
+        for job in jobs:
+            job.join()
+        print(f"{name:<12}{np.percentile(ms, 50):>10.1f}{np.percentile(ms, 95):>10.1f}{max(ms):>10.1f}")
+
+
+def _model_bytes(model: Any) -> int:
+    return sum(t.numel() * t.element_size() for t in [*model.parameters(), *model.buffers()])
+
+
+def _forward_memory(model: Any, x: Any) -> int:
+    import torch
+
+    # Peak allocator usage on CUDA; on CPU, the bytes allocated during one forward pass.
+    if x.is_cuda:
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        with torch.no_grad():
+            model(x)
+        return torch.cuda.max_memory_allocated() - base
+
+    from torch.profiler import ProfilerActivity, profile
+
+    with torch.no_grad(), profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        model(x)
+    return sum(e.self_cpu_memory_usage for e in prof.key_averages() if e.self_cpu_memory_usage > 0)
+
+
+def bench_fold(args: argparse.Namespace) -> None:
+    import torch
+
+    from inference_service import UNET_INPUT_SIZE
+    from unet_arch import UNet
+    from unet_optimize import max_output_diff, optimize_unet
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    weights = Path(args.unet_weights)
+    reference = UNet(in_channels=3, out_channels=2)
+    reference.load_state_dict(torch.load(str(weights), map_location=device))
+    reference.to(device).eval()
+
+    shape = (args.batch, UNET_INPUT_SIZE, UNET_INPUT_SIZE)
+    variants = {"reference": reference, "folded": optimize_unet(reference, weights)[0]}
+    # `--compile` alone measures the default mode; modes that fail to compile are skipped.
+    for mode in ["default"] if args.compile == [] else args.compile or []:
+        model, info = optimize_unet(reference, weights, compile=mode, warmup_shapes=[shape])
+        if info["compiled"]:
+            variants[f"folded+{mode}"] = model
+            print(f"[INFO] {mode}: compiled in {info['compile_s']:.1f} s")
+
+    x = torch.rand(args.batch, 3, UNET_INPUT_SIZE, UNET_INPUT_SIZE, generator=torch.Generator().manual_seed(0)).to(device)
+    print(f"device: {device}  input: {tuple(x.shape)}")
+    print(f"{'model':<24}{'mean ms':>10}{'p95 ms':>10}{'img/s':>9}{'speedup':>9}{'params MiB':>12}{'fwd MiB':>10}"
+          f"{'max diff':>11}")
+    reference_ms = None
+    for name, model in variants.items():
+        with torch.no_grad():
+            model(x)  # warm-up (and compilation)
+            ms = []
+            for _ in range(args.repeats):
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                model(x)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                ms.append((time.perf_counter() - start) * 1000.0)
+        reference_ms = reference_ms or np.mean(ms)
+        print(f"{name:<24}{np.mean(ms):>10.1f}{np.percentile(ms, 95):>10.1f}{args.batch * 1000.0 / np.mean(ms):>9.1f}"
+              f"{reference_ms / np.mean(ms):>8.2f}x{_model_bytes(model) / 2**20:>12.1f}"
+              f"{_forward_memory(model, x) / 2**20:>10.1f}{max_output_diff(reference, model, x):>11.1e}")
+
+
+def bench_transfer(args: argparse.Namespace) -> None:
+    import torch
+
+    from inference_service import UNET_INPUT_SIZE, UNET_THRESHOLD, pack_mask_bits
+    from prob_cache import threshold_level
+    from unet_arch import UNet
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = UNet(in_channels=3, out_channels=2)
+    model.load_state_dict(torch.load(args.unet_weights, map_location=device))
+    model.to(device).eval()
+    x = torch.rand(args.batch, 3, UNET_INPUT_SIZE, UNET_INPUT_SIZE, generator=torch.Generator().manual_seed(0)).to(device)
+    with torch.no_grad():
+        logits = model(x)
+    level = threshold_level(UNET_THRESHOLD)
+
+    # Post-processing only: everything after the forward pass up to host memory.
+    outputs = {
+        "float32": lambda: torch.sigmoid(logits).cpu(),
+        "uint8": lambda: torch.sigmoid(logits).mul_(255.0).round_().to(torch.uint8).cpu(),
+        "packed mask": lambda: pack_mask_bits(
+            torch.sigmoid(logits).mul_(255.0).round_().to(torch.uint8) > level
+        ).cpu(),
+    }
+    print(f"device: {device}  batch: {args.batch}  input: {UNET_INPUT_SIZE}x{UNET_INPUT_SIZE}")
+    print(f"{'output':<14}{'KiB/image':>11}{'mean ms':>10}{'p95 ms':>10}")
+    for name, fn in outputs.items():
+        ms = []
+        for _ in range(args.repeats):
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            out = fn()
+            ms.append((time.perf_counter() - start) * 1000.0)
+        kib = out.numel() * out.element_size() / args.batch / 1024
+        print(f"{name:<14}{kib:>11.1f}{np.mean(ms):>10.2f}{np.percentile(ms, 95):>10.2f}")
+
+
+def _add_split_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--split_csv", type=str,
+                   default="../../Ophthalmic_Scans/splits/tumor_and_fluid_segmentation_oct/test.csv")
+    p.add_argument("--root_dir", type=str, default="../../Ophthalmic_Scans")
+    p.add_argument("--limit", type=int, default=0, help="Only use the first N rows (0 = all)")
+    p.add_argument("--yolo_weights", type=str, default="models/yolo-weights.pt")
+    p.add_argument("--unet_weights", type=str, default="unet.pth")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backend micro-benchmarks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("serialization", help="Compare response encoders and compression")
+    p.add_argument("--image", type=str, default=None,
+                   help="Run real inference on this image instead of synthetic detections")
+    p.add_argument("--model", type=str, default="unet", choices=["yolo", "unet"])
+    p.add_argument("--detections", type=int, default=20)
+    p.add_argument("--points", type=int, default=2000)
+    p.add_argument("--repeats", type=int, default=50)
+    p.add_argument("--seed", type=int, default=42)
+    p.set_defaults(func=bench_serialization)
+
+    p = sub.add_parser("roi", help="Retina-band cropping: compute saved and Dice parity on a split")
+    _add_split_args(p)
+    p.set_defaults(func=bench_roi)
+
+    p = sub.add_parser("resize", help="Square resize vs letterbox: latency and Dice on a split")
+    _add_split_args(p)
+    p.set_defaults(func=bench_resize)
+
+    p = sub.add_parser("load", help="Tail latency under concurrent load, with and without degradation")
+    _add_split_args(p)
+    p.add_argument("--model", type=str, default="unet", choices=["yolo", "unet"])
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--max_batch", type=int, default=1, help="UNet micro-batch size (1 = off)")
+    p.add_argument("--high_inflight", type=int, default=8)
+    p.add_argument("--low_inflight", type=int, default=4)
+    p.add_argument("--high_latency_ms", type=float, default=0.0)
+    p.add_argument("--low_latency_ms", type=float, default=0.0)
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("priority", help="Interactive latency while bulk jobs saturate the scheduler")
+    _add_split_args(p)
+    p.add_argument("--model", type=str, default="unet", choices=["yolo", "unet"])
+    p.add_argument("--requests", type=int, default=50, help="Interactive requests per run")
+    p.add_argument("--interval_ms", type=float, default=100.0, help="Pause between interactive requests")
+    p.add_argument("--bulk_jobs", type=int, default=2)
+    p.add_argument("--bulk_frames", type=int, default=32, help="Frames queued per bulk job")
+    p.add_argument("--max_batch", type=int, default=1, help="UNet micro-batch size (1 = off)")
+    p.set_defaults(func=bench_priority)
+
+    p = sub.add_parser("fold", help="UNet with BatchNorm folded (and optionally compiled) vs the reference")
+    p.add_argument("--unet_weights", type=str, default="models/unet.pth")
+    p.add_argument("--batch", type=int, default=1)
+    p.add_argument("--repeats", type=int, default=10)
+    p.add_argument("--compile", nargs="*", metavar="MODE", default=None,
+                   help="Also measure torch.compile on the folded model in these modes, e.g. default reduce-overhead "
+                        "(none given: default)")
+    p.set_defaults(func=bench_fold)
+
+    p = sub.add_parser("transfer", help="Device-to-host copy of UNet outputs: float32 vs uint8 vs packed masks")
+    p.add_argument("--unet_weights", type=str, default="models/unet.pth")
+    p.add_argument("--batch", type=int, default=8)
+    p.add_argument("--repeats", type=int, default=20)
+    p.set_defaults(func=bench_transfer)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
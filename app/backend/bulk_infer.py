@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import glob
+import json
+import os
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+from batcher import Priority
+from inference_service import (
+    STREAM_BATCH_SIZE,
+    UNET_CLASS_NAMES,
+    UNET_THRESHOLD,
+    InferenceService,
+    MissingDependencyError,
+)
+from mask_stats import rasterize_segments
+
+
+OUTPUT_FORMATS = ("masks", "yolo", "labelstudio")
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+# Same polygon precision as prepare_dataset/yolo_labels_utils.py.
+YOLO_LABEL_DECIMALS = 6
+PROGRESS_EVERY = 50
+# Split CSVs list paths relative to this directory, as the training scripts read them.
+DATASET_ROOT_NAME = "Ophthalmic_Scans"
+
+
+def _glob_base(pattern: str) -> Path:
+    # The directory part of a pattern before its first wildcard.
+    parts = Path(pattern).parts
+    fixed = []
+    for part in parts[:-1]:
+        if glob.has_magic(part):
+            break
+        fixed.append(part)
+    return Path(*fixed) if fixed else Path(".")
+
+
+def csv_root(csv_path: Path, root_dir: str | None) -> Path:
+    # --root_dir, or the Ophthalmic_Scans directory the CSV lives in
+    # (Ophthalmic_Scans/splits/<task>/test.csv).
+    if root_dir:
+        return Path(root_dir)
+    for parent in csv_path.resolve().parents:
+        if parent.name == DATASET_ROOT_NAME:
+            return parent
+    raise ValueError(f"{csv_path} is not inside {DATASET_ROOT_NAME}/; pass --root_dir for its image paths")
+
+
+def collect_images(inputs: list[str], root_dir: str | None, image_column: str) -> list[tuple[Path, Path]]:
+    # Returns (absolute path, path relative to its input), the latter decides the output name.
+    found: dict[Path, Path] = {}
+    for spec in inputs:
+        p = Path(spec)
+        if p.is_dir():
+            for f in sorted(p.rglob("*")):
+                if f.suffix.lower() in IMAGE_SUFFIXES:
+                    found.setdefault(f.resolve(), f.relative_to(p))
+        elif p.suffix.lower() == ".csv":
+            base = csv_root(p, root_dir)
+            with open(p, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    rel = Path(row[image_column])
+                    found.setdefault((base / rel).resolve(), rel)
+        else:
+            matches = sorted(glob.glob(spec, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"No images match: {spec}")
+            base = _glob_base(spec)
+            for m in matches:
+                f = Path(m)
+                if f.suffix.lower() in IMAGE_SUFFIXES:
+                    found.setdefault(f.resolve(), f.relative_to(base))
+    return [(path, rel) for path, rel in found.items()]
+
+
+def _output_paths(rel: Path, output_dir: Path, fmt: str, class_names: list[str]) -> list[Path]:
+    stem = rel.with_suffix("")
+    if fmt == "masks":
+        return [output_dir / "masks" / c / stem.with_suffix(".png") for c in class_names]
+    if fmt == "yolo":
+        return [output_dir / "labels" / stem.with_suffix(".txt")]
+    return [output_dir / "labelstudio" / stem.with_suffix(".json")]
+
+
+def prefetch(items: list[Any], load: Any, workers: int, depth: int) -> Iterator[tuple[Any, Any]]:
+    # Decodes ahead on a thread pool, but only `depth` images at a time, so memory
+    # does not grow with the size of the archive.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: deque[tuple[Any, Future]] = deque()
+        it = iter(items)
+        for item in it:
+            pending.append((item, pool.submit(load, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(load, nxt)))
+            yield item, future.result()
+
+
+def batches(it: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    batch: list[Any] = []
+    for x in it:
+        batch.append(x)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _class_masks(
+    service: InferenceService,
+    model: str,
+    images: list[Image.Image],
+    threshold: float | None,
+) -> list[dict[str, np.ndarray]]:
+    import cv2
+
+    # One binary mask per class at the original resolution; every output format is
+    # derived from these, so both models go through the same writers.
+    if model == "unet":
+        t = UNET_THRESHOLD if threshold is None else threshold
+        out = []
+        for pil_img, masks in zip(images, service.unet_masks_batch(images, t, priority=Priority.OFFLINE)):
+            out.append(
+                {
+                    c: cv2.resize(masks[i], pil_img.size, interpolation=cv2.INTER_NEAREST)
+                    for i, c in enumerate(UNET_CLASS_NAMES)
+                }
+            )
+        return out
+
+    names = list(service.yolo.names.values())
+    out = []
+    results = service.yolo_detections_batch(images, threshold, priority=Priority.OFFLINE)
+    for pil_img, detections in zip(images, results):
+        by_class: dict[str, list[np.ndarray]] = {c: [] for c in names}
+        for det in detections:
+            if "segments" in det:
+                by_class[det["class"]].append(det["segments"])
+        out.append({c: rasterize_segments(segs, pil_img.size) for c, segs in by_class.items()})
+    return out
+
+
+def _atomic_write(path: Path, write: Any) -> None:
+    # Written next to the target and renamed, so an interrupted run never leaves a
+    # truncated file that a re-run would mistake for a finished one.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _yolo_lines(masks: dict[str, np.ndarray], class_names: list[str]) -> list[str]:
+    import cv2
+
+    lines = []
+    for label, cname in enumerate(class_names):
+        mask = masks[cname]
+        h, w = mask.shape
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for cnt in contours:
+            if len(cnt) < 3:
+                continue
+            pts = cnt.squeeze(axis=1) / (w, h)
+            coords = " ".join(f"{x:.{YOLO_LABEL_DECIMALS}f} {y:.{YOLO_LABEL_DECIMALS}f}" for x, y in pts)
+            lines.append(f"{label} {coords}")
+    return lines
+
+
+def _labelstudio_task(
+    masks: dict[str, np.ndarray],
+    image_ref: str,
+    model_version: str,
+    mask2rle: Any,
+) -> dict[str, Any]:
+    # Brush regions for label-studio-local-setup/labelling_interface.xml
+    # (BrushLabels "label" on image "image", labels "Fluid" / "Tumor").
+    result = []
+    for cname, mask in masks.items():
+        if not mask.any():
+            continue
+        h, w = mask.shape
+        result.append(
+            {
+                "from_name": "label",
+                "to_name": "image",
+                "type": "brushlabels",
+                "original_width": w,
+                "original_height": h,
+                "image_rotation": 0,
+                "value": {
+                    "format": "rle",
+                    "rle": mask2rle((mask > 0).astype(np.uint8) * 255),
+                    "brushlabels": [cname.capitalize()],
+                },
+            }
+        )
+    return {"data": {"image": image_ref}, "predictions": [{"model_version": model_version, "result": result}]}
+
+
+def _write_outputs(
+    masks: dict[str, np.ndarray],
+    paths: list[Path],
+    fmt: str,
+    class_names: list[str],
+    image_ref: str,
+    model_version: str,
+    mask2rle: Any,
+) -> None:
+    if fmt == "masks":
+        for cname, path in zip(class_names, paths):
+            _atomic_write(path, lambda tmp, m=masks[cname]: Image.fromarray(m * 255).save(tmp, format="PNG"))
+    elif fmt == "yolo":
+        text = "".join(line + "\n" for line in _yolo_lines(masks, class_names))
+        _atomic_write(paths[0], lambda tmp: tmp.write_text(text, encoding="utf-8"))
+    else:
+        task = _labelstudio_task(masks, image_ref, model_version, mask2rle)
+        _atomic_write(paths[0], lambda tmp: tmp.write_text(json.dumps(task), encoding="utf-8"))
+
+
+def _merge_labelstudio(output_dir: Path) -> Path:
+    tasks = [json.loads(p.read_text(encoding="utf-8")) for p in sorted((output_dir / "labelstudio").rglob("*.json"))]
+    out = output_dir / "labelstudio_tasks.json"
+    _atomic_write(out, lambda tmp: tmp.write_text(json.dumps(tasks, ensure_ascii=False), encoding="utf-8"))
+    return out
+
+
+def run(args: argparse.Namespace) -> None:
+    mask2rle = None
+    if args.format == "labelstudio":
+        try:
+            from label_studio_converter.brush import mask2rle
+        except ImportError as e:
+            raise MissingDependencyError(
+                "label_studio_converter",
+                "label-studio-converter is required for --format labelstudio",
+            ) from e
+
+    service = InferenceService(
+        yolo_weights=args.yolo_weights,
+        unet_weights_filename=args.unet_weights,
+        unet_max_batch=args.batch_size,
+        # Every image is seen once; caching maps would only evict each other.
+        prob_cache_bytes=0,
+    )
+    class_names = list(UNET_CLASS_NAMES) if args.model == "unet" else list(service.yolo.names.values())
+    output_dir = Path(args.output_dir)
+
+    images = collect_images(args.inputs, args.root_dir, args.image_column)
+    todo = []
+    # Outputs are named by the path inside each input, so two inputs (or a.png and
+    # a.jpg) can map to the same file; that is an error rather than a silent overwrite.
+    owners: dict[Path, Path] = {}
+    for path, rel in images:
+        paths = _output_paths(rel, output_dir, args.format, class_names)
+        owner = owners.setdefault(paths[0], path)
+        if owner != path:
+            raise ValueError(f"{owner} and {path} would both write {paths[0]}; use separate --output_dir runs")
+        if args.overwrite or not all(p.exists() for p in paths):
+            todo.append((path, rel, paths))
+    print(f"[INFO] {len(images)} images, {len(images) - len(todo)} already done, {len(todo)} to process")
+    if not todo:
+        return
+
+    def load(item: tuple[Path, Path, list[Path]]) -> Image.Image:
+        with Image.open(item[0]) as img:
+            return img.convert("RGB")
+
+    done = 0
+    start = time.perf_counter()
+    stream = prefetch(todo, load, args.workers, depth=2 * args.batch_size)
+    for batch in batches(stream, args.batch_size):
+        items = [item for item, _ in batch]
+        all_masks = _class_masks(service, args.model, [img for _, img in batch], args.threshold)
+        for (path, rel, paths), masks in zip(items, all_masks):
+            image_ref = f"{args.url_prefix.rstrip('/')}/{rel.as_posix()}" if args.url_prefix else str(path)
+            _write_outputs(masks, paths, args.format, class_names, image_ref, args.model, mask2rle)
+
+        prev, done = done, done + len(batch)
+        if done // PROGRESS_EVERY != prev // PROGRESS_EVERY or done == len(todo):
+            elapsed = time.perf_counter() - start
+            print(f"[INFO] {done}/{len(todo)} images, {done / elapsed:.2f} img/s")
+
+    elapsed = time.perf_counter() - start
+    print(f"[INFO] Processed {done} images in {elapsed:.1f} s ({done / elapsed:.2f} img/s)")
+    if args.format == "labelstudio":
+        print(f"[INFO] Label Studio tasks: {_merge_labelstudio(output_dir)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run YOLO or U-Net over many images and write masks, YOLO labels or Label Studio predictions."
+    )
+    parser.add_argument("inputs", nargs="+",
+                        help="Image directories, glob patterns or split CSVs (e.g. Ophthalmic_Scans/splits/.../test.csv)")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--model", type=str, default="unet", choices=["yolo", "unet"])
+    parser.add_argument("--format", type=str, default="masks", choices=OUTPUT_FORMATS)
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--batch_size", type=int, default=STREAM_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=4, help="Image decode threads")
+    parser.add_argument("--root_dir", type=str, default=None,
+                        help="Base directory for paths in split CSVs (default: the Ophthalmic_Scans directory containing the CSV)")
+    parser.add_argument("--image_column", type=str, default="image_path")
+    parser.add_argument("--url_prefix", type=str, default=None,
+                        help="Prefix for image URLs in Label Studio tasks (default: local paths)")
+    parser.add_argument("--overwrite", action="store_true", help="Recompute images that already have outputs")
+    parser.add_argument("--yolo_weights", type=str, default="models/yolo-weights.pt")
+    parser.add_argument("--unet_weights", type=str, default="unet.pth")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Below this many vectors a flat scan is fast enough and k-means has too little data.
+IVF_MIN_VECTORS = 2048
+# ~39 training points per centroid at least (the usual IVF rule of thumb).
+IVF_MIN_POINTS_PER_LIST = 39
+IVF_NPROBE = 8
+KMEANS_ITERS = 20
+KMEANS_MAX_SAMPLE = 65536
+# Rows scored per matmul, so a flat scan over a large memmap stays in bounded memory.
+SCAN_CHUNK = 65536
+
+_VECTORS = "vectors.f16"
+_KEYS = "keys.jsonl"
+_ASSIGN = "ivf_lists.i32"
+_CENTROIDS = "ivf_centroids.npy"
+_META = "meta.json"
+_LOCK = ".lock"
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def spherical_kmeans(x: np.ndarray, k: int, *, iters: int = KMEANS_ITERS, seed: int = 0) -> np.ndarray:
+    # k-means on unit vectors with cosine similarity; returns unit-norm centroids.
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = ~sums.any(axis=1)
+        # Empty lists are reseeded with random points instead of being dropped.
+        sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class EmbeddingIndex:
+    # Approximate nearest-neighbour index over L2-normalized embeddings (cosine
+    # similarity), stored append-only in one directory:
+    #   vectors.f16        N x dim float16, read through a memory map
+    #   keys.jsonl         the key (e.g. image path) of every vector
+    #   ivf_centroids.npy  k-means centroids, once the index is trained
+    #   ivf_lists.i32      the inverted list (nearest centroid) of every vector
+    #   meta.json          dim and count, rewritten last on every add
+    # A crash in the middle of an add leaves rows beyond meta's count, which are
+    # dropped by the next writer. New vectors join the list of their nearest
+    # centroid; only train() re-clusters.
+    #
+    # Several processes may share the directory (the backend and the
+    # similar_cases.py CLI): writers hold an exclusive flock on .lock, and every
+    # call first picks up what other processes committed since (meta.json is
+    # replaced on every commit, so an unchanged stat means nothing to read).
+
+    def __init__(self, path: str | Path, dim: int) -> None:
+        self._dir = Path(path)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._dim = dim
+        self._count = 0
+        self._trainings = 0
+        self._keys: list[str] = []
+        self._key_set: set[str] = set()
+        self._keys_bytes = 0
+        self._meta_stat: tuple[int, int] | None = None
+        self._centroids: np.ndarray | None = None
+        self._vectors = self._open_vectors()
+        self._lists: list[np.ndarray] = []
+
+        with self._lock, self._file_lock():
+            self._sync()
+            self._drop_uncommitted()
+
+    def __len__(self) -> int:
+        self._refresh()
+        return self._count
+
+    def __contains__(self, key: str) -> bool:
+        self._refresh()
+        return key in self._key_set
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    @property
+    def nlist(self) -> int:
+        self._refresh()
+        return self._nlist()
+
+    def _nlist(self) -> int:
+        return 0 if self._centroids is None else len(self._centroids)
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with open(self._dir / _LOCK, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_meta(self) -> dict:
+        meta_path = self._dir / _META
+        if not meta_path.exists():
+            return {"dim": self._dim, "count": 0}
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        if meta["dim"] != self._dim:
+            raise ValueError(f"Index at {self._dir} has dim {meta['dim']}, expected {self._dim}")
+        return meta
+
+    def _stat_meta(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self._dir / _META)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _refresh(self) -> None:
+        # Cheap when nothing changed: one stat of meta.json.
+        if self._stat_meta() == self._meta_stat:
+            return
+        with self._lock, self._file_lock(shared=True):
+            self._sync()
+
+    def _sync(self) -> None:
+        # Loads the rows other processes committed since the last call; a retrain
+        # reloads the centroids and rebuilds the lists. Caller holds both locks.
+        self._meta_stat = self._stat_meta()
+        meta = self._read_meta()
+        count, trainings = int(meta["count"]), int(meta.get("trainings", 0))
+        if count == self._count and trainings == self._trainings:
+            return
+
+        with open(self._dir / _KEYS, "a+b") as f:
+            f.seek(self._keys_bytes)
+            lines = f.read().split(b"\n")[: count - self._count]
+        if len(lines) < count - self._count or (lines and not lines[-1]):
+            raise ValueError(f"Index at {self._dir} is corrupt: fewer keys than its {count} vectors")
+        new_keys = [json.loads(line) for line in lines]
+
+        lists = self._lists
+        if trainings != self._trainings or self._centroids is None:
+            centroids_path = self._dir / _CENTROIDS
+            self._centroids = np.load(centroids_path) if centroids_path.exists() else None
+            lists = self._build_lists(self._read_assign(0, count))
+        elif count > self._count:
+            lists = self._append_lists(lists, self._read_assign(self._count, count), self._count)
+
+        self._keys.extend(new_keys)
+        self._key_set.update(new_keys)
+        self._keys_bytes += sum(len(line) + 1 for line in lines)
+        self._count, self._trainings = count, trainings
+        self._vectors = self._open_vectors()
+        self._lists = lists
+
+    def _drop_uncommitted(self) -> None:
+        # Rows beyond meta's count are left by a crashed add; they are cut off
+        # before anything is appended after them. Caller holds the exclusive lock.
+        self._truncate(self._dir / _KEYS, self._keys_bytes)
+        self._truncate(self._dir / _VECTORS, self._count * self._dim * 2)
+        self._truncate(self._dir / _ASSIGN, self._count * 4 if self._centroids is not None else 0)
+
+    @staticmethod
+    def _truncate(path: Path, nbytes: int) -> None:
+        if path.exists() and path.stat().st_size > nbytes:
+            with open(path, "r+b") as f:
+                f.truncate(nbytes)
+
+    def _open_vectors(self) -> np.ndarray:
+        if self._count == 0:
+            return np.empty((0, self._dim), dtype=np.float16)
+        return np.memmap(self._dir / _VECTORS, dtype=np.float16, mode="r", shape=(self._count, self._dim))
+
+    def _read_assign(self, start: int, stop: int) -> np.ndarray:
+        if self._centroids is None or stop <= start:
+            return np.empty(0, dtype=np.int32)
+        return np.fromfile(self._dir / _ASSIGN, dtype=np.int32, count=stop - start, offset=start * 4)
+
+    def _build_lists(self, assign: np.ndarray) -> list[np.ndarray]:
+        # Only on open and (re)training; added rows go through _append_lists.
+        if self._centroids is None:
+            return []
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(self._centroids) + 1))
+        return [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+
+    @staticmethod
+    def _append_lists(lists: list[np.ndarray], assign: np.ndarray, first_id: int) -> list[np.ndarray]:
+        # New rows have the highest ids, so appending keeps every list sorted.
+        # Searches read self._lists without the lock: the outer list is replaced,
+        # not modified in place.
+        ids = np.arange(first_id, first_id + len(assign))
+        lists = list(lists)
+        for c in np.unique(assign):
+            lists[c] = np.concatenate([lists[c], ids[assign == c]])
+        return lists
+
+    def _write_meta(self) -> None:
+        meta_path = self._dir / _META
+        tmp = meta_path.with_name(meta_path.name + ".tmp")
+        meta = {"dim": self._dim, "count": self._count, "nlist": self._nlist(), "trainings": self._trainings}
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, meta_path)
+        self._meta_stat = self._stat_meta()
+
+    def _nearest_centroid(self, x: np.ndarray) -> np.ndarray:
+        return np.argmax(x @ self._centroids.T, axis=1).astype(np.int32)
+
+    def add(self, vectors: np.ndarray, keys: list[str]) -> None:
+        vectors = normalize(vectors).reshape(-1, self._dim)
+        if len(vectors) != len(keys):
+            raise ValueError(f"Got {len(vectors)} vectors for {len(keys)} keys")
+        if not keys:
+            return
+        with self._lock, self._file_lock():
+            self._sync()
+            dup = [k for k in keys if k in self._key_set]
+            if dup or len(set(keys)) != len(keys):
+                raise ValueError(f"Already indexed: {dup[0] if dup else 'duplicate keys in batch'}")
+            self._drop_uncommitted()
+            with open(self._dir / _VECTORS, "ab") as f:
+                f.write(vectors.astype(np.float16).tobytes())
+            key_lines = b"".join(json.dumps(k).encode("utf-8") + b"\n" for k in keys)
+            with open(self._dir / _KEYS, "ab") as f:
+                f.write(key_lines)
+            lists = self._lists
+            if self._centroids is not None:
+                assign = self._nearest_centroid(vectors)
+                with open(self._dir / _ASSIGN, "ab") as f:
+                    f.write(assign.tobytes())
+                lists = self._append_lists(lists, assign, self._count)
+
+            self._count += len(keys)
+            self._keys.extend(keys)
+            self._key_set.update(keys)
+            self._keys_bytes += len(key_lines)
+            self._write_meta()
+            self._vectors = self._open_vectors()
+            self._lists = lists
+
+    def train(self, nlist: int | None = None, *, seed: int = 0) -> None:
+        # (Re)builds the inverted lists from the stored vectors. Indexes smaller than
+        # IVF_MIN_VECTORS stay flat.
+        with self._lock, self._file_lock():
+            self._sync()
+            n = self._count
+            if nlist is None:
+                if n < IVF_MIN_VECTORS:
+                    return
+                nlist = max(1, min(int(4 * np.sqrt(n)), n // IVF_MIN_POINTS_PER_LIST))
+            if not 1 <= nlist <= n:
+                raise ValueError(f"nlist must be between 1 and the index size ({n}), got {nlist}")
+            rng = np.random.default_rng(seed)
+            sample_ids = np.sort(rng.choice(n, size=min(n, KMEANS_MAX_SAMPLE), replace=False))
+            centroids = spherical_kmeans(self._vectors[sample_ids].astype(np.float32), nlist, seed=seed)
+
+            self._centroids = centroids
+            assign = np.concatenate(
+                [
+                    self._nearest_centroid(self._vectors[i:i + SCAN_CHUNK].astype(np.float32))
+                    for i in range(0, n, SCAN_CHUNK)
+                ]
+            )
+            np.save(self._dir / _CENTROIDS, centroids)
+            assign.tofile(self._dir / _ASSIGN)
+            self._trainings += 1
+            self._write_meta()
+            self._lists = self._build_lists(assign)
+
+    def search(self, query: np.ndarray, k: int = 10, *, nprobe: int = IVF_NPROBE) -> list[list[tuple[str, float]]]:
+        # Returns, for each query row, up to k (key, cosine similarity) pairs, best first.
+        queries = normalize(query).reshape(-1, self._dim)
+        self._refresh()
+        with self._lock:
+            vectors, keys, centroids, lists = self._vectors, self._keys, self._centroids, self._lists
+
+        out = []
+        for q in queries:
+            if centroids is None or nprobe >= len(centroids):
+                ids = None
+                scores = np.concatenate(
+                    [vectors[i:i + SCAN_CHUNK].astype(np.float32) @ q for i in range(0, len(vectors), SCAN_CHUNK)]
+                ) if len(vectors) else np.empty(0, dtype=np.float32)
+            else:
+                probe = np.argpartition(-(centroids @ q), nprobe - 1)[:nprobe]
+                ids = np.sort(np.concatenate([lists[c] for c in probe]))
+                scores = vectors[ids].astype(np.float32) @ q
+
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k] if len(scores) > k else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            rows = top if ids is None else ids[top]
+            out.append([(keys[r], float(scores[t])) for r, t in zip(rows, top)])
+        return out
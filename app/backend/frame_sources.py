@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import re
+import zipfile
+from collections.abc import Iterator
+from io import BytesIO
+from typing import BinaryIO
+
+import numpy as np
+from PIL import Image
+
+from inference_service import MissingDependencyError
+from series_store import is_high_depth, scale_to_uint8, to_grayscale
+
+
+ZIP_IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".dcm")
+
+
+class UnsupportedFrameSourceError(ValueError):
+    pass
+
+
+class FrameDecodeError(ValueError):
+    # The container was recognized, but one of its frames could not be decoded
+    # (corrupt TIFF page, broken DICOM pixel data, damaged ZIP member).
+    pass
+
+
+def _natural_key(name: str) -> list:
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def _is_zip(head: bytes) -> bool:
+    return head.startswith(b"PK\x03\x04")
+
+
+def _is_dicom(head: bytes) -> bool:
+    return len(head) >= 132 and head[128:132] == b"DICM"
+
+
+def iter_frames(fp: BinaryIO) -> Iterator[Image.Image]:
+    # Frames are decoded one at a time, so memory does not grow with the number
+    # of slices in the container. `fp` must be seekable (uploads are spooled files).
+    head = fp.read(132)
+    fp.seek(0)
+
+    try:
+        if _is_zip(head):
+            yield from _iter_zip(fp)
+        elif _is_dicom(head):
+            yield from _iter_dicom(fp)
+        else:
+            yield from _iter_pil(fp)
+    except (UnsupportedFrameSourceError, FrameDecodeError, MissingDependencyError):
+        raise
+    except Exception as e:
+        raise FrameDecodeError(f"Could not decode frame: {e}") from e
+
+
+def count_frames(fp: BinaryIO) -> int:
+    # Validates the container and counts its frames from the headers only; no
+    # pixel data is decoded.
+    head = fp.read(132)
+    fp.seek(0)
+
+    try:
+        if _is_zip(head):
+            with zipfile.ZipFile(fp) as zf:
+                names = _zip_image_names(zf)
+                return sum(count_frames(BytesIO(zf.read(name))) for name in names)
+        if _is_dicom(head):
+            try:
+                import pydicom
+            except ImportError as e:
+                raise MissingDependencyError("pydicom", "pydicom is required to read DICOM files") from e
+            ds = pydicom.dcmread(fp, stop_before_pixels=True)
+            return int(getattr(ds, "NumberOfFrames", 1) or 1)
+        try:
+            img = Image.open(fp)
+        except Exception as e:
+            raise UnsupportedFrameSourceError(f"Unsupported image or container: {e}") from e
+        return getattr(img, "n_frames", 1)
+    except (UnsupportedFrameSourceError, FrameDecodeError, MissingDependencyError):
+        raise
+    except Exception as e:
+        raise FrameDecodeError(f"Could not read frame headers: {e}") from e
+
+
+def _iter_pil(fp: BinaryIO) -> Iterator[Image.Image]:
+    try:
+        img = Image.open(fp)
+    except Exception as e:
+        raise UnsupportedFrameSourceError(f"Unsupported image or container: {e}") from e
+
+    # 16-bit pages are scaled to 8 bits here, while the TIFF tags (BitsPerSample)
+    # are still attached; copies lose them.
+    n_frames = getattr(img, "n_frames", 1)
+    if n_frames == 1:
+        img.load()
+        yield to_grayscale(img) if is_high_depth(img) else img
+        return
+    # Multi-page TIFF and friends: only the current page is held by the container.
+    for i in range(n_frames):
+        img.seek(i)
+        yield to_grayscale(img) if is_high_depth(img) else img.copy()
+
+
+def _zip_image_names(zf: zipfile.ZipFile) -> list[str]:
+    names = [
+        info.filename
+        for info in zf.infolist()
+        if not info.is_dir()
+        and not info.filename.startswith("__MACOSX/")
+        and not info.filename.rsplit("/", 1)[-1].startswith(".")
+        and info.filename.lower().endswith(ZIP_IMAGE_SUFFIXES)
+    ]
+    if not names:
+        raise UnsupportedFrameSourceError("ZIP archive contains no images")
+    return sorted(names, key=_natural_key)
+
+
+def _iter_zip(fp: BinaryIO) -> Iterator[Image.Image]:
+    with zipfile.ZipFile(fp) as zf:
+        for name in _zip_image_names(zf):
+            yield from iter_frames(BytesIO(zf.read(name)))
+
+
+def _dicom_frame_to_image(frame: np.ndarray, ds: object) -> Image.Image:
+    if frame.dtype != np.uint8:
+        frame = scale_to_uint8(frame, int(getattr(ds, "BitsStored", 16)))
+    if frame.ndim == 2 and getattr(ds, "PhotometricInterpretation", "") == "MONOCHROME1":
+        frame = 255 - frame
+    return Image.fromarray(frame)
+
+
+def _iter_dicom(fp: BinaryIO) -> Iterator[Image.Image]:
+    try:
+        import pydicom
+    except ImportError as e:
+        raise MissingDependencyError("pydicom", "pydicom is required to read DICOM files") from e
+
+    try:
+        from pydicom.pixels import iter_pixels
+    except ImportError:
+        iter_pixels = None
+
+    if iter_pixels is not None:
+        # pydicom >= 3 decodes multi-frame pixel data one frame at a time.
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        fp.seek(0)
+        for frame in iter_pixels(fp):
+            yield _dicom_frame_to_image(frame, ds)
+        return
+
+    ds = pydicom.dcmread(fp)
+    pixels = ds.pixel_array
+    if int(getattr(ds, "NumberOfFrames", 1)) == 1:
+        pixels = pixels[np.newaxis]
+    for frame in pixels:
+        yield _dicom_frame_to_image(frame, ds)
@@ -1,19 +1,68 @@
 from __future__ import annotations
 
+import itertools
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import Future
+from contextlib import AbstractContextManager, nullcontext
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from ultralytics import YOLO
 
+from batcher import MAX_WAIT_MS, MicroBatcher, Priority
+from load_control import (
+    REDUCED_UNET_INPUT_SIZE,
+    REDUCED_YOLO_IMGSZ,
+    VARIANT_FULL,
+    VARIANT_REDUCED,
+    LoadController,
+)
+from mask_stats import component_outlines, connected_components, lesion_stats, rasterize_segments
+from prob_cache import (
+    PROB_CACHE_MAX_BYTES,
+    ProbabilityMapCache,
+    image_digest,
+    threshold_level,
+)
+from roi import align_band, find_retina_band
+from sequence import (
+    SEQUENCE_TOLERANCE,
+    estimate_shift,
+    shift_probabilities,
+    slice_distance,
+    slice_thumbnail,
+)
 from unet_arch import UNet
+from unet_optimize import UNET_COMPILE_MODES, ParityError, optimize_unet
 
 
 UNET_INPUT_SIZE = 512
 UNET_THRESHOLD = 0.5
+# Output channel order of the UNet; matches the class ids in data.yaml.
+UNET_CLASS_NAMES = ("fluid", "tumor")
+# "square" stretches every scan to UNET_INPUT_SIZE x UNET_INPUT_SIZE (the training setup);
+# "letterbox" scales the long side to UNET_INPUT_SIZE and pads the short one to UNET_ALIGN.
+UNET_RESIZE_MODES = ("square", "letterbox")
+# The UNet pools four times, so padded inputs are a multiple of 2**4.
+UNET_ALIGN = 16
+# First phase of progressive inference: a quick low-resolution pass to show roughly
+# where the lesions are while the full-resolution pass runs.
+UNET_COARSE_SIZE = 256
+STREAM_BATCH_SIZE = 8
+# YOLO letterboxes internally, so any images with the same predictor options can share
+# a batch; they are never held back waiting for company.
+YOLO_MAX_BATCH = 8
+
+# Normalized segment coordinates keep 4 decimals (0.1 px on a 1000 px scan),
+# pixel boxes keep 2; anything finer is noise that only inflates the payload.
+SEGMENT_DECIMALS = 4
+BOX_DECIMALS = 2
+CONF_DECIMALS = 4
 
 
 class InferenceServiceError(Exception):
@@ -32,9 +81,54 @@ class ModelUnavailableError(InferenceServiceError):
         super().__init__(message or f"Model unavailable: {model}")
 
 
+def validate_thresholds(thresholds: Sequence[float]) -> list[float]:
+    thresholds = [float(t) for t in thresholds]
+    if not thresholds:
+        raise ValueError("At least one threshold is required")
+    for t in thresholds:
+        if not 0.0 < t < 1.0:
+            raise ValueError(f"Threshold must be in (0, 1), got {t}")
+    return thresholds
+
+
+def round_segments(points: np.ndarray) -> np.ndarray:
+    return np.round(np.asarray(points, dtype=np.float64), SEGMENT_DECIMALS)
+
+
+def pack_mask_bits(mask: torch.Tensor) -> torch.Tensor:
+    # torch counterpart of np.packbits(mask, axis=-1) (big-endian bit order), so masks
+    # can be packed on the device; the last dimension must be a multiple of 8.
+    *lead, w = mask.shape
+    bits = mask.reshape(*lead, w // 8, 8).to(torch.uint8)
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=mask.device)
+    return (bits << shifts).sum(dim=-1, dtype=torch.uint8)
+
+
 @dataclass(frozen=True)
 class InferenceResult:
     detections: list[dict[str, Any]]
+    stats: dict[str, Any] | None = None
+    # Which model variant produced the result; "reduced" while the service is saturated.
+    variant: str = VARIANT_FULL
+
+
+@dataclass(frozen=True)
+class SequenceResult:
+    results: list[InferenceResult]
+    # Index of the slice whose network output each slice was answered from.
+    reused_from: list[int]
+    forward_passes: int
+    skipped: int
+
+
+def _require_cv2(purpose: str) -> None:
+    try:
+        import cv2  # noqa: F401
+    except ImportError as e:
+        raise MissingDependencyError(
+            "cv2",
+            f"OpenCV (cv2) is required for {purpose}",
+        ) from e
 
 
 class InferenceService:
@@ -45,7 +139,20 @@ class InferenceService:
         device: torch.device | None = None,
         yolo_weights: str = r"models/yolo-weights.pt",
         unet_weights_filename: str = "unet.pth",
+        prob_cache_bytes: int = PROB_CACHE_MAX_BYTES,
+        unet_roi_crop: bool = False,
+        unet_resize: str = "square",
+        unet_max_batch: int = 1,
+        unet_batch_wait_ms: float = MAX_WAIT_MS,
+        load_controller: LoadController | None = None,
+        unet_optimize: bool = True,
+        unet_compile: str | None = None,
     ) -> None:
+        if unet_resize not in UNET_RESIZE_MODES:
+            raise ValueError(f"Unknown UNet resize mode: {unet_resize}")
+        if unet_compile is not None and unet_compile not in UNET_COMPILE_MODES:
+            raise ValueError(f"Unknown UNet compile mode: {unet_compile}")
+
         self._backend_dir = (backend_dir or Path(__file__).resolve().parent).resolve()
         self._device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -54,7 +161,23 @@ class InferenceService:
         # Resolve weights relative to backend_dir so it works regardless of cwd (incl. Docker)
         yolo_weights_path = self._resolve_existing_file(yolo_weights, kind="YOLO weights")
         self._yolo = YOLO(str(yolo_weights_path))
-        self._unet: UNet | None = None
+        # Requests run on a thread pool, but the Ultralytics predictor is not thread-safe:
+        # every prediction goes through the scheduler thread.
+        self._yolo_batcher = MicroBatcher(
+            self._yolo_forward,
+            max_batch=YOLO_MAX_BATCH,
+            max_wait_ms=0.0,
+            name="yolo-batcher",
+            collate=list,
+            key=lambda item: item[1],
+        )
+        self._unet: torch.nn.Module | None = None
+        self._unet_key = ""
+        self._prob_cache = ProbabilityMapCache(prob_cache_bytes)
+        self._unet_roi_crop = unet_roi_crop
+        self._unet_resize = unet_resize
+        self._unet_batcher: MicroBatcher | None = None
+        self._load = load_controller
         try:
             weights_path = self._resolve_existing_file(unet_weights_filename, kind="UNet weights")
 
@@ -63,12 +186,43 @@ class InferenceService:
             model.load_state_dict(state)
             model.to(self._device)
             model.eval()
+            if unet_optimize:
+                model = self._optimize_unet(model, weights_path, unet_compile, unet_max_batch)
             self._unet = model
+            self._unet_key = str(weights_path)
             print(f"[INFO] UNet loaded successfully: {weights_path}")
+            # All UNet passes are scheduled by priority class; with unet_max_batch=1
+            # the scheduler only orders them and never waits to fill a batch.
+            # Items are (input, threshold level or None for probabilities).
+            self._unet_batcher = MicroBatcher(
+                self._unet_forward,
+                max_batch=unet_max_batch,
+                max_wait_ms=unet_batch_wait_ms if unet_max_batch > 1 else 0.0,
+                collate=lambda items: (torch.stack([x for x, _ in items]), items[0][1]),
+                key=lambda item: (tuple(item[0].shape), item[1]),
+            )
         except Exception as e:
             print(f"[WARN] Failed to load UNet: {e}")
             self._unet = None
 
+    def _optimize_unet(self, model: UNet, weights_path: Path, compile: str | None, max_batch: int) -> torch.nn.Module:
+        # Compile for the sizes requests run at (full, coarse and load-shedding passes),
+        # singly and as full micro-batches.
+        sizes = (UNET_INPUT_SIZE, UNET_COARSE_SIZE, REDUCED_UNET_INPUT_SIZE)
+        warmup_shapes = [(batch, size, size) for batch in sorted({1, max_batch}) for size in sizes]
+        try:
+            optimized, info = optimize_unet(model, weights_path, compile=compile, warmup_shapes=warmup_shapes)
+        except ParityError as e:
+            print(f"[WARN] {e}; serving the unoptimized UNet")
+            return model
+        compiled = f", compiled (mode={info['compiled']}, {info['compile_s']:.1f} s)" if info["compiled"] else ""
+        print(
+            f"[INFO] UNet optimized: folded {info['folded_bn']} BatchNorm layers"
+            f"{' (cached)' if info['cached'] else ''}{compiled}, "
+            f"max output diff {info['max_diff']:.1e}"
+        )
+        return optimized
+
     def _resolve_existing_file(self, path: str | Path, *, kind: str) -> Path:
         p = Path(path)
         if p.is_absolute():
@@ -101,88 +255,559 @@ class InferenceService:
     def unet_available(self) -> bool:
         return self._unet is not None
 
-    def infer(self, model: str, pil_img: Image.Image) -> InferenceResult:
+    @property
+    def prob_cache(self) -> ProbabilityMapCache:
+        return self._prob_cache
+
+    @property
+    def load_controller(self) -> LoadController | None:
+        return self._load
+
+    def _admit(self, *, record_latency: bool = True) -> AbstractContextManager[str]:
+        if self._load is None:
+            return nullcontext(VARIANT_FULL)
+        return self._load.admit(record_latency=record_latency)
+
+    def infer(
+        self,
+        model: str,
+        pil_img: Image.Image,
+        threshold: float | None = None,
+    ) -> InferenceResult:
+        model = model.lower().strip()
+        if model not in ("yolo", "unet"):
+            raise ValueError(f"Unknown model: {model}")
+        with self._admit() as variant:
+            if model == "yolo":
+                detections = self._infer_yolo(pil_img, conf=threshold, variant=variant)
+                return self._yolo_result(pil_img.size, detections, variant=variant)
+            t = UNET_THRESHOLD if threshold is None else threshold
+            return self._infer_unet(pil_img, [t], variant=variant)[0]
+
+    def infer_thresholds(
+        self,
+        model: str,
+        pil_img: Image.Image,
+        thresholds: Sequence[float],
+    ) -> list[InferenceResult]:
+        thresholds = validate_thresholds(thresholds)
+        model = model.lower().strip()
+        if model not in ("yolo", "unet"):
+            raise ValueError(f"Unknown model: {model}")
+        with self._admit() as variant:
+            if model == "yolo":
+                # One pass at the loosest threshold; stricter ones are a filter on conf.
+                detections = self._infer_yolo(pil_img, conf=min(thresholds), variant=variant)
+                return [
+                    self._yolo_result(
+                        pil_img.size,
+                        [d for d in detections if d["conf"] > t],
+                        variant=variant,
+                    )
+                    for t in thresholds
+                ]
+            return self._infer_unet(pil_img, thresholds, variant=variant)
+
+    def infer_sequence(
+        self,
+        model: str,
+        images: Sequence[Image.Image],
+        *,
+        threshold: float | None = None,
+        tolerance: float = SEQUENCE_TOLERANCE,
+        warp: bool = False,
+        priority: Priority = Priority.SERIES,
+    ) -> SequenceResult:
         model = model.lower().strip()
-        if model == "yolo":
-            return InferenceResult(detections=self._infer_yolo(pil_img))
+        if model not in ("yolo", "unet"):
+            raise ValueError(f"Unknown model: {model}")
+        if tolerance < 0:
+            raise ValueError(f"Tolerance must be >= 0, got {tolerance}")
         if model == "unet":
-            return InferenceResult(detections=self._infer_unet(pil_img))
-        raise ValueError(f"Unknown model: {model}")
+            _require_cv2("UNet contour extraction")
+            threshold = validate_thresholds([UNET_THRESHOLD if threshold is None else threshold])[0]
 
-    def _infer_yolo(self, pil_img: Image.Image) -> list[dict[str, Any]]:
-        results = self._yolo(pil_img)
-        r = results[0]
+        # One variant for the whole call, so all slices of a series are comparable.
+        with self._admit(record_latency=False) as variant:
+            return self._infer_sequence(model, images, threshold, tolerance, warp, variant, priority)
+
+    def _infer_sequence(
+        self,
+        model: str,
+        images: Sequence[Image.Image],
+        threshold: float | None,
+        tolerance: float,
+        warp: bool,
+        variant: str,
+        priority: Priority,
+    ) -> SequenceResult:
+        input_size = self._unet_input_size(variant)
+        results: list[InferenceResult] = []
+        reused_from: list[int] = []
+        forward_passes = 0
+
+        # Slices are compared with the last slice that actually went through the
+        # network, not with their neighbour, so slow drift cannot chain reuses.
+        ref_index = -1
+        ref_thumb: np.ndarray | None = None
+        ref_size: tuple[int, int] | None = None
+        ref_output: Any = None
+
+        for i, pil_img in enumerate(images):
+            thumb = slice_thumbnail(pil_img)
+            duplicate = (
+                ref_thumb is not None
+                and pil_img.size == ref_size
+                and slice_distance(thumb, ref_thumb) <= tolerance
+            )
+
+            if model == "yolo":
+                if duplicate:
+                    result = ref_output
+                else:
+                    detections = self._infer_yolo(pil_img, conf=threshold, variant=variant, priority=priority)
+                    result = self._yolo_result(pil_img.size, detections, variant=variant)
+                    ref_index, ref_thumb, ref_size, ref_output = i, thumb, pil_img.size, result
+                    forward_passes += 1
+            else:
+                if duplicate:
+                    probs = ref_output
+                    if warp:
+                        probs = shift_probabilities(probs, estimate_shift(ref_thumb, thumb))
+                else:
+                    probs = self.unet_probabilities(pil_img, input_size=input_size, priority=priority)
+                    ref_index, ref_thumb, ref_size, ref_output = i, thumb, pil_img.size, probs
+                    forward_passes += 1
+                result = self._unet_detections(probs, pil_img.size, threshold, variant=variant)
+
+            results.append(result)
+            reused_from.append(ref_index)
+
+        return SequenceResult(
+            results=results,
+            reused_from=reused_from,
+            forward_passes=forward_passes,
+            skipped=len(results) - forward_passes,
+        )
+
+    def infer_stream(
+        self,
+        model: str,
+        frames: Iterable[Image.Image],
+        *,
+        threshold: float | None = None,
+        batch_size: int = STREAM_BATCH_SIZE,
+        priority: Priority = Priority.SERIES,
+    ) -> Iterator[InferenceResult]:
+        model = model.lower().strip()
+        if model not in ("yolo", "unet"):
+            raise ValueError(f"Unknown model: {model}")
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be >= 1, got {batch_size}")
+        if model == "unet":
+            _require_cv2("UNet contour extraction")
+            threshold = validate_thresholds([UNET_THRESHOLD if threshold is None else threshold])[0]
+
+        with self._admit(record_latency=False) as variant:
+            input_size = self._unet_input_size(variant)
+            # Only one batch of decoded frames is alive at a time, however long the series.
+            frames = iter(frames)
+            while batch := [f.convert("RGB") for f in itertools.islice(frames, batch_size)]:
+                if model == "yolo":
+                    batch_dets = self._infer_yolo_batch(
+                        batch, conf=threshold, variant=variant, priority=priority
+                    )
+                    for pil_img, dets in zip(batch, batch_dets):
+                        yield self._yolo_result(pil_img.size, dets, variant=variant)
+                else:
+                    batch_probs = self.unet_probabilities_batch(
+                        batch, input_size=input_size, priority=priority
+                    )
+                    for pil_img, probs in zip(batch, batch_probs):
+                        yield self._unet_detections(probs, pil_img.size, threshold, variant=variant)
+
+    def infer_progressive(
+        self,
+        pil_img: Image.Image,
+        threshold: float | None = None,
+        *,
+        coarse_size: int = UNET_COARSE_SIZE,
+    ) -> Iterator[tuple[str, InferenceResult]]:
+        # UNet only: yields ("coarse", result) from a coarse_size pass, then ("final", result).
+        # The coarse phase is skipped when the full map is cached or would not be smaller.
+        _require_cv2("UNet contour extraction")
+        t = validate_thresholds([UNET_THRESHOLD if threshold is None else threshold])[0]
+        roi_crop, resize = self._unet_options(None, None)
+
+        with self._admit() as variant:
+            input_size = self._unet_input_size(variant)
+            key = self._unet_cache_key(pil_img, input_size, resize, roi_crop)
+            probs = self._prob_cache.get(key)
+            if probs is None:
+                # Decoding, resizing and the host-to-device copy happen once; the coarse
+                # input is downsampled from the full one on the device.
+                inp, content_size = self._pil_to_unet_input(pil_img, resize, input_size)
+                top, height = self._unet_band(inp, content_size[1], roi_crop)
+                coarse = None
+                if coarse_size < input_size:
+                    small, small_size = self._downscale_input(inp, content_size, coarse_size / input_size)
+                    s_top, s_height = self._unet_band(small, small_size[1], roi_crop)
+                    coarse = (self._unet_batcher.submit((small[:, s_top:s_top + s_height], None)), s_top, small_size)
+                # Both passes are queued together, so the full pass does not wait for
+                # the coarse result to be consumed.
+                fine = self._unet_batcher.submit((inp[:, top:top + height], None))
+
+                if coarse is not None:
+                    future, s_top, small_size = coarse
+                    coarse_probs = self._finish_probabilities(future.result().numpy(), s_top, small_size)
+                    yield "coarse", self._unet_detections(coarse_probs, pil_img.size, t, variant=variant)
+
+                probs = self._finish_probabilities(fine.result().numpy(), top, content_size)
+                self._prob_cache.put(key, probs)
+
+            yield "final", self._unet_detections(probs, pil_img.size, t, variant=variant)
+
+    def _infer_yolo(
+        self,
+        pil_img: Image.Image,
+        conf: float | None = None,
+        variant: str = VARIANT_FULL,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> list[dict[str, Any]]:
+        return self._infer_yolo_batch([pil_img], conf=conf, variant=variant, priority=priority)[0]
+
+    def _infer_yolo_batch(
+        self,
+        images: list[Image.Image],
+        conf: float | None = None,
+        variant: str = VARIANT_FULL,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> list[list[dict[str, Any]]]:
+        kwargs: dict[str, Any] = {} if conf is None else {"conf": validate_thresholds([conf])[0]}
+        if variant == VARIANT_REDUCED:
+            kwargs["imgsz"] = REDUCED_YOLO_IMGSZ
+        options = tuple(sorted(kwargs.items()))
+        futures = [self._yolo_batcher.submit((pil_img, options), priority) for pil_img in images]
+        return [self._yolo_detections(f.result()) for f in futures]
+
+    def _yolo_forward(self, items: list[tuple[Image.Image, tuple]]) -> list[Any]:
+        # Items in one batch share their options (they are the batcher key).
+        return self._yolo([pil_img for pil_img, _ in items], **dict(items[0][1]))
+
+    def _yolo_detections(self, r: Any) -> list[dict[str, Any]]:
+        classes = r.boxes.cls.cpu().numpy().astype(int)
+        confs = np.round(r.boxes.conf.cpu().numpy().astype(np.float64), CONF_DECIMALS)
+        boxes = np.round(r.boxes.xyxy.cpu().numpy().astype(np.float64), BOX_DECIMALS)
+        segments = r.masks.xyn if r.masks is not None else None
 
         detections: list[dict[str, Any]] = []
-        for i in range(len(r.boxes)):
+        for i in range(len(classes)):
             det: dict[str, Any] = {
-                "class": r.names[int(r.boxes[i].cls)],
-                "conf": float(r.boxes[i].conf),
-                "box": r.boxes[i].xyxy[0].tolist(),
+                "class": r.names[int(classes[i])],
+                "conf": float(confs[i]),
+                "box": boxes[i],
             }
-            if r.masks is not None:
-                det["segments"] = r.masks.xyn[i].tolist()  # normalized
+            if segments is not None:
+                det["segments"] = round_segments(segments[i])  # normalized
             detections.append(det)
 
         return detections
 
-    def _pil_to_unet_input(self, pil_img: Image.Image) -> torch.Tensor:
-        img_resized = pil_img.resize((UNET_INPUT_SIZE, UNET_INPUT_SIZE), Image.BILINEAR)
-        img_np = np.asarray(img_resized, dtype=np.float32) / 255.0
-        return torch.from_numpy(img_np).permute(2, 0, 1).unsqueeze(0).to(self._device)
+    def _yolo_result(
+        self,
+        orig_size: tuple[int, int],
+        detections: list[dict[str, Any]],
+        variant: str = VARIANT_FULL,
+    ) -> InferenceResult:
+        _require_cv2("lesion statistics")
+        # YOLO only hands back polygons, so each class is rasterized once at the
+        # original resolution and measured the same way as the UNet masks.
+        by_class: dict[str, list[np.ndarray]] = {name: [] for name in self._yolo.names.values()}
+        for det in detections:
+            if "segments" in det:
+                by_class.setdefault(det["class"], []).append(det["segments"])
+
+        classes: dict[str, Any] = {}
+        lesions: list[dict[str, Any]] = []
+        for cname, segments in by_class.items():
+            mask = rasterize_segments(segments, orig_size)
+            classes[cname], class_lesions = lesion_stats(cname, mask, orig_size)
+            lesions.extend(class_lesions)
+
+        return InferenceResult(
+            detections=detections,
+            stats={"image_size": list(orig_size), "classes": classes, "lesions": lesions},
+            variant=variant,
+        )
 
-    def _infer_unet(self, pil_img: Image.Image) -> list[dict[str, Any]]:
+    def _pil_to_unet_input(
+        self,
+        pil_img: Image.Image,
+        resize: str,
+        size: int = UNET_INPUT_SIZE,
+    ) -> tuple[torch.Tensor, tuple[int, int]]:
+        w, h = pil_img.size
+        if resize == "letterbox":
+            scale = size / max(w, h)
+            nw, nh = max(1, round(w * scale)), max(1, round(h * scale))
+        else:
+            nw, nh = size, size
+        img_np = np.array(pil_img.resize((nw, nh), Image.BILINEAR), dtype=np.uint8)
+
+        pw, ph = -(-nw // UNET_ALIGN) * UNET_ALIGN, -(-nh // UNET_ALIGN) * UNET_ALIGN
+        if (pw, ph) != (nw, nh):
+            padded = np.zeros((ph, pw, 3), dtype=np.uint8)
+            padded[:nh, :nw] = img_np
+            img_np = padded
+
+        # Copied to the device as uint8 and converted there: a quarter of the transfer.
+        inp = torch.from_numpy(img_np).to(self._device).permute(2, 0, 1).float().div_(255.0)
+        return inp, (nw, nh)
+
+    def _downscale_input(
+        self,
+        inp: torch.Tensor,
+        content_size: tuple[int, int],
+        scale: float,
+    ) -> tuple[torch.Tensor, tuple[int, int]]:
+        nw, nh = content_size
+        sw, sh = max(1, round(nw * scale)), max(1, round(nh * scale))
+        small = F.interpolate(inp[None, :, :nh, :nw], size=(sh, sw), mode="area")[0]
+        pw, ph = -(-sw // UNET_ALIGN) * UNET_ALIGN, -(-sh // UNET_ALIGN) * UNET_ALIGN
+        return F.pad(small, (0, pw - sw, 0, ph - sh)), (sw, sh)
+
+    def _unet_forward(self, batch: tuple[torch.Tensor, int | None]) -> torch.Tensor:
+        x, level = batch
+        # Also called from the batcher thread, and grad mode is thread-local.
+        with torch.no_grad():
+            # Quantized on the device (round half to even, like np.rint), so only uint8
+            # levels cross to the host: a quarter of the float32 map. With a threshold
+            # level the masks are also bit-packed there: 1/32 of it.
+            probs = torch.sigmoid(self._unet(x)).mul_(255.0).round_().to(torch.uint8)
+            if level is None:
+                return probs.cpu()  # [B,2,H,W]
+            return pack_mask_bits(probs > level).cpu()  # [B,2,H,W/8]
+
+    def _forward_single(self, inp: torch.Tensor, priority: Priority) -> np.ndarray:
+        return self._unet_batcher((inp, None), priority).numpy()
+
+    def _unet_options(self, roi_crop: bool | None, resize: str | None) -> tuple[bool, str]:
         if self._unet is None:
             raise ModelUnavailableError("unet", "UNet model not available on server")
 
-        try:
-            import cv2
-        except ImportError as e:
-            raise MissingDependencyError(
-                "cv2",
-                "OpenCV (cv2) is required for UNet contour extraction",
-            ) from e
+        roi_crop = self._unet_roi_crop if roi_crop is None else roi_crop
+        resize = self._unet_resize if resize is None else resize
+        if resize not in UNET_RESIZE_MODES:
+            raise ValueError(f"Unknown UNet resize mode: {resize}")
+        return roi_crop, resize
+
+    @staticmethod
+    def _unet_input_size(variant: str) -> int:
+        return REDUCED_UNET_INPUT_SIZE if variant == VARIANT_REDUCED else UNET_INPUT_SIZE
+
+    def _unet_cache_key(self, pil_img: Image.Image, size: int, resize: str, roi_crop: bool) -> tuple:
+        return ("unet", self._unet_key, size, resize, roi_crop, image_digest(pil_img))
+
+    def _unet_band(self, inp: torch.Tensor, content_h: int, roi_crop: bool) -> tuple[int, int]:
+        # With ROI cropping only the retinal band goes through the network; rows
+        # outside it are vitreous/background and get probability 0.
+        h = inp.shape[1]
+        if not roi_crop:
+            return 0, h
+        gray = inp[:, :content_h].mean(dim=0).cpu().numpy()
+        top, bottom = find_retina_band(gray)
+        return align_band(top, bottom, h, align=UNET_ALIGN)
+
+    def _finish_probabilities(
+        self,
+        band_probs: np.ndarray,
+        top: int,
+        content_size: tuple[int, int],
+    ) -> np.ndarray:
+        nw, nh = content_size
+        probs = np.zeros((band_probs.shape[0], nh, nw), dtype=np.uint8)
+        rows = band_probs[:, : max(0, nh - top), :nw]
+        # Padding is dropped here, so the map covers exactly the resized image.
+        # Cached and fresh requests both threshold the uint8 map, so a threshold
+        # change never changes the answer for the same threshold.
+        probs[:, top:top + rows.shape[1]] = rows
+        return probs
+
+    def _finish_masks(
+        self,
+        band_bits: np.ndarray,
+        top: int,
+        content_size: tuple[int, int],
+    ) -> np.ndarray:
+        nw, nh = content_size
+        masks = np.zeros((band_bits.shape[0], nh, nw), dtype=np.uint8)
+        rows = np.unpackbits(band_bits[:, : max(0, nh - top)], axis=-1)[..., :nw]
+        masks[:, top:top + rows.shape[1]] = rows
+        return masks
+
+    def unet_probabilities(
+        self,
+        pil_img: Image.Image,
+        *,
+        roi_crop: bool | None = None,
+        resize: str | None = None,
+        input_size: int = UNET_INPUT_SIZE,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> np.ndarray:
+        roi_crop, resize = self._unet_options(roi_crop, resize)
+        key = self._unet_cache_key(pil_img, input_size, resize, roi_crop)
+        probs = self._prob_cache.get(key)
+        if probs is not None:
+            return probs
+
+        inp, content_size = self._pil_to_unet_input(pil_img, resize, input_size)
+        top, height = self._unet_band(inp, content_size[1], roi_crop)
+        band_probs = self._forward_single(inp[:, top:top + height], priority)  # (2,h,W)
+
+        probs = self._finish_probabilities(band_probs, top, content_size)
+        self._prob_cache.put(key, probs)
+        return probs
+
+    def unet_probabilities_batch(
+        self,
+        images: Sequence[Image.Image],
+        *,
+        roi_crop: bool | None = None,
+        resize: str | None = None,
+        input_size: int = UNET_INPUT_SIZE,
+        priority: Priority = Priority.SERIES,
+    ) -> list[np.ndarray]:
+        roi_crop, resize = self._unet_options(roi_crop, resize)
+        out: list[np.ndarray | None] = [None] * len(images)
+        # All frames are queued at once; the scheduler stacks those with the same
+        # padded/cropped shape, in between higher-priority requests.
+        pending: list[tuple[int, tuple, Future, int, tuple[int, int]]] = []
+
+        for i, pil_img in enumerate(images):
+            key = self._unet_cache_key(pil_img, input_size, resize, roi_crop)
+            cached = self._prob_cache.get(key)
+            if cached is not None:
+                out[i] = cached
+                continue
+            inp, content_size = self._pil_to_unet_input(pil_img, resize, input_size)
+            top, height = self._unet_band(inp, content_size[1], roi_crop)
+            future = self._unet_batcher.submit((inp[:, top:top + height], None), priority)
+            pending.append((i, key, future, top, content_size))
+
+        for i, key, future, top, content_size in pending:
+            probs = self._finish_probabilities(future.result().numpy(), top, content_size)
+            self._prob_cache.put(key, probs)
+            out[i] = probs
+
+        return out
+
+    def unet_masks_batch(
+        self,
+        images: Sequence[Image.Image],
+        threshold: float = UNET_THRESHOLD,
+        *,
+        roi_crop: bool | None = None,
+        resize: str | None = None,
+        input_size: int = UNET_INPUT_SIZE,
+        priority: Priority = Priority.SERIES,
+    ) -> list[np.ndarray]:
+        # Binary (2,h,w) masks at the resized resolution, for callers that need no
+        # probabilities: thresholded and bit-packed on the device. Equal to
+        # unet_probabilities_batch(...) > threshold_level(threshold).
+        roi_crop, resize = self._unet_options(roi_crop, resize)
+        level = threshold_level(validate_thresholds([threshold])[0])
+        out: list[np.ndarray | None] = [None] * len(images)
+        pending: list[tuple[int, Future, int, tuple[int, int]]] = []
+
+        for i, pil_img in enumerate(images):
+            cached = self._prob_cache.get(self._unet_cache_key(pil_img, input_size, resize, roi_crop))
+            if cached is not None:
+                out[i] = (cached > level).astype(np.uint8)
+                continue
+            inp, content_size = self._pil_to_unet_input(pil_img, resize, input_size)
+            top, height = self._unet_band(inp, content_size[1], roi_crop)
+            future = self._unet_batcher.submit((inp[:, top:top + height], level), priority)
+            pending.append((i, future, top, content_size))
+
+        for i, future, top, content_size in pending:
+            out[i] = self._finish_masks(future.result().numpy(), top, content_size)
+
+        return out
+
+    def yolo_detections_batch(
+        self,
+        images: Sequence[Image.Image],
+        threshold: float | None = None,
+        *,
+        priority: Priority = Priority.SERIES,
+    ) -> list[list[dict[str, Any]]]:
+        # Detections only, for callers that rasterize the polygons themselves: no
+        # lesion statistics.
+        return self._infer_yolo_batch(list(images), conf=threshold, priority=priority)
 
-        orig_w, orig_h = pil_img.size
-        inp = self._pil_to_unet_input(pil_img)
+    def _infer_unet(
+        self,
+        pil_img: Image.Image,
+        thresholds: Sequence[float],
+        variant: str = VARIANT_FULL,
+    ) -> list[InferenceResult]:
+        if self._unet is None:
+            raise ModelUnavailableError("unet", "UNet model not available on server")
 
-        with torch.no_grad():
-            out = self._unet(inp)  # [1,2,H,W] logits
-            probs = torch.sigmoid(out)[0].cpu().numpy()  # (2,H,W)
+        _require_cv2("UNet contour extraction")
+
+        thresholds = validate_thresholds(thresholds)
+        probs = self.unet_probabilities(pil_img, input_size=self._unet_input_size(variant))
+        return [self._unet_detections(probs, pil_img.size, t, variant=variant) for t in thresholds]
+
+    def _unet_detections(
+        self,
+        probs: np.ndarray,
+        orig_size: tuple[int, int],
+        threshold: float,
+        variant: str = VARIANT_FULL,
+    ) -> InferenceResult:
+        orig_w, orig_h = orig_size
+        mask_h, mask_w = probs.shape[1:]
+        level = threshold_level(threshold)
 
-        class_names = ["fluid", "tumor"]
         detections: list[dict[str, Any]] = []
+        classes: dict[str, Any] = {}
+        lesions: list[dict[str, Any]] = []
 
-        for ch_idx, cname in enumerate(class_names):
+        for ch_idx, cname in enumerate(UNET_CLASS_NAMES):
             prob_map = probs[ch_idx]
-            mask_bin = (prob_map > UNET_THRESHOLD).astype(np.uint8) * 255
-            contours, _ = cv2.findContours(mask_bin, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            for cnt in contours:
-                if cnt is None or cnt.shape[0] < 3:
+            mask_bool = prob_map > level
+            mask_bin = mask_bool.astype(np.uint8)
+            components = connected_components(mask_bin)
+            classes[cname], class_lesions = lesion_stats(cname, mask_bin, orig_size, prob_map, components)
+            lesions.extend(class_lesions)
+            if not class_lesions:
+                continue
+
+            conf = float(prob_map[mask_bool].mean()) / 255.0
+            _, labels, cc, _ = components
+
+            # One detection per component, with the same box as its lesion entry.
+            for lesion, cnt in zip(class_lesions, component_outlines(labels, cc)):
+                if cnt is None:
                     continue
-                cnt = cnt.squeeze()
-                if cnt.ndim != 2 or cnt.shape[0] < 3:
-                    continue
-
-                xs = cnt[:, 0].astype(float) * (orig_w / UNET_INPUT_SIZE)
-                ys = cnt[:, 1].astype(float) * (orig_h / UNET_INPUT_SIZE)
 
-                x1, y1 = float(xs.min()), float(ys.min())
-                x2, y2 = float(xs.max()), float(ys.max())
-
-                seg = [[float(x) / orig_w, float(y) / orig_h] for x, y in zip(xs, ys)]
-
-                mask_bool = mask_bin > 0
-                conf = float(prob_map[mask_bool].mean()) if mask_bool.any() else 0.0
+                # Contour points are in probability-map pixels; dividing by the map size
+                # gives coordinates normalized to the original image directly.
+                seg = cnt.astype(np.float64) / (mask_w, mask_h)
 
                 detections.append(
                     {
                         "class": cname,
-                        "conf": conf,
-                        "box": [x1, y1, x2, y2],
-                        "segments": seg,
+                        "conf": round(conf, CONF_DECIMALS),
+                        "box": np.round(lesion["box"], BOX_DECIMALS),
+                        "segments": round_segments(seg),
                     }
                 )
 
-        return detections
+        return InferenceResult(
+            detections=detections,
+            stats={"image_size": [orig_w, orig_h], "classes": classes, "lesions": lesions},
+            variant=variant,
+        )
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+VARIANT_FULL = "full"
+VARIANT_REDUCED = "reduced"
+
+# Cheaper settings used while the service is saturated. Both stay multiples of 32,
+# which keeps them valid for the UNet (pools 4x) and for YOLO's stride.
+REDUCED_UNET_INPUT_SIZE = 320
+REDUCED_YOLO_IMGSZ = 416
+
+LATENCY_EWMA_ALPHA = 0.2
+
+
+@dataclass(frozen=True)
+class LoadWatermarks:
+    # Degrade when either high watermark is reached; recover only when both
+    # signals are at or below their low watermark. 0 disables a signal.
+    high_inflight: int = 0
+    low_inflight: int = 0
+    high_latency_ms: float = 0.0
+    low_latency_ms: float = 0.0
+
+    def __post_init__(self) -> None:
+        if self.high_inflight < 0 or self.low_inflight < 0:
+            raise ValueError("In-flight watermarks must be >= 0")
+        if self.high_latency_ms < 0 or self.low_latency_ms < 0:
+            raise ValueError("Latency watermarks must be >= 0")
+        if self.high_inflight and self.low_inflight >= self.high_inflight:
+            raise ValueError("low_inflight must be below high_inflight")
+        if self.high_latency_ms and self.low_latency_ms >= self.high_latency_ms:
+            raise ValueError("low_latency_ms must be below high_latency_ms")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.high_inflight or self.high_latency_ms)
+
+
+class LoadController:
+    # Picks the model variant for each new request from the number of requests in
+    # flight (queued in the batcher or running) and an EWMA of request latency.
+    # The two watermarks give hysteresis, so the service does not flap between
+    # variants on every request near the limit.
+
+    def __init__(self, watermarks: LoadWatermarks, *, alpha: float = LATENCY_EWMA_ALPHA) -> None:
+        self._wm = watermarks
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._latency_ms = 0.0
+        self._degraded = False
+        self._switches = 0
+
+    @property
+    def watermarks(self) -> LoadWatermarks:
+        return self._wm
+
+    @property
+    def degraded(self) -> bool:
+        with self._lock:
+            return self._degraded
+
+    def snapshot(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                "variant": VARIANT_REDUCED if self._degraded else VARIANT_FULL,
+                "inflight": self._inflight,
+                "latency_ms": round(self._latency_ms, 1),
+                "switches": self._switches,
+            }
+
+    def _update(self) -> None:
+        wm = self._wm
+        high = (wm.high_inflight and self._inflight >= wm.high_inflight) or (
+            wm.high_latency_ms and self._latency_ms >= wm.high_latency_ms
+        )
+        low = (not wm.high_inflight or self._inflight <= wm.low_inflight) and (
+            not wm.high_latency_ms or self._latency_ms <= wm.low_latency_ms
+        )
+        if not self._degraded and high:
+            self._degraded = True
+            self._switches += 1
+        elif self._degraded and low:
+            self._degraded = False
+            self._switches += 1
+
+    @contextmanager
+    def admit(self, *, record_latency: bool = True) -> Iterator[str]:
+        # Long multi-frame calls count towards in-flight load but do not feed the
+        # latency average, which tracks single-image requests.
+        with self._lock:
+            self._inflight += 1
+            self._update()
+            variant = VARIANT_REDUCED if self._degraded else VARIANT_FULL
+        start = time.perf_counter()
+        try:
+            yield variant
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            with self._lock:
+                self._inflight -= 1
+                if record_latency:
+                    if self._latency_ms == 0.0:
+                        self._latency_ms = elapsed_ms
+                    else:
+                        self._latency_ms += self._alpha * (elapsed_ms - self._latency_ms)
+                self._update()
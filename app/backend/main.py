@@ -1,18 +1,37 @@
+import os
+from collections.abc import Iterator
 from enum import Enum
 from io import BytesIO
+from pathlib import Path
 
-from fastapi import FastAPI, File, Form, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from PIL import Image
 
+from frame_sources import FrameDecodeError, UnsupportedFrameSourceError, count_frames, iter_frames
 from inference_service import ( 
+    STREAM_BATCH_SIZE,
     InferenceService,
+    SequenceResult,
     MissingDependencyError,
     ModelUnavailableError,
 )
+from load_control import LoadController, LoadWatermarks
+from responses import CompressionMiddleware, FastJSONResponse, dumps
+from sequence import SEQUENCE_TOLERANCE
+from series_store import (
+    Series,
+    SeriesNotFoundError,
+    SeriesStore,
+    SeriesTooLargeError,
+    to_frame,
+)
+from similar_cases import SIMILAR_TOP_K, SimilarCaseService
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 origins = [
     "http://localhost:5173",
@@ -24,6 +43,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
 
 
 class ModelEnum(str, Enum):
@@ -31,35 +51,332 @@ class ModelEnum(str, Enum):
     UNET = "unet"
 
 
-inference_service = InferenceService()
+load_watermarks = LoadWatermarks(
+    high_inflight=int(os.getenv("DEGRADE_HIGH_INFLIGHT", "0")),
+    low_inflight=int(os.getenv("DEGRADE_LOW_INFLIGHT", "0")),
+    high_latency_ms=float(os.getenv("DEGRADE_HIGH_LATENCY_MS", "0")),
+    low_latency_ms=float(os.getenv("DEGRADE_LOW_LATENCY_MS", "0")),
+)
+# "false", "true" (= "default") or a torch.compile mode such as "reduce-overhead".
+unet_compile = os.getenv("UNET_COMPILE", "false").strip().lower()
+inference_service = InferenceService(
+    unet_roi_crop=os.getenv("UNET_ROI_CROP", "false").strip().lower() == "true",
+    unet_resize=os.getenv("UNET_RESIZE", "square").strip().lower(),
+    unet_max_batch=int(os.getenv("UNET_MAX_BATCH", "1")),
+    unet_batch_wait_ms=float(os.getenv("UNET_BATCH_WAIT_MS", "5")),
+    load_controller=LoadController(load_watermarks) if load_watermarks.enabled else None,
+    unet_optimize=os.getenv("UNET_OPTIMIZE", "true").strip().lower() == "true",
+    unet_compile={"false": None, "true": "default"}.get(unet_compile, unet_compile),
+)
+series_store = SeriesStore()
 
+backend_dir = Path(__file__).resolve().parent
+similar_cases: SimilarCaseService | None = None
+try:
+    similar_cases = SimilarCaseService(
+        backend_dir / os.getenv("SIMILAR_ENCODER_WEIGHTS", "models/encoder_kermany_pretrained.pth"),
+        backend_dir / os.getenv("SIMILAR_INDEX_DIR", "models/similar_index"),
+        device=inference_service.device,
+    )
+    print(f"[INFO] Similar-case index loaded: {len(similar_cases.index)} scans")
+except Exception as e:
+    print(f"[WARN] Similar-case search disabled: {e}")
 
-@app.post("/inference")
-async def infer(file: UploadFile = File(...), model: ModelEnum = Form(ModelEnum.YOLO)):
-    img_bytes = await file.read()
-    pil_img = Image.open(BytesIO(img_bytes)).convert("RGB")
 
+def _run_inference(
+    model: ModelEnum,
+    pil_img: Image.Image,
+    threshold: float | None = None,
+    thresholds: list[float] | None = None,
+) -> FastJSONResponse:
     try:
-        result = inference_service.infer(model.value, pil_img)
-        return {"detections": result.detections}
+        # Returned as a response object so FastAPI skips jsonable_encoder and the
+        # numpy coordinate arrays go straight to the encoder.
+        if thresholds:
+            results = inference_service.infer_thresholds(model.value, pil_img, thresholds)
+            return FastJSONResponse(
+                {
+                    "results": [
+                        {"threshold": t, "detections": r.detections, "stats": r.stats}
+                        for t, r in zip(thresholds, results)
+                    ],
+                    "variant": results[0].variant,
+                }
+            )
+        result = inference_service.infer(model.value, pil_img, threshold=threshold)
+        return FastJSONResponse(
+            {"detections": result.detections, "stats": result.stats, "variant": result.variant}
+        )
+    except ValueError as e:
+        return FastJSONResponse({"detections": [], "error": str(e)})
     except ModelUnavailableError as e:
-        return {"detections": [], "error": str(e)}
+        return FastJSONResponse({"detections": [], "error": str(e)})
     except MissingDependencyError as e:
-        return {"detections": [], "error": str(e)}
+        return FastJSONResponse({"detections": [], "error": str(e)})
     except Exception as e:
         print(f"[WARN] Inference failed: {e}")
-        return {"detections": [], "error": "Inference failed"}
+        return FastJSONResponse({"detections": [], "error": "Inference failed"})
+
+
+def _estimate_volume(n_frames: int) -> float:
+    # Placeholder until a volume model exists; it only needs the number of frames,
+    # so uploads are validated and counted but not decoded.
+    import random
+
+    return random.uniform(1, 16)
+
+
+def _count_upload_frames(files: list[UploadFile]) -> int:
+    n = 0
+    for file in files:
+        file.file.seek(0)
+        n += count_frames(file.file)
+    return n
+
+
+def _upload_frames(files: list[UploadFile]) -> Iterator[Image.Image]:
+    # Uploads are spooled to disk by Starlette, so containers are read lazily from there.
+    for file in files:
+        file.file.seek(0)
+        yield from iter_frames(file.file)
+
+
+def _get_similar_cases() -> SimilarCaseService:
+    if similar_cases is None:
+        raise HTTPException(status_code=503, detail="Similar-case search not available on server")
+    return similar_cases
+
+
+def _get_series(series_id: str) -> Series:
+    try:
+        return series_store.get(series_id)
+    except SeriesNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+
+
+@app.post("/inference")
+async def infer(
+    file: UploadFile = File(...),
+    model: ModelEnum = Form(ModelEnum.YOLO),
+    threshold: float | None = Form(None),
+    thresholds: list[float] | None = Form(None),
+):
+    img_bytes = await file.read()
+    pil_img = Image.open(BytesIO(img_bytes)).convert("RGB")
+    # Off the event loop, so concurrent requests can meet in the UNet micro-batcher.
+    return await run_in_threadpool(_run_inference, model, pil_img, threshold, thresholds)
+
+
+@app.post("/inference/progressive")
+async def infer_progressive(
+    file: UploadFile = File(...),
+    threshold: float | None = Form(None),
+):
+    img_bytes = await file.read()
+    pil_img = Image.open(BytesIO(img_bytes)).convert("RGB")
+
+    # UNet only: a "coarse" NDJSON line from a low-resolution pass, then the "final" one.
+    def lines() -> Iterator[bytes]:
+        try:
+            for phase, r in inference_service.infer_progressive(pil_img, threshold=threshold):
+                line = {"phase": phase, "detections": r.detections, "stats": r.stats, "variant": r.variant}
+                yield dumps(line) + b"\n"
+        except (ValueError, ModelUnavailableError, MissingDependencyError) as e:
+            yield dumps({"phase": "final", "detections": [], "error": str(e)}) + b"\n"
+        except Exception as e:
+            print(f"[WARN] Progressive inference failed: {e}")
+            yield dumps({"phase": "final", "detections": [], "error": "Inference failed"}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/similar")
+async def find_similar(
+    file: UploadFile = File(...),
+    k: int = Form(SIMILAR_TOP_K),
+):
+    service = _get_similar_cases()
+    img_bytes = await file.read()
+    pil_img = Image.open(BytesIO(img_bytes)).convert("RGB")
+    try:
+        results = await run_in_threadpool(service.search, pil_img, k)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    return {"results": results, "indexed": len(service.index)}
+
+
+@app.post("/similar/index")
+async def index_similar(
+    file: UploadFile = File(...),
+    key: str = Form(...),
+):
+    # Adds one scan to the index (e.g. once it has been reviewed); no rebuild needed.
+    service = _get_similar_cases()
+    if not key.strip():
+        raise HTTPException(status_code=422, detail="key must not be empty")
+    img_bytes = await file.read()
+    pil_img = Image.open(BytesIO(img_bytes)).convert("RGB")
+    try:
+        await run_in_threadpool(service.add, pil_img, key)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+    return {"key": key, "indexed": len(service.index)}
 
 
 @app.post("/volume")
 async def calculcate_volume(files: list[UploadFile] = File(...)):
-    images = []
-    for file in files:
-        img_bytes = await file.read()
-        img = Image.open(BytesIO(img_bytes))
-        images.append(img)
+    try:
+        n_frames = await run_in_threadpool(_count_upload_frames, files)
+    except UnsupportedFrameSourceError as e:
+        raise HTTPException(status_code=415, detail=str(e)) from e
+    except FrameDecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    return {"volume": _estimate_volume(n_frames)}
+
+
+@app.post("/inference/stream")
+async def infer_stream(
+    file: UploadFile = File(...),
+    model: ModelEnum = Form(ModelEnum.UNET),
+    threshold: float | None = Form(None),
+    batch_size: int = Form(STREAM_BATCH_SIZE),
+):
+    # One NDJSON line per frame as soon as its batch is done, then a summary line.
+    def lines() -> Iterator[bytes]:
+        n = 0
+        try:
+            results = inference_service.infer_stream(
+                model.value,
+                _upload_frames([file]),
+                threshold=threshold,
+                batch_size=batch_size,
+            )
+            for n, r in enumerate(results, start=1):
+                line = {"index": n - 1, "detections": r.detections, "stats": r.stats, "variant": r.variant}
+                yield dumps(line) + b"\n"
+        except (ValueError, ModelUnavailableError, MissingDependencyError) as e:
+            yield dumps({"error": str(e)}) + b"\n"
+        except Exception as e:
+            print(f"[WARN] Stream inference failed: {e}")
+            yield dumps({"error": "Inference failed"}) + b"\n"
+        yield dumps({"done": True, "frames": n}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/series")
+async def create_series(files: list[UploadFile] = File(...)):
+    try:
+        frames = await run_in_threadpool(lambda: [to_frame(f) for f in _upload_frames(files)])
+    except UnsupportedFrameSourceError as e:
+        raise HTTPException(status_code=415, detail=str(e)) from e
+    except FrameDecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+
+    try:
+        series = series_store.add(frames)
+    except SeriesTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e)) from e
+    return {
+        "series_id": series.series_id,
+        "frames": len(series),
+        "ttl_seconds": series_store.ttl_seconds,
+    }
+
+
+@app.get("/series/{series_id}")
+async def describe_series(series_id: str):
+    series = _get_series(series_id)
+    return {
+        "series_id": series.series_id,
+        "frames": len(series),
+        "shapes": [list(f.shape[:2]) for f in series.frames],
+    }
+
+
+@app.delete("/series/{series_id}")
+async def delete_series(series_id: str):
+    try:
+        series_store.delete(series_id)
+    except SeriesNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    return {"deleted": series_id}
+
+
+@app.post("/series/{series_id}/inference")
+async def infer_series_frame(
+    series_id: str,
+    index: int = Form(...),
+    model: ModelEnum = Form(ModelEnum.YOLO),
+    threshold: float | None = Form(None),
+    thresholds: list[float] | None = Form(None),
+):
+    series = _get_series(series_id)
+    if not 0 <= index < len(series):
+        raise HTTPException(status_code=404, detail=f"Frame index out of range: {index}")
+    return await run_in_threadpool(_run_inference, model, series.image(index), threshold, thresholds)
+
+
+def _run_sequence(
+    model: ModelEnum,
+    series: Series,
+    indices: list[int],
+    threshold: float | None,
+    tolerance: float,
+    warp: bool,
+) -> FastJSONResponse:
+    try:
+        seq: SequenceResult = inference_service.infer_sequence(
+            model.value,
+            [series.image(i) for i in indices],
+            threshold=threshold,
+            tolerance=tolerance,
+            warp=warp,
+        )
+    except (ValueError, ModelUnavailableError, MissingDependencyError) as e:
+        return FastJSONResponse({"frames": [], "error": str(e)})
+    except Exception as e:
+        print(f"[WARN] Sequence inference failed: {e}")
+        return FastJSONResponse({"frames": [], "error": "Inference failed"})
+
+    return FastJSONResponse(
+        {
+            "frames": [
+                {
+                    "index": index,
+                    "reused_from": indices[ref],
+                    "detections": r.detections,
+                    "stats": r.stats,
+                }
+                for index, ref, r in zip(indices, seq.reused_from, seq.results)
+            ],
+            "forward_passes": seq.forward_passes,
+            "skipped": seq.skipped,
+            "variant": seq.results[0].variant if seq.results else None,
+        }
+    )
+
+
+@app.post("/series/{series_id}/analyze")
+async def analyze_series(
+    series_id: str,
+    model: ModelEnum = Form(ModelEnum.UNET),
+    indices: list[int] | None = Form(None),
+    threshold: float | None = Form(None),
+    tolerance: float = Form(SEQUENCE_TOLERANCE),
+    warp: bool = Form(False),
+):
+    series = _get_series(series_id)
+    selected = indices if indices is not None else list(range(len(series)))
+    if any(not 0 <= i < len(series) for i in selected):
+        raise HTTPException(status_code=404, detail="Frame index out of range")
+    return await run_in_threadpool(_run_sequence, model, series, selected, threshold, tolerance, warp)
 
-    import random
 
-    volume = random.uniform(1, 16)
-    return {"volume": volume}
+@app.post("/series/{series_id}/volume")
+async def calculate_series_volume(series_id: str, indices: list[int] | None = Form(None)):
+    series = _get_series(series_id)
+    selected = indices if indices is not None else list(range(len(series)))
+    if any(not 0 <= i < len(series) for i in selected):
+        raise HTTPException(status_code=404, detail="Frame index out of range")
+    return {"volume": _estimate_volume(len(selected))}
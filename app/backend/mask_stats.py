@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from typing import Any
+
+import numpy as np
+
+
+AREA_DECIMALS = 2
+CENTROID_DECIMALS = 4
+
+
+def rasterize_segments(
+    segments: list[np.ndarray],
+    size: tuple[int, int],
+) -> np.ndarray:
+    import cv2
+
+    w, h = size
+    mask = np.zeros((h, w), dtype=np.uint8)
+    polys = [np.rint(np.asarray(seg) * (w, h)).astype(np.int32) for seg in segments if len(seg) >= 3]
+    if polys:
+        cv2.fillPoly(mask, polys, 1)
+    return mask
+
+
+def connected_components(mask: np.ndarray) -> tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+    import cv2
+
+    return cv2.connectedComponentsWithStats(mask.astype(np.uint8, copy=False), connectivity=8)
+
+
+def component_outlines(labels: np.ndarray, cc: np.ndarray) -> list[np.ndarray | None]:
+    import cv2
+
+    # Outer contour of every component (background row excluded), traced only
+    # inside the component's bounding box; None for components too thin for a polygon.
+    outlines: list[np.ndarray | None] = []
+    for i, (x, y, w, h) in enumerate(cc[1:, :4], start=1):
+        roi = (labels[y:y + h, x:x + w] == i).astype(np.uint8)
+        contours, _ = cv2.findContours(
+            roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y))
+        )
+        cnt = max(contours, key=len).reshape(-1, 2) if contours else None
+        outlines.append(cnt if cnt is not None and len(cnt) >= 3 else None)
+    return outlines
+
+
+def lesion_stats(
+    class_name: str,
+    mask: np.ndarray,
+    orig_size: tuple[int, int],
+    prob_map: np.ndarray | None = None,
+    components: tuple[int, np.ndarray, np.ndarray, np.ndarray] | None = None,
+) -> tuple[dict[str, Any], list[dict[str, Any]]]:
+    import cv2
+
+    # `mask` may be at any resolution: areas and boxes are scaled to original image
+    # pixels and centroids are normalized, the same units as the detections. Boxes
+    # cover whole pixels: x2 = left + width. Pass `components` from
+    # connected_components(mask) to reuse a labelling.
+    mask_h, mask_w = mask.shape
+    orig_w, orig_h = orig_size
+    sx, sy = orig_w / mask_w, orig_h / mask_h
+
+    n, labels, cc, centroids = components if components is not None else connected_components(mask)
+    # Row 0 is the background component.
+    cc = cc[1:]
+    centroids = centroids[1:]
+
+    areas = cc[:, cv2.CC_STAT_AREA].astype(np.float64)
+    areas_px = np.round(areas * sx * sy, AREA_DECIMALS)
+    x = cc[:, cv2.CC_STAT_LEFT]
+    y = cc[:, cv2.CC_STAT_TOP]
+    boxes = np.stack(
+        [x, y, x + cc[:, cv2.CC_STAT_WIDTH], y + cc[:, cv2.CC_STAT_HEIGHT]], axis=1
+    ).astype(np.float64) * (sx, sy, sx, sy)
+    boxes = np.round(boxes, AREA_DECIMALS)
+    centroids = np.round(centroids / (mask_w, mask_h), CENTROID_DECIMALS)
+
+    mean_probs = None
+    if prob_map is not None and n > 1:
+        sums = np.bincount(labels.ravel(), weights=prob_map.ravel(), minlength=n)[1:]
+        mean_probs = np.round(sums / np.maximum(areas, 1.0) / 255.0, CENTROID_DECIMALS)
+
+    lesions: list[dict[str, Any]] = []
+    for i in range(n - 1):
+        lesion: dict[str, Any] = {
+            "class": class_name,
+            "area_px": float(areas_px[i]),
+            "centroid": centroids[i],
+            "box": boxes[i],
+        }
+        if mean_probs is not None:
+            lesion["mean_prob"] = float(mean_probs[i])
+        lesions.append(lesion)
+
+    summary = {
+        "area_px": round(float(areas_px.sum()), AREA_DECIMALS),
+        "area_fraction": round(float(areas.sum()) / (mask_w * mask_h), 6),
+        "components": n - 1,
+    }
+    return summary, lesions
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable
+
+import numpy as np
+from PIL import Image
+
+
+PROB_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def image_digest(pil_img: Image.Image) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{pil_img.mode}:{pil_img.size}".encode())
+    h.update(pil_img.tobytes())
+    return h.hexdigest()
+
+
+def threshold_level(threshold: float) -> int:
+    # prob > threshold  <=>  uint8 level > threshold_level(threshold), up to quantization (1/255).
+    return int(threshold * 255.0)
+
+
+class ProbabilityMapCache:
+    def __init__(self, max_bytes: int = PROB_CACHE_MAX_BYTES) -> None:
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> np.ndarray | None:
+        with self._lock:
+            probs = self._entries.get(key)
+            if probs is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return probs
+
+    def put(self, key: Hashable, probs: np.ndarray) -> None:
+        if probs.dtype != np.uint8:
+            raise TypeError(f"Probability maps must be quantized to uint8, got {probs.dtype}")
+        if probs.nbytes > self._max_bytes:
+            return
+        probs.setflags(write=False)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            while self._entries and self._nbytes + probs.nbytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+            self._entries[key] = probs
+            self._nbytes += probs.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
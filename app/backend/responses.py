@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import gzip
+import json
+from typing import Any
+
+import numpy as np
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    # orjson writes numpy arrays straight from their buffers; the stdlib fallback
+    # has to go through Python lists first.
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(
+        content,
+        default=_json_default,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    accepted: dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[token] = q
+
+    def quality(name: str) -> float:
+        return accepted.get(name, accepted.get("*", 0.0))
+
+    # The acceptable encoding with the highest q wins; br (listed first) breaks ties.
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best = max(supported, key=quality)
+    return best if quality(best) > 0.0 else None
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Message | None = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            if message["type"] == "http.response.body" and start_message is not None:
+                start, start_message = start_message, None
+                headers = MutableHeaders(raw=start["headers"])
+                body = message.get("body", b"")
+                # Streaming responses pass through untouched so every chunk reaches
+                # the client as soon as it is produced.
+                if (
+                    message.get("more_body", False)
+                    or "content-encoding" in headers
+                    or len(body) < self.minimum_size
+                ):
+                    await send(start)
+                    await send(message)
+                    return
+
+                body = compress(encoding, body)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+                return
+
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
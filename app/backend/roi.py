@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+# The UNet pools four times, so crops are padded to a multiple of 2**4 rows.
+ROI_ALIGN = 16
+ROI_MARGIN = 16
+ROI_SMOOTH_ROWS = 9
+ROI_REL_THRESHOLD = 0.15
+
+
+def find_retina_band(
+    gray: np.ndarray,
+    *,
+    rel_threshold: float = ROI_REL_THRESHOLD,
+    margin: int = ROI_MARGIN,
+) -> tuple[int, int]:
+    # The retina is the only bright horizontal structure in a B-scan: rows whose
+    # smoothed mean intensity rises clearly above the background level bound it.
+    h = gray.shape[0]
+    profile = gray.mean(axis=1, dtype=np.float64)
+    kernel = np.full(ROI_SMOOTH_ROWS, 1.0 / ROI_SMOOTH_ROWS)
+    profile = np.convolve(profile, kernel, mode="same")
+
+    background = float(np.percentile(profile, 5))
+    peak = float(profile.max())
+    if peak - background < 1e-3:
+        return 0, h
+
+    rows = np.flatnonzero(profile > background + rel_threshold * (peak - background))
+    top = max(int(rows[0]) - margin, 0)
+    bottom = min(int(rows[-1]) + 1 + margin, h)
+    return top, bottom
+
+
+def align_band(top: int, bottom: int, size: int, align: int = ROI_ALIGN) -> tuple[int, int]:
+    height = min(-(-(bottom - top) // align) * align, size)
+    top = min(top, size - height)
+    return top, height
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import numpy as np
+from PIL import Image
+
+
+SEQUENCE_THUMB_SIZE = 128
+# Mean absolute difference of the grayscale thumbnails, as a fraction of full scale.
+SEQUENCE_TOLERANCE = 0.02
+
+
+def slice_thumbnail(pil_img: Image.Image) -> np.ndarray:
+    thumb = pil_img.convert("L").resize((SEQUENCE_THUMB_SIZE, SEQUENCE_THUMB_SIZE), Image.BILINEAR)
+    return np.asarray(thumb, dtype=np.float32) / 255.0
+
+
+def slice_distance(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.abs(a - b).mean())
+
+
+def estimate_shift(reference: np.ndarray, current: np.ndarray) -> tuple[float, float]:
+    import cv2
+
+    # Phase correlation gives the translation taking `reference` onto `current`,
+    # in thumbnail pixels.
+    (dx, dy), _ = cv2.phaseCorrelate(reference.astype(np.float64), current.astype(np.float64))
+    return dx, dy
+
+
+def shift_probabilities(probs: np.ndarray, shift: tuple[float, float]) -> np.ndarray:
+    import cv2
+
+    h, w = probs.shape[1:]
+    dx = shift[0] * w / SEQUENCE_THUMB_SIZE
+    dy = shift[1] * h / SEQUENCE_THUMB_SIZE
+    m = np.float32([[1, 0, dx], [0, 1, dy]])
+    return np.stack(
+        [
+            cv2.warpAffine(ch, m, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            for ch in probs
+        ]
+    )
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+
+SERIES_TTL_SECONDS = 30 * 60
+SERIES_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class SeriesNotFoundError(LookupError):
+    def __init__(self, series_id: str):
+        self.series_id = series_id
+        super().__init__(f"Series not found or expired: {series_id}")
+
+
+class SeriesTooLargeError(ValueError):
+    pass
+
+
+@dataclass
+class Series:
+    series_id: str
+    frames: list[np.ndarray]
+    expires_at: float
+    nbytes: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.nbytes = sum(f.nbytes for f in self.frames)
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def image(self, index: int) -> Image.Image:
+        # fromarray shares the frame buffer, so this is not a decode.
+        frame = self.frames[index]
+        img = Image.fromarray(frame)
+        return img if frame.ndim == 3 else img.convert("RGB")
+
+    def images(self) -> list[Image.Image]:
+        return [self.image(i) for i in range(len(self.frames))]
+
+
+def scale_to_uint8(pixels: np.ndarray, bits: int) -> np.ndarray:
+    # Scale by the stored bit depth, not per frame, so intensities stay comparable
+    # across the slices of one series.
+    return np.clip(pixels.astype(np.float32) * (255.0 / (2**bits - 1)), 0, 255).astype(np.uint8)
+
+
+def is_high_depth(pil_img: Image.Image) -> bool:
+    return pil_img.mode == "I" or pil_img.mode.startswith("I;16")
+
+
+def to_grayscale(pil_img: Image.Image) -> Image.Image:
+    # convert("L") clips 16-bit samples at 255 instead of scaling them. TIFF records
+    # the stored depth (BitsPerSample); other sources are taken as full 16-bit.
+    if not is_high_depth(pil_img):
+        return pil_img.convert("L")
+    bits = getattr(pil_img, "tag_v2", {}).get(258, 16)
+    bits = bits[0] if isinstance(bits, tuple) else bits
+    return Image.fromarray(scale_to_uint8(np.asarray(pil_img), int(bits)))
+
+
+def to_frame(pil_img: Image.Image) -> np.ndarray:
+    # Grayscale scans (most OCT exports) are kept single-channel: a third of the RGB size.
+    if pil_img.mode in ("L", "1") or is_high_depth(pil_img):
+        return np.ascontiguousarray(np.asarray(to_grayscale(pil_img), dtype=np.uint8))
+    return np.ascontiguousarray(np.asarray(pil_img.convert("RGB"), dtype=np.uint8))
+
+
+class SeriesStore:
+    def __init__(
+        self,
+        *,
+        ttl_seconds: float = SERIES_TTL_SECONDS,
+        max_bytes: int = SERIES_MAX_BYTES,
+    ) -> None:
+        self._ttl = ttl_seconds
+        self._max_bytes = max_bytes
+        self._series: OrderedDict[str, Series] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ttl_seconds(self) -> float:
+        return self._ttl
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def add(self, frames: list[np.ndarray]) -> Series:
+        series = Series(
+            series_id=uuid.uuid4().hex,
+            frames=frames,
+            expires_at=time.monotonic() + self._ttl,
+        )
+        if series.nbytes > self._max_bytes:
+            raise SeriesTooLargeError(
+                f"Series of {series.nbytes} bytes exceeds the store limit of {self._max_bytes} bytes"
+            )
+
+        with self._lock:
+            self._evict_expired()
+            # Least recently used series go first once the byte budget is exceeded.
+            while self._series and self._nbytes + series.nbytes > self._max_bytes:
+                self._remove(next(iter(self._series)))
+            self._series[series.series_id] = series
+            self._nbytes += series.nbytes
+        return series
+
+    def get(self, series_id: str) -> Series:
+        with self._lock:
+            self._evict_expired()
+            series = self._series.get(series_id)
+            if series is None:
+                raise SeriesNotFoundError(series_id)
+            series.expires_at = time.monotonic() + self._ttl
+            self._series.move_to_end(series_id)
+            return series
+
+    def delete(self, series_id: str) -> None:
+        with self._lock:
+            if series_id not in self._series:
+                raise SeriesNotFoundError(series_id)
+            self._remove(series_id)
+
+    def _remove(self, series_id: str) -> None:
+        series = self._series.pop(series_id)
+        self._nbytes -= series.nbytes
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [sid for sid, s in self._series.items() if s.expires_at <= now]
+        for sid in expired:
+            self._remove(sid)
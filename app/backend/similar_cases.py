@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import argparse
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+from PIL import Image
+
+from bulk_infer import batches, collect_images, prefetch
+from embedding_index import IVF_NPROBE, EmbeddingIndex
+from unet_arch import UNetEncoder
+
+
+# Same preprocessing as the Kermany val/test transform the encoder was trained with:
+# Resize(512) on the short side -> CenterCrop(512) -> Normalize(0.5, 0.5).
+ENCODER_INPUT_SIZE = 512
+EMBED_BATCH_SIZE = 16
+SIMILAR_TOP_K = 5
+PROGRESS_EVERY = 500
+
+
+class ScanEmbedder:
+    # One L2-normalized vector per scan: the encoder's conv5 features, average-pooled
+    # (the input of the Kermany classification head).
+
+    def __init__(self, weights_path: str | Path, device: torch.device | None = None) -> None:
+        self._device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self._encoder = UNetEncoder(in_channels=3)
+        # Accepts encoder checkpoints (train_kermany.py), full KermanyClassifier ones
+        # ("encoder." prefix) and UNet checkpoints, whose conv1-conv5 are the encoder.
+        state = torch.load(str(weights_path), map_location=self._device)
+        state = {k.removeprefix("encoder."): v for k, v in state.items()}
+        missing, _ = self._encoder.load_state_dict(state, strict=False)
+        if missing:
+            raise ValueError(f"Not an encoder checkpoint, missing {len(missing)} keys: {weights_path}")
+        self._encoder.to(self._device).eval()
+
+    @property
+    def dim(self) -> int:
+        return self._encoder.out_channels
+
+    @staticmethod
+    def preprocess(pil_img: Image.Image) -> np.ndarray:
+        # Rounded like torchvision's Resize and CenterCrop.
+        w, h = pil_img.size
+        size = ENCODER_INPUT_SIZE
+        nw, nh = (size, int(size * h / w)) if w <= h else (int(size * w / h), size)
+        img = pil_img.convert("RGB").resize((nw, nh), Image.BILINEAR)
+        left, top = round((nw - size) / 2), round((nh - size) / 2)
+        img = img.crop((left, top, left + size, top + size))
+        return np.asarray(img, dtype=np.uint8)
+
+    def embed(self, images: Sequence[np.ndarray]) -> np.ndarray:
+        # `images` are preprocess() outputs; copied to the device as uint8.
+        x = torch.from_numpy(np.stack(images)).to(self._device).permute(0, 3, 1, 2).float()
+        x = x.div_(127.5).sub_(1.0)
+        with torch.no_grad():
+            features = self._encoder(x).mean(dim=(2, 3))
+        return torch.nn.functional.normalize(features, dim=1).cpu().numpy()
+
+
+class SimilarCaseService:
+    def __init__(self, encoder_weights: str | Path, index_dir: str | Path, device: torch.device | None = None) -> None:
+        self._embedder = ScanEmbedder(encoder_weights, device)
+        self._index = EmbeddingIndex(index_dir, dim=self._embedder.dim)
+
+    @property
+    def index(self) -> EmbeddingIndex:
+        return self._index
+
+    def search(self, pil_img: Image.Image, k: int = SIMILAR_TOP_K, *, nprobe: int = IVF_NPROBE) -> list[dict[str, Any]]:
+        if k < 1:
+            raise ValueError("k must be >= 1")
+        query = self._embedder.embed([self._embedder.preprocess(pil_img)])
+        return [{"key": key, "score": round(score, 4)} for key, score in self._index.search(query, k, nprobe=nprobe)[0]]
+
+    def add(self, pil_img: Image.Image, key: str) -> None:
+        if not key:
+            raise ValueError("key must not be empty")
+        self._index.add(self._embedder.embed([self._embedder.preprocess(pil_img)]), [key])
+
+
+def run(args: argparse.Namespace) -> None:
+    embedder = ScanEmbedder(args.encoder_weights)
+    index = EmbeddingIndex(args.index_dir, dim=embedder.dim)
+
+    # Keys are paths relative to their input, so re-running over a grown corpus only
+    # embeds the new scans.
+    todo = [(path, rel.as_posix()) for path, rel in collect_images(args.inputs, args.root_dir, args.image_column)]
+    todo = [(path, key) for path, key in todo if key not in index]
+    print(f"[INFO] {len(index)} scans indexed, {len(todo)} to add")
+
+    def load(item: tuple[Path, str]) -> np.ndarray:
+        with Image.open(item[0]) as img:
+            return embedder.preprocess(img)
+
+    done = 0
+    start = time.perf_counter()
+    for batch in batches(prefetch(todo, load, args.workers, depth=2 * args.batch_size), args.batch_size):
+        index.add(embedder.embed([img for _, img in batch]), [key for (_, key), _ in batch])
+        prev, done = done, done + len(batch)
+        if done // PROGRESS_EVERY != prev // PROGRESS_EVERY or done == len(todo):
+            print(f"[INFO] {done}/{len(todo)} scans, {done / (time.perf_counter() - start):.1f} scans/s")
+
+    # The inverted lists are built once the index is large enough; later runs only
+    # append to them unless --retrain is given.
+    if args.retrain or (index.nlist == 0 and todo):
+        index.train(args.nlist)
+    lists = f"{index.nlist} IVF lists" if index.nlist else "flat"
+    print(f"[INFO] Index: {len(index)} scans ({lists}) in {args.index_dir}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Embed OCT scans with the pretrained U-Net encoder into a similarity index.")
+    parser.add_argument("inputs", nargs="+",
+                        help="Image directories, glob patterns or split CSVs (e.g. Ophthalmic_Scans/splits/.../train.csv)")
+    parser.add_argument("--index_dir", type=str, default="models/similar_index")
+    parser.add_argument("--encoder_weights", type=str, default="models/encoder_kermany_pretrained.pth")
+    parser.add_argument("--batch_size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=4, help="Image decode threads")
+    parser.add_argument("--root_dir", type=str, default=None,
+                        help="Base directory for paths in split CSVs (default: the Ophthalmic_Scans directory containing the CSV)")
+    parser.add_argument("--image_column", type=str, default="image_path")
+    parser.add_argument("--retrain", action="store_true", help="Re-cluster the IVF lists over all indexed scans")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists for (re)training (default: ~4*sqrt(N))")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -87,3 +87,26 @@ class UNet(nn.Module):
         )
 
         return torch.cat([skip, up], dim=1)
+
+
+class UNetEncoder(nn.Module):
+    # The contracting path of UNet (conv1-conv5), as pretrained on Kermany OCT by
+    # train_model/transfer_learning/train_kermany.py; same state_dict keys.
+    def __init__(self, in_channels: int = 3, base: int = 64):
+        super().__init__()
+        self.conv1 = self.double_conv(in_channels, base)
+        self.conv2 = self.double_conv(base, base * 2)
+        self.conv3 = self.double_conv(base * 2, base * 4)
+        self.conv4 = self.double_conv(base * 4, base * 8)
+        self.conv5 = self.double_conv(base * 8, base * 16)
+        self.pool = nn.MaxPool2d(2)
+        self.out_channels = base * 16
+
+    double_conv = UNet.double_conv
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.conv1(x)
+        x = self.conv2(self.pool(x))
+        x = self.conv3(self.pool(x))
+        x = self.conv4(self.pool(x))
+        return self.conv5(self.pool(x))
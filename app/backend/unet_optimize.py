@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import copy
+import hashlib
+import os
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from unet_arch import UNet
+
+
+# Max |difference| of sigmoid outputs accepted from an optimized UNet: well below one
+# uint8 quantization step (1/255) of the probability maps the service hands out.
+UNET_PARITY_ATOL = 1e-3
+UNET_PARITY_INPUT = (1, 3, 256, 256)
+UNET_OPTIMIZED_CACHE_DIR = ".cache"
+# torch.compile modes; "reduce-overhead" adds CUDA graphs, "max-autotune" also benchmarks
+# Triton/GEMM kernels at compile time (slow start-up, for long-running servers).
+UNET_COMPILE_MODES = ("default", "reduce-overhead", "max-autotune")
+
+
+class ParityError(RuntimeError):
+    def __init__(self, max_diff: float, atol: float):
+        self.max_diff = max_diff
+        super().__init__(f"Optimized UNet differs from the reference by {max_diff:.2e} (> {atol:.0e})")
+
+
+def fold_batchnorm(model: nn.Module) -> int:
+    # Every double_conv is Conv2d -> BatchNorm2d -> ReLU. In eval mode the BN is an
+    # affine transform of the conv output, so it is folded into the conv weights and
+    # replaced by Identity (the Sequential indices, and thus the state_dict keys of
+    # the convs, stay the same).
+    folded = 0
+    for seq in model.modules():
+        if not isinstance(seq, nn.Sequential):
+            continue
+        for i in range(len(seq) - 1):
+            conv, bn = seq[i], seq[i + 1]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                seq[i] = fuse_conv_bn_eval(conv, bn)
+                seq[i + 1] = nn.Identity()
+                folded += 1
+    return folded
+
+
+def folded_unet(**kwargs: int) -> UNet:
+    # The module structure of a folded UNet, to load a cached folded state_dict into.
+    model = UNet(**kwargs).eval()
+    for seq in model.modules():
+        if isinstance(seq, nn.Sequential):
+            for i, m in enumerate(seq):
+                if isinstance(m, nn.BatchNorm2d):
+                    seq[i] = nn.Identity()
+    return model
+
+
+@torch.no_grad()
+def max_output_diff(reference: nn.Module, optimized: nn.Module, x: torch.Tensor) -> float:
+    return float((torch.sigmoid(reference(x)) - torch.sigmoid(optimized(x))).abs().max())
+
+
+def _digest(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=12)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def optimize_unet(
+    model: UNet,
+    weights_path: Path,
+    *,
+    cache_dir: Path | None = None,
+    compile: str | None = None,
+    warmup_shapes: Iterable[tuple[int, int, int]] = (),
+    atol: float = UNET_PARITY_ATOL,
+) -> tuple[nn.Module, dict[str, object]]:
+    # `compile` is a UNET_COMPILE_MODES entry or None; `warmup_shapes` are the
+    # (batch, height, width) inputs to compile for before the model serves requests.
+    if compile is not None and compile not in UNET_COMPILE_MODES:
+        raise ValueError(f"Unknown torch.compile mode: {compile}")
+    device = next(model.parameters()).device
+    cache_dir = cache_dir or weights_path.parent / UNET_OPTIMIZED_CACHE_DIR
+    cache_path = cache_dir / f"{weights_path.stem}-folded-{_digest(weights_path)}.pth"
+
+    if cache_path.exists():
+        optimized: nn.Module = folded_unet()
+        optimized.load_state_dict(torch.load(str(cache_path), map_location=device))
+        optimized.to(device)
+        folded = sum(isinstance(m, nn.Identity) for m in optimized.modules())
+        cached = True
+    else:
+        optimized = copy.deepcopy(model)
+        folded = fold_batchnorm(optimized)
+        cached = False
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = cache_path.with_name(cache_path.name + ".tmp")
+            torch.save(optimized.state_dict(), str(tmp))
+            os.replace(tmp, cache_path)
+        except OSError as e:
+            # Read-only model directories (e.g. a mounted volume) only lose the cache.
+            print(f"[WARN] Could not cache folded UNet at {cache_path}: {e}")
+
+    gen = torch.Generator().manual_seed(0)
+    x = torch.rand(UNET_PARITY_INPUT, generator=gen).to(device)
+    diff = max_output_diff(model, optimized, x)
+    if diff > atol:
+        raise ParityError(diff, atol)
+
+    compile_s = None
+    if compile:
+        # Inductor fuses the conv bias and ReLU epilogues; shapes vary with ROI cropping
+        # and letterboxing, so the graph is compiled for dynamic shapes. Compilation is
+        # lazy: the warm-up pays for it here instead of in the first requests.
+        start = time.perf_counter()
+        try:
+            compiled = torch.compile(optimized, mode=compile, dynamic=True)
+            with torch.no_grad():
+                for batch, height, width in warmup_shapes:
+                    compiled(torch.zeros(batch, 3, height, width, device=device))
+            compiled_diff = max_output_diff(model, compiled, x)
+            if compiled_diff > atol:
+                raise ParityError(compiled_diff, atol)
+        except Exception as e:
+            # A missing compiler toolchain or an unsupported backend leaves the folded
+            # eager model, which already passed the parity check.
+            torch._dynamo.reset()
+            print(f"[WARN] torch.compile(mode={compile}) failed, serving the eager UNet: {e}")
+            compile = None
+        else:
+            optimized, diff = compiled, compiled_diff
+            compile_s = time.perf_counter() - start
+
+    return optimized, {
+        "folded_bn": folded, "cached": cached, "compiled": compile, "compile_s": compile_s, "max_diff": diff,
+    }
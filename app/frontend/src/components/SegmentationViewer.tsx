@@ -1,6 +1,6 @@
 import React, { useEffect, useRef, useState } from "react";
 import { X, Eye, EyeOff, Loader, ChevronRight } from "lucide-react";
-import type { Detection } from "../types/inference";
+import type { Detection, ProgressivePhase } from "../types/inference";
 import AEyeLogo from "../assets/logo.svg";
 
 interface SegmentationViewerProps {
@@ -19,6 +19,7 @@ export const SegmentationViewer: React.FC<SegmentationViewerProps> = ({
   const [showOverlay, setShowOverlay] = useState(true);
   const [imageLoaded, setImageLoaded] = useState(false);
   const [isLoading, setIsLoading] = useState(true);
+  const [isRefining, setIsRefining] = useState(false);
   const [sliderPosition, setSliderPosition] = useState(50);
   const [detections, setDetections] = useState<Detection[]>([]);
   const [viewMode, setViewMode] = useState<"comparison" | "analysis">(
@@ -27,30 +28,70 @@ export const SegmentationViewer: React.FC<SegmentationViewerProps> = ({
   const [selectedModel, setSelectedModel] = useState<"yolo" | "unet">("yolo");
 
   useEffect(() => {
+    let cancelled = false;
+
+    // UNet answers in two NDJSON lines: a coarse mask within a fraction of the
+    // full pass, then the refined one. Show each as soon as it arrives.
+    const readProgressive = async (response: Response) => {
+      const reader = response.body!.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done || cancelled) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop() ?? "";
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const phase: ProgressivePhase = JSON.parse(line);
+          setDetections(phase.detections || []);
+          setIsLoading(false);
+          setIsRefining(phase.phase === "coarse");
+        }
+      }
+    };
+
     const fetchSegmentation = async () => {
       setIsLoading(true);
+      setIsRefining(false);
       try {
         const response = await fetch(imageUrl);
         const blob = await response.blob();
         const formData = new FormData();
         formData.append("file", blob);
-        formData.append("model", selectedModel);
 
+        if (selectedModel === "unet") {
+          const inferenceResponse = await fetch("http://localhost:8000/inference/progressive", {
+            method: "POST",
+            body: formData,
+          });
+          await readProgressive(inferenceResponse);
+          return;
+        }
+
+        formData.append("model", selectedModel);
         const inferenceResponse = await fetch("http://localhost:8000/inference", {
           method: "POST",
           body: formData,
         });
 
         const data = await inferenceResponse.json();
-        setDetections(data.detections || []);
+        if (!cancelled) setDetections(data.detections || []);
       } catch (error) {
         console.error("API Error:", error);
-        setDetections([]);
+        if (!cancelled) setDetections([]);
       } finally {
-        setIsLoading(false);
+        if (!cancelled) {
+          setIsLoading(false);
+          setIsRefining(false);
+        }
       }
     };
     fetchSegmentation();
+    return () => {
+      cancelled = true;
+    };
   }, [imageUrl, selectedModel]);
 
   useEffect(() => {
@@ -333,6 +374,12 @@ export const SegmentationViewer: React.FC<SegmentationViewerProps> = ({
             <span className="text-3xl font-black">{detections.length}</span>
             <span className="text-sm text-white/60">Objects detected</span>
           </div>
+          {isRefining && (
+            <p className="mt-2 flex items-center gap-2 text-[10px] font-mono uppercase tracking-widest text-white/40">
+              <Loader className="animate-spin" size={12} />
+              Preview, refining...
+            </p>
+          )}
         </div>
 
         <div className="flex-1 overflow-y-auto p-6 space-y-4 custom-scrollbar">
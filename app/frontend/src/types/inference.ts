@@ -3,4 +3,32 @@ export interface Detection {
     conf: number;
     box: [number, number, number, number];
     segments: [number, number][];
-}
\ No newline at end of file
+}
+
+export interface ClassStats {
+    area_px: number;
+    area_fraction: number;
+    components: number;
+}
+
+export interface Lesion {
+    class: string;
+    area_px: number;
+    centroid: [number, number];
+    box: [number, number, number, number];
+    mean_prob?: number;
+}
+
+export interface InferenceStats {
+    image_size: [number, number];
+    classes: Record<string, ClassStats>;
+    lesions: Lesion[];
+}
+
+export interface ProgressivePhase {
+    phase: "coarse" | "final";
+    detections: Detection[];
+    stats?: InferenceStats;
+    variant?: "full" | "reduced";
+    error?: string;
+}
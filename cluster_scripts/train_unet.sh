@@ -2,14 +2,37 @@
 #SBATCH --job-name=train_unet_model
 #SBATCH --partition=gpu_spot
 #SBATCH --gres=gpu:1
+#SBATCH --ntasks-per-node=1
 #SBATCH --cpus-per-task=8
 #SBATCH --time=16:00:00
 #SBATCH --output=unet_train_task-%j.out
 #SBATCH --mail-type=ALL
 #SBATCH --mem=16G
+#SBATCH --requeue
+#SBATCH --signal=USR1@120
 
 module load anaconda
 conda activate nn_train
 cd /projects/onkokul/onkologia-okulistyczna || exit -1
 
-srun python train_model/train_unet.py
\ No newline at end of file
+# Multi-GPU: raise --gres=gpu:N together with --ntasks-per-node=N (and --nodes).
+# srun starts one process per GPU and train_unet.py joins them with DDP;
+# --batch is per GPU.
+export MASTER_ADDR=$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)
+export MASTER_PORT=$((29500 + SLURM_JOB_ID % 1000))
+
+# Preemption (SIGTERM) and the time limit (SIGUSR1, 120 s ahead) make train_unet.py
+# write weights/checkpoint.pth and exit. SLURM requeues preempted jobs itself, but not
+# jobs that hit the time limit: train_unet.py then exits with status 3 and the job
+# requeues itself below.
+# Each attempt writes runs_unet/unet_job<id>_<restart>. An attempt resumes the newest
+# of this job's runs that saved anything, and starts fresh if there is none.
+RUN_PREFIX="unet_job${SLURM_JOB_ID}_"
+srun python train_model/train_unet.py \
+  --run_name "${RUN_PREFIX}${SLURM_RESTART_COUNT:-0}" \
+  --unet_continue_last_run --resume_prefix "$RUN_PREFIX"
+status=$?
+if [ "$status" -eq 3 ]; then
+  scontrol requeue "$SLURM_JOB_ID"
+fi
+exit "$status"
\ No newline at end of file
@@ -0,0 +1,101 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+import unet_utils
+
+
+def activation_bytes(model, criterion, imgs, masks):
+    """Bytes held for backward at the end of one forward pass.
+
+    Counts the tensors autograd saves plus the inputs kept by checkpointed blocks,
+    once per storage and without the weights. This is the part of training memory
+    that grows with batch and image size, and it is the same on any device.
+    """
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    storages = {}
+
+    def keep(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    hooks = [getattr(model, name).register_forward_pre_hook(lambda module, args: keep(args[0]))
+             for name in model.checkpoint_blocks]
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(keep, lambda t: t):
+            loss = criterion(model(imgs), masks)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return sum(storages.values())
+
+
+def bench(args, blocks, imgsz, device):
+    torch.manual_seed(0)
+    model = unet_utils.UNet(3, 2).to(device).train()
+    model.set_activation_checkpointing(unet_utils.parse_checkpoint_blocks(blocks))
+    criterion = nn.BCEWithLogitsLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    scaler = unet_utils.make_grad_scaler(device, args.amp)
+    imgs = torch.rand(args.batch, 3, imgsz, imgsz, device=device)
+    masks = (torch.rand(args.batch, 2, imgsz, imgsz, device=device) > 0.5).float()
+
+    with unet_utils.autocast(device, args.amp):
+        act = activation_bytes(model, criterion, imgs, masks)
+
+    def train_step():
+        with unet_utils.autocast(device, args.amp):
+            loss = criterion(model(imgs), masks)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+
+    train_step()  # allocates the optimizer state
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        train_step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated() if device.type == "cuda" else None
+    return act, peak, args.steps * args.batch / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Activation memory and training throughput of the UNet per activation-checkpointing setting.")
+    parser.add_argument("--imgsz", type=int, nargs="+", default=[512])
+    parser.add_argument("--batch", type=int, default=4,
+                        help="Per-step batch; with --grad_accum, memory depends on this micro-batch only")
+    parser.add_argument("--activation_checkpointing", type=str, nargs="+",
+                        default=["none", "outer", "encoder", "decoder", "all"],
+                        help="Settings to compare, in train_unet.py --activation_checkpointing syntax")
+    parser.add_argument("--amp", type=str, choices=list(unet_utils.AMP_DTYPES), default="off")
+    parser.add_argument("--steps", type=int, default=5, help="Timed training steps per setting")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"device: {device}  batch: {args.batch}  amp: {args.amp}")
+    print(f"{'imgsz':>6}  {'checkpointing':<16}{'act MiB':>10}{'MiB/img':>9}{'peak MiB':>10}{'img/s':>8}{'time':>7}")
+    for imgsz in args.imgsz:
+        baseline = None
+        for blocks in args.activation_checkpointing:
+            act, peak, images_per_s = bench(args, blocks, imgsz, device)
+            baseline = baseline or images_per_s
+            peak = f"{peak / 2**20:>10.0f}" if peak is not None else f"{'-':>10}"
+            print(f"{imgsz:>6}  {blocks:<16}{act / 2**20:>10.0f}{act / 2**20 / args.batch:>9.1f}{peak}"
+                  f"{images_per_s:>8.2f}{baseline / images_per_s:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
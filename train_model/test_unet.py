@@ -1,7 +1,6 @@
 import unet_utils
 import torch
 import os
-from torch.utils.data import DataLoader
 import argparse
 from dotenv import load_dotenv
 import re
@@ -22,20 +21,26 @@ def make_eval_run_name(split: str, model_to_test: str, imgsz: int, batch: int) -
     return f"unet_eval__model{model_tag}__split{split_tag}__img{imgsz}__bs{batch}__{stamp}"
 
 
-def main(split: str, model_to_test: str, batch: int, imgsz: int) -> None:
+def main(split: str, model_to_test: str, batch: int, imgsz: int,
+         workers: int = 4, pin_memory: bool = True, prefetch_factor: int = 2,
+         data_cache: bool = True, cache_dir: str = "Ophthalmic_Scans/.cache",
+         compile: str = "off") -> None:
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
     root_dir = os.path.join("Ophthalmic_Scans")
     test_csv = os.path.join(split, 'test.csv')
-    test_dataset = unet_utils.UNetDataset(test_csv, root_dir, imgsz=imgsz)
-    test_loader = DataLoader(test_dataset, batch_size=batch, shuffle=False)
+    test_dataset = unet_utils.UNetDataset(test_csv, root_dir, imgsz=imgsz,
+                                          cache_dir=cache_dir if data_cache else None)
+    test_loader = unet_utils.build_loader(test_dataset, batch, workers=workers,
+                                          pin_memory=pin_memory and device.type == "cuda",
+                                          prefetch_factor=prefetch_factor)
 
     model = unet_utils.UNet(3, 2)
     model.load_state_dict(torch.load(model_to_test, map_location=device))
     run_name = make_eval_run_name(split=split, model_to_test=model_to_test, imgsz=imgsz, batch=batch)
     print(f"Saving evaluation results to: {os.path.join('runs_unet', run_name)}")
-    model.test_model(test_loader, device=device, run_name=run_name)
+    model.test_model(test_loader, device=device, run_name=run_name, compile=compile)
 
     print("\nModel evaluation complete.")
 
@@ -61,6 +66,10 @@ if __name__ == "__main__":
     parser.add_argument("--batch", type=int, default=default_batch)
     parser.add_argument("--imgsz", type=int, default=512,
                         help="Resize images to this size before inference (must match training imgsz)")
+    parser.add_argument("--compile", type=str, choices=list(unet_utils.COMPILE_MODES),
+                        default=os.getenv('COMPILE', 'off'),
+                        help="torch.compile the UNet (falls back to eager if compilation fails)")
+    unet_utils.add_loader_args(parser, persistent_workers=False)
 
     args = parser.parse_args()
     main(**vars(args))
\ No newline at end of file
@@ -5,10 +5,11 @@ import numpy as np
 import csv
 import json
 import subprocess
-from torch.utils.data import DataLoader
 from utils import get_unique_path
 from dotenv import load_dotenv
 import argparse
+import signal
+import sys
 import torch
 import re
 from pathlib import Path
@@ -25,6 +26,10 @@ def set_seed(seed: int):
 
 load_dotenv(dotenv_path='train_model/.env')
 
+# Exit status after a SIGUSR1 stop (SLURM's warning before the time limit):
+# cluster_scripts/train_unet.sh requeues the job on it.
+REQUEUE_EXIT_CODE = 3
+
 
 def _extract_completed_epochs(run_dir: Path) -> list[int]:
     return [
@@ -34,7 +39,16 @@ def _extract_completed_epochs(run_dir: Path) -> list[int]:
     ]
 
 
+def _checkpoint_epochs_done(path) -> int:
+    return torch.load(path, map_location="cpu", weights_only=False, mmap=True)["epochs_done"]
+
+
 def _checkpoint_and_epoch_for_run(run_dir: Path) -> tuple[str, int] | None:
+    checkpoint = run_dir / "weights" / unet_utils.CHECKPOINT_NAME
+    if checkpoint.exists():
+        # Full state from the middle of an epoch (--checkpoint_every, SIGTERM/SIGUSR1),
+        # newer than any completed epoch of the run.
+        return str(checkpoint), _checkpoint_epochs_done(checkpoint)
     epochs_done = _extract_completed_epochs(run_dir)
     if not epochs_done:
         return None
@@ -45,12 +59,13 @@ def _checkpoint_and_epoch_for_run(run_dir: Path) -> tuple[str, int] | None:
     return str(weights), max_epoch
 
 
-def get_last_run_model() -> tuple[str, int, str]:
+def get_last_run_model(prefix: str = "") -> tuple[str, int, str]:
     """Find the latest resumable checkpoint in runs_unet based on mtime.
 
     Iterates over run directories from newest to oldest and returns
     the path to last.pth and the highest completed epoch number for the
     first run that has both a completed epoch directory and a checkpoint.
+    Only runs whose name starts with `prefix` are considered.
 
     Returns:
         (weights_path, trained_epochs, run_name): checkpoint path, epoch count and run folder name.
@@ -63,12 +78,13 @@ def get_last_run_model() -> tuple[str, int, str]:
         raise FileNotFoundError("No runs_unet directory found — nothing to resume.")
 
     runs = sorted(
-        [p for p in unet_runs.iterdir() if p.is_dir() and not p.name.startswith(("test_run", "unet_eval"))],
+        [p for p in unet_runs.iterdir()
+         if p.is_dir() and p.name.startswith(prefix) and not p.name.startswith(("test_run", "unet_eval"))],
         key=lambda p: p.stat().st_mtime,
         reverse=True,
     )
     if not runs:
-        raise FileNotFoundError("No runs_unet/* directories found — nothing to resume.")
+        raise FileNotFoundError(f"No runs_unet/{prefix}* directories found — nothing to resume.")
     for run_dir in runs:
         result = _checkpoint_and_epoch_for_run(run_dir)
         if result is not None:
@@ -95,6 +111,18 @@ def get_run_model_by_name(run_name: str) -> tuple[str, int, str]:
     return weights, max_epoch, run_name
 
 
+def load_resume_weights(model, path: str, device) -> str | None:
+    """Load weights to resume from; returns `path` when it is a full mid-epoch checkpoint.
+
+    The model, optimizer and position of a full checkpoint are restored by
+    train_model itself.
+    """
+    if Path(path).name == unet_utils.CHECKPOINT_NAME:
+        return path
+    model.load_state_dict(torch.load(path, map_location=device))
+    return None
+
+
 def infer_approach(encoder_weights: str | None, freeze_encoder: bool) -> str:
     if encoder_weights and freeze_encoder:
         return "transfer_freeze"
@@ -136,24 +164,45 @@ def append_experiment_index(row: dict):
 
 
 def main(train_csv, val_csv, save_path=None, epochs=50, imgsz=512, batch=16,
-         unet_continue_last_run=False, seed=42, encoder_weights=None,
+         unet_continue_last_run=False, resume_prefix="", seed=42, encoder_weights=None,
         freeze_encoder=False, run_name=None, resume_from=None,
-        resume_run_name=None, approach=None):
+        resume_run_name=None, approach=None, amp="off", workers=4, pin_memory=True,
+        persistent_workers=True, prefetch_factor=2, data_cache=True,
+        cache_dir="Ophthalmic_Scans/.cache", log_every=50, profile_steps=0, checkpoint_every=500,
+        compile="off", activation_checkpointing="none", grad_accum=1):
     set_seed(seed)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device} | seed: {seed}")
+    # One process per GPU under torchrun or `srun` with several tasks; `batch` is per process.
+    rank, world_size, device = unet_utils.init_distributed()
+    distributed = world_size > 1
+    print(f"Using device: {device} | seed: {seed}"
+          + (f" | rank {rank}/{world_size}" if distributed else ""))
 
     started_at = datetime.now(timezone.utc)
     approach = approach or infer_approach(encoder_weights, freeze_encoder)
     run_name = run_name or make_run_name(approach, seed, imgsz, batch, started_at)
 
     root_dir = os.path.join("Ophthalmic_Scans")
-    train_dataset = unet_utils.UNetDataset(train_csv, root_dir, imgsz=imgsz)
-    val_dataset = unet_utils.UNetDataset(val_csv, root_dir, imgsz=imgsz)
-
-    train_loader = DataLoader(train_dataset, batch_size=batch, shuffle=True)
-    val_loader = DataLoader(val_dataset,   batch_size=batch, shuffle=False)
+    cache_dir = cache_dir if data_cache else None
+    with unet_utils.main_process_first():
+        train_dataset = unet_utils.UNetDataset(train_csv, root_dir, imgsz=imgsz, cache_dir=cache_dir)
+        val_dataset = unet_utils.UNetDataset(val_csv, root_dir, imgsz=imgsz, cache_dir=cache_dir)
+
+    # Shuffling and worker seeds come from `seed`, so set_seed() reproducibility
+    # holds with any number of workers.
+    loader_args = dict(workers=workers, pin_memory=pin_memory and device.type == "cuda",
+                       persistent_workers=persistent_workers, prefetch_factor=prefetch_factor,
+                       distributed=distributed)
+    train_loader = unet_utils.build_loader(train_dataset, batch, shuffle=True, seed=seed, **loader_args)
+    val_loader = unet_utils.build_loader(val_dataset, batch, shuffle=False, seed=seed, **loader_args)
     model = unet_utils.UNet(3, 2)
+    checkpoint_blocks = unet_utils.parse_checkpoint_blocks(activation_checkpointing)
+    model.set_activation_checkpointing(checkpoint_blocks)
+    if grad_accum < 1:
+        raise ValueError("--grad_accum must be >= 1")
+    effective_batch = batch * world_size * grad_accum
+    if checkpoint_blocks or grad_accum > 1:
+        print(f"[INFO] Activation checkpointing: {', '.join(checkpoint_blocks) or 'off'} | "
+              f"effective batch: {batch} x {world_size} process(es) x {grad_accum} accumulation steps = {effective_batch}")
 
     if encoder_weights:
         state = torch.load(encoder_weights, map_location="cpu", weights_only=True)
@@ -172,32 +221,60 @@ def main(train_csv, val_csv, save_path=None, epochs=50, imgsz=512, batch=16,
     trained_epochs = 0
     resume_mode = "none"
     resume_source = ""
+    resume_weights = None
+    resume_checkpoint = None
 
     if resume_from:
         resume_mode = "resume_from"
         resume_source = resume_from
         print(f"Resuming from explicit checkpoint path: {resume_from}")
-        model.load_state_dict(torch.load(resume_from, map_location=device))
+        resume_checkpoint = load_resume_weights(model, resume_from, device)
+        resume_weights = resume_from
+        if resume_checkpoint:
+            trained_epochs = _checkpoint_epochs_done(resume_checkpoint)
+            epochs = epochs - trained_epochs
     elif resume_run_name:
         resume_mode = "resume_run_name"
         last_weights, trained_epochs, resumed_run_name = get_run_model_by_name(resume_run_name)
         resume_source = f"{resumed_run_name}:{last_weights}"
         print(f"Resuming from epoch {trained_epochs + 1} (checkpoint: {last_weights})")
-        model.load_state_dict(torch.load(last_weights, map_location=device))
+        resume_checkpoint = load_resume_weights(model, last_weights, device)
+        resume_weights = last_weights
         epochs = epochs - trained_epochs
     elif unet_continue_last_run:
-        resume_mode = "continue_last_run"
         print("Resuming training from latest checkpoint...")
-        last_weights, trained_epochs, resumed_run_name = get_last_run_model()
-        resume_source = f"{resumed_run_name}:{last_weights}"
-        print(f"Resuming from epoch {trained_epochs + 1} (checkpoint: {last_weights})")
-        model.load_state_dict(torch.load(last_weights, map_location=device))
-        epochs = epochs - trained_epochs
+        try:
+            last_weights, trained_epochs, resumed_run_name = get_last_run_model(resume_prefix)
+        except FileNotFoundError as e:
+            # With a prefix (one SLURM job's attempts) nothing saved yet means the
+            # previous attempt was stopped before its first checkpoint.
+            if not resume_prefix:
+                raise
+            print(f"[INFO] {e} Starting a new run.")
+        else:
+            resume_mode = "continue_last_run"
+            resume_source = f"{resumed_run_name}:{last_weights}"
+            print(f"Resuming from epoch {trained_epochs + 1} (checkpoint: {last_weights})")
+            resume_checkpoint = load_resume_weights(model, last_weights, device)
+            resume_weights = last_weights
+            epochs = epochs - trained_epochs
 
     if epochs <= 0:
         print("No remaining epochs to train — target already reached.")
         return
 
+    # Optimizer/scaler state saved next to last.pth (absent for older runs). It belongs
+    # to the step of last.pth only: best*.pth from an earlier epoch start a fresh
+    # optimizer (one saved in the last epoch is a hardlink to last.pth).
+    resume_state = None
+    if resume_weights and not resume_checkpoint:
+        state_path = Path(resume_weights).with_name("last_state.pth")
+        last_path = state_path.with_name("last.pth")
+        if state_path.exists() and last_path.exists() and os.path.samefile(resume_weights, last_path):
+            resume_state = str(state_path)
+        elif state_path.exists():
+            print(f"[INFO] Not restoring {state_path}: it belongs to last.pth, not {resume_weights}")
+
     run_meta = {
         "run_name": run_name,
         "approach": approach,
@@ -210,6 +287,13 @@ def main(train_csv, val_csv, save_path=None, epochs=50, imgsz=512, batch=16,
         "batch": batch,
         "freeze_encoder": freeze_encoder,
         "encoder_weights": encoder_weights,
+        "amp": amp,
+        "compile": compile,
+        "activation_checkpointing": list(checkpoint_blocks),
+        "grad_accum": grad_accum,
+        "effective_batch": effective_batch,
+        "workers": workers,
+        "world_size": world_size,
         "resume_mode": resume_mode,
         "resume_source": resume_source,
         "save_path_requested": save_path,
@@ -226,7 +310,24 @@ def main(train_csv, val_csv, save_path=None, epochs=50, imgsz=512, batch=16,
         freeze_encoder=freeze_encoder,
         run_name=run_name,
         run_meta=run_meta,
+        amp=amp,
+        resume_state=resume_state,
+        log_every=log_every,
+        profile_steps=profile_steps,
+        checkpoint_every=checkpoint_every,
+        resume_checkpoint=resume_checkpoint,
+        epoch_offset=trained_epochs,
+        compile=compile,
+        grad_accum=grad_accum,
     )
+    if train_result["interrupted"] and unet_utils.is_main_process():
+        print(f"\nTraining interrupted; continue with --resume_run_name {Path(train_result['run_dir']).name}")
+    if train_result["interrupted"] or not unet_utils.is_main_process():
+        if distributed:
+            torch.distributed.destroy_process_group()
+        if train_result["stop_signal"] == signal.SIGUSR1:
+            sys.exit(REQUEUE_EXIT_CODE)
+        return
     weights_dir = train_result["weights_dir"]
     run_dir = train_result["run_dir"]
 
@@ -281,6 +382,8 @@ def main(train_csv, val_csv, save_path=None, epochs=50, imgsz=512, batch=16,
         "git_commit": run_meta["git_commit"],
         "slurm_job_id": run_meta["slurm_job_id"],
     })
+    if distributed:
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == "__main__":
@@ -311,6 +414,9 @@ if __name__ == "__main__":
         default=_env_continue == 'true',
         help="Resume training from the latest checkpoint (set UNET_CONTINUE_LAST_RUN=true to enable via .env)"
     )
+    parser.add_argument("--resume_prefix", type=str, default="",
+                        help="With --unet_continue_last_run: only resume runs whose name starts with this prefix, "
+                             "and start a new run when none of them is resumable")
     parser.add_argument("--save_path", type=str, default=None,
                         help="Optional model save path")
     parser.add_argument("--epochs", type=int, default=default_epochs)
@@ -332,6 +438,36 @@ if __name__ == "__main__":
         action="store_true",
         help="Freeze encoder blocks conv1-conv5 during segmentation training"
     )
+    parser.add_argument(
+        "--amp",
+        type=str,
+        choices=list(unet_utils.AMP_DTYPES),
+        default=os.getenv('AMP', 'off'),
+        help="Mixed precision for training and validation: off (fp32), fp16 (with loss scaling) or bf16"
+    )
+    parser.add_argument(
+        "--compile",
+        type=str,
+        choices=list(unet_utils.COMPILE_MODES),
+        default=os.getenv('COMPILE', 'off'),
+        help="torch.compile the UNet for training and validation (falls back to eager if compilation fails)"
+    )
+    parser.add_argument(
+        "--activation_checkpointing",
+        type=str,
+        default=os.getenv('ACTIVATION_CHECKPOINTING', 'none'),
+        help="double_conv blocks to recompute in backward instead of storing their activations: comma-separated "
+             "names (conv1-conv5, uconv1-uconv4) and/or groups: none, all, encoder, decoder, outer"
+    )
+    parser.add_argument("--grad_accum", type=int, default=int(os.getenv('GRAD_ACCUM', '1')),
+                        help="Batches whose gradients are accumulated per optimizer step (effective batch = batch x processes x grad_accum)")
+    parser.add_argument("--log_every", type=int, default=int(os.getenv('LOG_EVERY', '50')),
+                        help="Training steps between loss readouts (progress bar, TensorBoard Loss/train_step); 0 = epoch end only")
+    parser.add_argument("--checkpoint_every", type=int, default=int(os.getenv('CHECKPOINT_EVERY', '500')),
+                        help="Training steps between full mid-epoch checkpoints (weights/checkpoint.pth); 0 = only on SIGTERM/SIGUSR1")
+    parser.add_argument("--profile_steps", type=int, default=0,
+                        help="Record a torch.profiler trace of this many training steps in the first epoch (runs_unet/<run>/profiler)")
+    unet_utils.add_loader_args(parser)
 
     args = parser.parse_args()
     main(**vars(args))
@@ -23,6 +23,8 @@ TensorBoard:
 import argparse
 import json
 import random
+import time
+from contextlib import nullcontext
 from pathlib import Path
 
 import numpy as np
@@ -49,6 +51,16 @@ def set_seed(seed: int) -> None:
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
+AMP_DTYPES = {"off": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def autocast(device: torch.device, amp: str = "off"):
+    """Autocast context for forward passes (same as unet_utils.autocast)."""
+    if AMP_DTYPES[amp] is None:
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[amp])
+
+
 def build_metrics(device: torch.device):
     acc = MulticlassAccuracy(num_classes=NUM_CLASSES, average="macro").to(device)
     f1  = MulticlassF1Score(num_classes=NUM_CLASSES,  average="macro").to(device)
@@ -60,12 +72,21 @@ def build_metrics(device: torch.device):
 # ---------------------------------------------------------------------------
 
 def run_epoch(model, loader, criterion, optimizer, device,
-              acc_fn, f1_fn, is_train: bool):
+              acc_fn, f1_fn, is_train: bool,
+              scaler=None, amp: str = "off"):
+    """
+    One pass over loader. With amp="fp16" a GradScaler must be given for training.
+
+    Returns:
+        (loss, accuracy, f1, images_per_s)
+    """
     model.train() if is_train else model.eval()
     total_loss = 0.0
+    n_images   = 0
     acc_fn.reset()
     f1_fn.reset()
 
+    start = time.perf_counter()
     ctx = torch.enable_grad() if is_train else torch.no_grad()
     with ctx:
         for imgs, labels in tqdm(loader, leave=False,
@@ -73,23 +94,33 @@ def run_epoch(model, loader, criterion, optimizer, device,
             imgs   = imgs.to(device)
             labels = labels.to(device)
 
-            logits = model(imgs)
-            loss   = criterion(logits, labels)
+            with autocast(device, amp):
+                logits = model(imgs)
+                loss   = criterion(logits, labels)
 
             if is_train:
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                if scaler is not None:
+                    scaler.scale(loss).backward()
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    loss.backward()
+                    optimizer.step()
 
             total_loss += loss.item()
+            n_images   += imgs.size(0)
             preds = logits.argmax(dim=1)
             acc_fn.update(preds, labels)
             f1_fn.update(preds, labels)
 
+    if device.type == "cuda":
+        torch.cuda.synchronize()
     return (
         total_loss / len(loader),
         acc_fn.compute().item(),
         f1_fn.compute().item(),
+        n_images / (time.perf_counter() - start),
     )
 
 
@@ -109,11 +140,13 @@ def train(
     output_dir:     str   = "./runs_kermany",
     val_split:      float = 0.1,
     seed:           int   = 42,
+    amp:            str   = "off",
 ):
     set_seed(seed)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[INFO] Device: {device}")
     print(f"[INFO] Seed: {seed}")
+    print(f"[INFO] Mixed precision: {amp}")
 
     # DataLoaders (test loader not needed here – evaluation is done in eval_kermany.py)
     train_loader, val_loader, _ = build_dataloaders(
@@ -131,6 +164,8 @@ def train(
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=lr,
                                  weight_decay=weight_decay)
+    # Loss scaling is only needed for fp16; bf16 has the exponent range of fp32.
+    scaler = torch.amp.GradScaler(device.type, enabled=amp == "fp16")
 
     # Metrics
     train_acc, train_f1 = build_metrics(device)
@@ -148,26 +183,28 @@ def train(
     for epoch in range(1, epochs + 1):
         print(f"\n--- Epoch {epoch}/{epochs} ---")
 
-        tr_loss, tr_acc, tr_f1 = run_epoch(
+        tr_loss, tr_acc, tr_f1, tr_ips = run_epoch(
             model, train_loader, criterion, optimizer, device,
-            train_acc, train_f1, is_train=True,
+            train_acc, train_f1, is_train=True, scaler=scaler, amp=amp,
         )
-        vl_loss, vl_acc, vl_f1 = run_epoch(
+        vl_loss, vl_acc, vl_f1, vl_ips = run_epoch(
             model, val_loader, criterion, None, device,
-            val_acc, val_f1, is_train=False,
+            val_acc, val_f1, is_train=False, amp=amp,
         )
 
-        print(f"  Train  loss={tr_loss:.4f}  acc={tr_acc:.4f}  F1={tr_f1:.4f}")
-        print(f"  Val    loss={vl_loss:.4f}  acc={vl_acc:.4f}  F1={vl_f1:.4f}")
+        print(f"  Train  loss={tr_loss:.4f}  acc={tr_acc:.4f}  F1={tr_f1:.4f}  {tr_ips:.1f} img/s")
+        print(f"  Val    loss={vl_loss:.4f}  acc={vl_acc:.4f}  F1={vl_f1:.4f}  {vl_ips:.1f} img/s")
 
         writer.add_scalars("loss",     {"train": tr_loss, "val": vl_loss}, epoch)
         writer.add_scalars("accuracy", {"train": tr_acc,  "val": vl_acc},  epoch)
         writer.add_scalars("f1_macro", {"train": tr_f1,   "val": vl_f1},   epoch)
+        writer.add_scalars("images_per_s", {"train": tr_ips, "val": vl_ips}, epoch)
 
         history.append(dict(
             epoch=epoch,
             train_loss=tr_loss, train_acc=tr_acc, train_f1=tr_f1,
             val_loss=vl_loss,   val_acc=vl_acc,   val_f1=vl_f1,
+            train_images_per_s=tr_ips, val_images_per_s=vl_ips,
         ))
 
         # Early stopping + save encoder checkpoint only
@@ -216,6 +253,8 @@ def parse_args():
     p.add_argument("--val_split",    type=float, default=0.1)
     p.add_argument("--seed",         type=int,   default=42,
                    help="Random seed for reproducible split, shuffling and augmentation")
+    p.add_argument("--amp",          choices=list(AMP_DTYPES), default="off",
+                   help="Mixed precision: off (fp32), fp16 (with loss scaling) or bf16")
     return p.parse_args()
 
 
@@ -234,4 +273,5 @@ if __name__ == "__main__":
         output_dir     = args.output_dir,
         val_split      = args.val_split,
         seed           = args.seed,
+        amp            = args.amp,
     )
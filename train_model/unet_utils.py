@@ -1,17 +1,147 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset
+import torch.distributed as dist
+import torch.utils.checkpoint
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, DistributedSampler, Sampler
 import torchvision.transforms as T
 import os
+import random
 import pandas as pd
 from PIL import Image
 import numpy as np
 import json
+import hashlib
+import time
+import argparse
+import signal
+import queue
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager, nullcontext
 from tqdm import tqdm
-from torchmetrics import ConfusionMatrix
 from torch.utils.tensorboard import SummaryWriter
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+AMP_DTYPES = {"off": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+# Full training state for mid-epoch resume, next to last.pth.
+CHECKPOINT_NAME = "checkpoint.pth"
+# Best weights per metric, in the order of the checkpoint's "best" scores.
+BEST_WEIGHTS = ("best.pth", "best_tumor.pth", "best_fluid.pth")
+# Signals that request a checkpoint and a clean exit: SIGTERM on preemption,
+# SIGUSR1 from `#SBATCH --signal=USR1@<seconds>` before the time limit.
+CHECKPOINT_SIGNALS = tuple(getattr(signal, name) for name in ("SIGTERM", "SIGUSR1") if hasattr(signal, name))
+# Under DDP the ranks agree on stopping every this many steps (one small all-reduce).
+SIGNAL_POLL_STEPS = 10
+
+
+def autocast(device, amp="off"):
+    """Autocast context for forward passes; amp="off" keeps everything in fp32."""
+    if AMP_DTYPES[amp] is None:
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES[amp])
+
+
+COMPILE_MODES = ("off", "default", "reduce-overhead", "max-autotune")
+
+
+def compile_with_warmup(model, mode, warmup, what="UNet"):
+    """torch.compile `model` and compile it up front by running `warmup(compiled)`.
+
+    Returns the eager model if compilation fails (unsupported platform, missing
+    compiler toolchain, ...), so a --compile run never dies on it.
+    """
+    if mode == "off":
+        return model
+    start = time.perf_counter()
+    try:
+        # Shapes are fixed by --imgsz and the batch size; warm-up covers the
+        # full and the last partial batch, so nothing recompiles mid-epoch.
+        compiled = torch.compile(model, mode=mode, dynamic=False)
+        warmup(compiled)
+    except Exception as e:
+        torch._dynamo.reset()
+        print(f"[WARN] torch.compile(mode={mode}) failed for the {what}, running eagerly: {e}")
+        return model
+    print(f"[INFO] Compiled the {what} (mode={mode}) in {time.perf_counter() - start:.1f} s")
+    return compiled
+
+
+def warmup_shapes(loader):
+    """Input shapes `loader` produces: full batches and the last partial one."""
+    sample_shape = tuple(loader.dataset[0][0].shape)
+    n, batch = len(loader.sampler), loader.batch_size
+    sizes = {min(batch, n)} | ({n % batch} if n % batch else set())
+    return [(size, *sample_shape) for size in sorted(sizes)]
+
+
+def make_grad_scaler(device, amp="off"):
+    """Loss scaling is only needed for fp16; bf16 has the exponent range of fp32."""
+    return torch.amp.GradScaler(device.type, enabled=amp == "fp16")
+
+
+def init_distributed():
+    """Join the process group when started by torchrun or as one of several SLURM tasks.
+
+    Returns (rank, world_size, device). A single process returns (0, 1, device)
+    without creating a group. NCCL is used with GPUs and gloo otherwise, so the
+    distributed path also runs on CPU-only machines.
+    """
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        rank = int(os.environ["RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+        local_rank = int(os.getenv("LOCAL_RANK", "0"))
+    elif int(os.getenv("SLURM_NTASKS", "1")) > 1:
+        rank = int(os.environ["SLURM_PROCID"])
+        world_size = int(os.environ["SLURM_NTASKS"])
+        local_rank = int(os.getenv("SLURM_LOCALID", "0"))
+        # Multi-node jobs export MASTER_ADDR in the sbatch script.
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+    else:
+        rank, world_size, local_rank = 0, 1, 0
+
+    if torch.cuda.is_available():
+        # With one GPU per task, SLURM already narrows CUDA_VISIBLE_DEVICES down to it.
+        device = torch.device("cuda", local_rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+        backend = "nccl"
+    else:
+        device = torch.device("cpu")
+        backend = "gloo"
+
+    if world_size > 1:
+        dist.init_process_group(backend, init_method="env://", rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    if dist.is_initialized():
+        dist.all_reduce(tensor)
+    return tensor
+
+
+@contextmanager
+def main_process_first():
+    """Rank 0 runs the block first (e.g. building the dataset cache), the others after it."""
+    if dist.is_initialized() and not is_main_process():
+        dist.barrier()
+    yield
+    if dist.is_initialized() and is_main_process():
+        dist.barrier()
+
 
 def metrics_from_confusion_matrix(cm):
     tn, fp = cm[0]
@@ -39,17 +169,56 @@ def metrics_from_confusion_matrix(cm):
     }
 
 
-def get_confusion_matrices(masks: torch.Tensor, preds: torch.Tensor):
-    device = masks.device
-    preds_fluid = preds[:, 0, :, :]
-    preds_tumor = preds[:, 1, :, :]
-    masks_fluid = masks[:, 0, :, :]
-    masks_tumor = masks[:, 1, :, :]
+class ConfusionAccumulator:
+    """Streaming binary confusion matrices for each class and threshold.
+
+    Counts stay on the device of the predictions and are summed per batch
+    without any host sync; compute() copies them to the host once. Matrices use
+    the [[TN, FP], [FN, TP]] layout expected by metrics_from_confusion_matrix.
+    """
+
+    def __init__(self, num_classes, thresholds=(0.5,), device=None):
+        self.num_classes = num_classes
+        self.thresholds = torch.as_tensor(thresholds, dtype=torch.float32, device=device)
+        shape = (len(self.thresholds), num_classes)
+        self.tp = torch.zeros(shape, dtype=torch.int64, device=device)
+        self.pred_pos = torch.zeros(shape, dtype=torch.int64, device=device)
+        self.pos = torch.zeros(num_classes, dtype=torch.int64, device=device)
+        self.total = 0
+
+    def update(self, probs: torch.Tensor, masks: torch.Tensor):
+        # probs and masks are [B, C, ...]; a pixel is positive where probs > threshold.
+        target = masks > 0.5
+        pred = probs.unsqueeze(0) > self.thresholds.view(-1, *([1] * probs.dim()))
+        dims = [1] + list(range(3, pred.dim()))
+        self.tp += (pred & target).sum(dim=dims)
+        self.pred_pos += pred.sum(dim=dims)
+        self.pos += target.sum(dim=[0] + list(range(2, target.dim())))
+        self.total += target[:, 0].numel()
+
+    def all_reduce(self):
+        """Sum the counts over all ranks (no-op without a process group)."""
+        if not dist.is_initialized():
+            return
+        total = torch.tensor(self.total, dtype=torch.int64, device=self.tp.device)
+        for t in (self.tp, self.pred_pos, self.pos, total):
+            dist.all_reduce(t)
+        self.total = int(total.item())
+
+    def compute(self):
+        """Confusion matrices as an int64 array of shape [thresholds, classes, 2, 2]."""
+        tp, pred_pos, pos = (t.cpu().numpy() for t in (self.tp, self.pred_pos, self.pos))
+        fp = pred_pos - tp
+        fn = pos - tp
+        tn = self.total - tp - fp - fn
+        return np.stack([np.stack([tn, fp], axis=-1), np.stack([fn, tp], axis=-1)], axis=-2)
 
-    cm = ConfusionMatrix(task="binary", num_classes=2).to(device)
-    fluid_cm = cm(preds_fluid, masks_fluid)
-    tumor_cm = cm(preds_tumor, masks_tumor)
-    return np.array(fluid_cm.cpu()), np.array(tumor_cm.cpu())
+
+def get_confusion_matrices(masks: torch.Tensor, preds: torch.Tensor):
+    cm = ConfusionAccumulator(num_classes=2, device=masks.device)
+    cm.update(preds, masks)
+    fluid_cm, tumor_cm = cm.compute()[0]
+    return fluid_cm, tumor_cm
 
 
 def get_metrics(masks: torch.Tensor, preds: torch.Tensor):
@@ -59,23 +228,385 @@ def get_metrics(masks: torch.Tensor, preds: torch.Tensor):
     return fluid_metrics, fluid_cm, tumor_metrics, tumor_cm
 
 
+def seed_worker(worker_id):
+    """Seed Python and NumPy in a DataLoader worker from its torch seed.
+
+    The torch seed of each worker is derived from the loader's generator, so
+    runs with the same --seed see the same random streams in every worker.
+    """
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+class ResumableSampler(DistributedSampler):
+    """Shuffling sampler whose order depends only on (seed, epoch).
+
+    Also used by a single process (one replica). set_start() makes the next
+    epoch begin part-way through, which is how a mid-epoch checkpoint resumes
+    on exactly the samples that were not trained on yet.
+    """
+
+    def __init__(self, dataset, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.start_index = 0
+
+    def set_start(self, index):
+        self.start_index = index
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def __iter__(self):
+        indices = list(super().__iter__())[self.start_index:]
+        self.start_index = 0
+        return iter(indices)
+
+
+def capture_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _snapshot(obj):
+    # Host copies of every tensor in a (nested) state dict. CUDA tensors are copied
+    # asynchronously into pinned memory; the caller records an event to wait on.
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == "cuda":
+            host = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return host.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+def _fsync_dir(path):
+    # Makes a rename durable; directories cannot be opened like this on Windows.
+    if os.name != "posix":
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CheckpointWriter:
+    """Writes checkpoints and run JSONs on a background thread.
+
+    save() only snapshots the tensors to host memory, so training continues
+    while the files are written, fsynced and atomically renamed into place
+    (an interrupted write leaves the previous file intact). Tasks run in
+    submission order; at most `max_pending` snapshots are held in memory.
+    """
+
+    def __init__(self, max_pending=2):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, obj, *paths):
+        """Write `obj` to the first path and hardlink the others to it."""
+        self._check()
+        snapshot = _snapshot(obj)
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self._queue.put((self._write, (snapshot, paths, event)))
+
+    def save_json(self, data, path):
+        self._check()
+        self._queue.put((self._write_json, (json.dumps(data, indent=2), path)))
+
+    def remove(self, path):
+        self._check()
+        self._queue.put((self._remove, (path,)))
+
+    def flush(self):
+        """Block until everything submitted so far is on disk."""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args = task
+                fn(*args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(snapshot, paths, event):
+        if event is not None:
+            event.synchronize()
+        first = paths[0]
+        tmp = first + ".tmp"
+        with open(tmp, "wb") as f:
+            torch.save(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, first)
+        for path in paths[1:]:
+            # Identical weights (e.g. last.pth and best.pth of the same epoch) share
+            # one file on disk.
+            tmp = path + ".tmp"
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            try:
+                os.link(first, tmp)
+            except OSError:
+                shutil.copyfile(first, tmp)
+            os.replace(tmp, path)
+        _fsync_dir(os.path.dirname(first))
+
+    @staticmethod
+    def _write_json(text, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def carry_over_best_weights(src_dir, dst_dir, scores):
+    """Link a resumed run's best*.pth into the new run's weights directory.
+
+    Returns the scores to continue from. A score whose file is missing is reset,
+    so the next epoch writes that file again. Pass dst_dir=None to only check
+    (ranks other than 0).
+    """
+    kept = []
+    for name, score in zip(BEST_WEIGHTS, scores):
+        src = os.path.join(src_dir, name)
+        if not os.path.exists(src):
+            kept.append(-1.0)
+            continue
+        dst = None if dst_dir is None else os.path.join(dst_dir, name)
+        if dst is not None and not (os.path.exists(dst) and os.path.samefile(src, dst)):
+            tmp = dst + ".tmp"
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        kept.append(score)
+    return tuple(kept)
+
+
+def load_checkpoint(path, device):
+    # Our own files; they hold RNG states, which weights_only loading rejects.
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+class ShardSampler(Sampler):
+    """This rank's share of the dataset, in order.
+
+    Unlike DistributedSampler it does not pad the shards to equal length, so
+    evaluation metrics summed over ranks count every sample exactly once.
+    """
+
+    def __init__(self, dataset):
+        self.indices = range(dist.get_rank(), len(dataset), dist.get_world_size())
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+
+def build_loader(dataset, batch_size, shuffle=False, seed=None, workers=0,
+                 pin_memory=False, persistent_workers=False, prefetch_factor=2,
+                 distributed=False):
+    """DataLoader with decoding in `workers` processes and seeded shuffling/workers.
+
+    Shuffled loaders use a ResumableSampler (reshuffled every epoch by
+    train_model). With `distributed`, each rank loads its own shard of it, or a
+    ShardSampler when not shuffling.
+    """
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    sampler = None
+    distributed = distributed and dist.is_initialized()
+    if shuffle:
+        replicas = dict(num_replicas=1, rank=0) if not distributed else {}
+        sampler = ResumableSampler(dataset, shuffle=True, seed=seed or 0, **replicas)
+        shuffle = False
+    elif distributed:
+        sampler = ShardSampler(dataset)
+    extra = {}
+    if workers > 0:
+        # Both options are rejected by DataLoader when loading in the main process.
+        extra = {"persistent_workers": persistent_workers, "prefetch_factor": prefetch_factor}
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        sampler=sampler,
+        num_workers=workers,
+        pin_memory=pin_memory,
+        worker_init_fn=seed_worker,
+        generator=generator,
+        **extra,
+    )
+
+
+def add_loader_args(parser, persistent_workers=True):
+    """DataLoader and dataset cache options shared by train_unet.py and test_unet.py (overridable from .env)."""
+    def env_flag(name, default):
+        return os.getenv(name, default).strip().lower() == "true"
+
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "4")),
+                        help="DataLoader worker processes for decoding/resizing (0 = main process)")
+    parser.add_argument("--pin_memory", action=argparse.BooleanOptionalAction,
+                        default=env_flag("PIN_MEMORY", "true"),
+                        help="Page-locked host batches, needed for asynchronous copies to the GPU")
+    parser.add_argument("--prefetch_factor", type=int, default=int(os.getenv("PREFETCH_FACTOR", "2")),
+                        help="Batches loaded ahead by each worker")
+    parser.add_argument("--data_cache", action=argparse.BooleanOptionalAction,
+                        default=env_flag("DATA_CACHE", "true"),
+                        help="Decode and resize each split once into memory-mapped arrays under --cache_dir")
+    parser.add_argument("--cache_dir", type=str, default=os.getenv("DATA_CACHE_DIR", "Ophthalmic_Scans/.cache"),
+                        help="Directory for the preprocessed dataset cache")
+    if persistent_workers:
+        parser.add_argument("--persistent_workers", action=argparse.BooleanOptionalAction,
+                            default=env_flag("PERSISTENT_WORKERS", "true"),
+                            help="Keep workers alive between epochs instead of re-forking them")
+
+
+class DevicePrefetcher:
+    """Iterates a DataLoader and yields its batches on `device`.
+
+    On CUDA the copy of the next batch is issued on a side stream with
+    non_blocking=True while the current batch is being processed, so it
+    overlaps with compute (fully only when the loader pins memory).
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.loader:
+                yield tuple(t.to(self.device) for t in batch)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        it = iter(self.loader)
+
+        def preload():
+            batch = next(it, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+        nxt = preload()
+        while nxt is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = nxt
+            for t in batch:
+                # The tensors were allocated on the side stream but are used on this one.
+                t.record_stream(current)
+            nxt = preload()
+            yield batch
+
+
+CACHE_VERSION = 1
+
+
+def _source_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
 class UNetDataset(Dataset):
-    def __init__(self, csv_path, root_dir="", transforms=None, imgsz=None):
+    """Image and (fluid, tumor) mask pairs listed in a split CSV.
+
+    With `cache_dir` and `imgsz` set, the resized samples are decoded once into
+    memory-mapped .npy files (images uint8 [N,H,W,3], masks uint8 [N,2,H,W]) under
+    cache_dir/<csv name>-<hash>-<imgsz>/. A manifest with the size and mtime of
+    every source file decides whether the cache is still valid; otherwise it is
+    rebuilt. DataLoader workers then read the same pages instead of decoding PNGs.
+    """
+
+    def __init__(self, csv_path, root_dir="", transforms=None, imgsz=None, cache_dir=None):
         self.data = pd.read_csv(csv_path)
         self.root_dir = root_dir
         self.transforms = transforms
         self.imgsz = imgsz
         self.to_tensor = T.ToTensor()
+        self.cache_path = None
+        self._images = None
+        self._masks = None
+        if cache_dir and imgsz:
+            self.cache_path = self._prepare_cache(csv_path, cache_dir)
 
     def __len__(self):
         return len(self.data)
 
-    def __getitem__(self, idx):
+    def __getstate__(self):
+        # Workers started with "spawn" (Windows) reopen the memory maps instead of
+        # receiving a pickled copy of the arrays.
+        state = self.__dict__.copy()
+        state["_images"] = state["_masks"] = None
+        return state
+
+    def _paths(self, idx):
         row = self.data.iloc[idx]
+        return tuple(os.path.join(self.root_dir, row[c])
+                     for c in ("image_path", "fluid_mask_path", "tumor_mask_path"))
 
-        img_path = os.path.join(self.root_dir, row["image_path"])
-        tumor_mask_path = os.path.join(self.root_dir, row["tumor_mask_path"])
-        fluid_mask_path = os.path.join(self.root_dir, row["fluid_mask_path"])
+    def _load(self, idx):
+        img_path, fluid_mask_path, tumor_mask_path = self._paths(idx)
 
         img = Image.open(img_path).convert("RGB")
 
@@ -88,23 +619,135 @@ class UNetDataset(Dataset):
             tumor_mask = tumor_mask.resize((self.imgsz, self.imgsz), Image.NEAREST)
             fluid_mask = fluid_mask.resize((self.imgsz, self.imgsz), Image.NEAREST)
 
+        return img, np.stack([np.asarray(fluid_mask), np.asarray(tumor_mask)], axis=0)
+
+    @staticmethod
+    @contextmanager
+    def _build_lock(path):
+        # Jobs started together on the same split (e.g. one per seed) share the
+        # cache: the first builds it, the others wait here and then reuse it.
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(path, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _prepare_cache(self, csv_path, cache_dir):
+        key = hashlib.blake2b(os.path.abspath(csv_path).encode("utf-8"), digest_size=6).hexdigest()
+        path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(csv_path))[0]}-{key}-{self.imgsz}")
+        manifest_path = os.path.join(path, "manifest.json")
+
+        sources = [[p, *_source_stat(p)] for idx in range(len(self)) for p in self._paths(idx)]
+        manifest = {"version": CACHE_VERSION, "imgsz": self.imgsz, "csv": os.path.abspath(csv_path),
+                    "sources": sources}
+        os.makedirs(path, exist_ok=True)
+        with self._build_lock(path):
+            if os.path.exists(manifest_path):
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    if json.load(f) == manifest:
+                        return path
+                print(f"[INFO] Source files changed, rebuilding dataset cache: {path}")
+                os.remove(manifest_path)
+
+            # Built under names unique to this build and renamed into place, so even
+            # without the lock a concurrent build never writes into these files.
+            tmp = f".{uuid.uuid4().hex}.tmp"
+            n, size = len(self), self.imgsz
+            images = np.lib.format.open_memmap(os.path.join(path, "images.npy" + tmp), mode="w+",
+                                               dtype=np.uint8, shape=(n, size, size, 3))
+            masks = np.lib.format.open_memmap(os.path.join(path, "masks.npy" + tmp), mode="w+",
+                                              dtype=np.uint8, shape=(n, 2, size, size))
+            for idx in tqdm(range(n), desc=f"Caching {os.path.basename(csv_path)} ({size}px)"):
+                img, mask = self._load(idx)
+                images[idx] = np.asarray(img)
+                masks[idx] = mask
+            images.flush()
+            masks.flush()
+            del images, masks
+            os.replace(os.path.join(path, "images.npy" + tmp), os.path.join(path, "images.npy"))
+            os.replace(os.path.join(path, "masks.npy" + tmp), os.path.join(path, "masks.npy"))
+            # Written last: a build that was interrupted leaves no manifest and is redone.
+            with open(manifest_path + tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(manifest_path + tmp, manifest_path)
+        return path
+
+    def __getitem__(self, idx):
+        if self.cache_path is None:
+            img, mask = self._load(idx)
+        else:
+            if self._images is None:
+                self._images = np.load(os.path.join(self.cache_path, "images.npy"), mmap_mode="r")
+                self._masks = np.load(os.path.join(self.cache_path, "masks.npy"), mmap_mode="r")
+            mask = self._masks[idx]
+            img = self._images[idx]
+            if self.transforms:
+                img = Image.fromarray(img)
+
         if self.transforms:
             img = self.transforms(img)
 
-        img_tensor = self.to_tensor(img)
-
-        tumor_mask_np = np.array(tumor_mask, dtype=np.float32) / 255.0
-        fluid_mask_np = np.array(fluid_mask, dtype=np.float32) / 255.0
+        if isinstance(img, Image.Image):
+            img_tensor = self.to_tensor(img)
+        else:
+            # Same values as ToTensor on the PIL image.
+            img_tensor = torch.from_numpy(img.transpose(2, 0, 1).astype(np.float32) / 255.0)
 
-        mask_tensor = torch.from_numpy(
-            np.stack([fluid_mask_np, tumor_mask_np], axis=0))
+        mask_tensor = torch.from_numpy(mask.astype(np.float32) / 255.0)
 
         return img_tensor, mask_tensor
 
 
+# double_conv blocks, in forward order; the names accepted by --activation_checkpointing
+# besides the groups in CHECKPOINT_BLOCK_GROUPS.
+UNET_BLOCKS = ("conv1", "conv2", "conv3", "conv4", "conv5", "uconv1", "uconv2", "uconv3", "uconv4")
+CHECKPOINT_BLOCK_GROUPS = {
+    "none": (),
+    "all": UNET_BLOCKS,
+    "encoder": UNET_BLOCKS[:5],
+    "decoder": UNET_BLOCKS[5:],
+    # The full-resolution blocks hold the largest activations.
+    "outer": ("conv1", "conv2", "uconv3", "uconv4"),
+}
+
+
+def parse_checkpoint_blocks(spec):
+    """Block names from a comma-separated list of UNET_BLOCKS and CHECKPOINT_BLOCK_GROUPS entries."""
+    blocks = set()
+    for name in filter(None, (part.strip() for part in spec.split(","))):
+        if name in CHECKPOINT_BLOCK_GROUPS:
+            blocks.update(CHECKPOINT_BLOCK_GROUPS[name])
+        elif name in UNET_BLOCKS:
+            blocks.add(name)
+        else:
+            raise ValueError(f"Unknown UNet block: {name} "
+                             f"(expected {', '.join([*CHECKPOINT_BLOCK_GROUPS, *UNET_BLOCKS])})")
+    return tuple(name for name in UNET_BLOCKS if name in blocks)
+
+
+@contextmanager
+def _restore_buffers(module):
+    # Backward recomputes a checkpointed block in train mode; without this its
+    # BatchNorm running statistics would be updated a second time.
+    saved = [b.clone() for b in module.buffers()]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for b, value in zip(module.buffers(), saved):
+                b.copy_(value)
+
+
 class UNet(nn.Module):
     def __init__(self, in_channels=3, out_channels=2, base=64):
         super().__init__()
+        # Blocks whose activations are recomputed in backward instead of stored
+        # (see set_activation_checkpointing).
+        self.checkpoint_blocks = ()
 
         # --- DOWN ---
         self.conv1 = self.double_conv(in_channels, base)
@@ -141,33 +784,56 @@ class UNet(nn.Module):
             nn.ReLU(inplace=True)
         )
 
+    def set_activation_checkpointing(self, blocks):
+        """Recompute the activations of the named double_conv blocks in backward.
+
+        Only the block inputs are kept, which trades one extra forward pass of
+        those blocks for most of their activation memory.
+        """
+        unknown = set(blocks) - set(UNET_BLOCKS)
+        if unknown:
+            raise ValueError(f"Unknown UNet blocks: {', '.join(sorted(unknown))}")
+        self.checkpoint_blocks = tuple(name for name in UNET_BLOCKS if name in blocks)
+
+    def block(self, name, x):
+        block = getattr(self, name)
+        if name not in self.checkpoint_blocks or not (self.training and torch.is_grad_enabled()):
+            return block(x)
+        if torch.compiler.is_compiling():
+            # Compiled graphs recompute from a functional copy and never apply buffer
+            # updates twice (and dynamo does not accept a custom context_fn).
+            return torch.utils.checkpoint.checkpoint(block, x, use_reentrant=False)
+        return torch.utils.checkpoint.checkpoint(
+            block, x, use_reentrant=False,
+            context_fn=lambda: (nullcontext(), _restore_buffers(block)))
+
     def forward(self, x):
         # DOWN
-        x1 = self.conv1(x)
-        x2 = self.conv2(self.pool(x1))
-        x3 = self.conv3(self.pool(x2))
-        x4 = self.conv4(self.pool(x3))
-        x5 = self.conv5(self.pool(x4))
+        x1 = self.block("conv1", x)
+        x2 = self.block("conv2", self.pool(x1))
+        x3 = self.block("conv3", self.pool(x2))
+        x4 = self.block("conv4", self.pool(x3))
+        x5 = self.block("conv5", self.pool(x4))
 
         # UP 1
         u1 = self.up1(x5)
         u1 = self.pad_and_concat(u1, x4)
-        u1 = self.uconv1(u1)
+        u1 = self.block("uconv1", u1)
 
         # UP 2
         u2 = self.up2(u1)
         u2 = self.pad_and_concat(u2, x3)
-        u2 = self.uconv2(u2)
+        u2 = self.block("uconv2", u2)
 
         # UP 3
         u3 = self.up3(u2)
         u3 = self.pad_and_concat(u3, x2)
-        u3 = self.uconv3(u3)
+        u3 = self.block("uconv3", u3)
 
         # UP 4
         u4 = self.up4(u3)
         u4 = self.pad_and_concat(u4, x1)
-        u4 = self.uconv4(u4)
+        u4 = self.block("uconv4", u4)
 
         return self.out(u4)
 
@@ -209,151 +875,390 @@ class UNet(nn.Module):
                     device=None,
                     freeze_encoder=False,
                     run_name=None,
-                    run_meta=None):
+                    run_meta=None,
+                    amp="off",
+                    resume_state=None,
+                    log_every=50,
+                    profile_steps=0,
+                    checkpoint_every=0,
+                    resume_checkpoint=None,
+                    epoch_offset=0,
+                    compile="off",
+                    grad_accum=1):
 
         if device is None:
             device = torch.device(
                 "cuda" if torch.cuda.is_available() else "cpu")
 
-        run_dir = self.__get_run_dir(run_name=run_name)
-        os.makedirs(run_dir, exist_ok=True)
-        weights_dir = os.path.join(run_dir, "weights")
-        os.makedirs(weights_dir, exist_ok=True)
-
-        if run_meta is not None:
-            with open(os.path.join(run_dir, "run_meta.json"), "w") as f:
-                json.dump(run_meta, f, indent=2)
+        # In a process group (see init_distributed) every rank trains on its shard
+        # of the data; only rank 0 creates the run directory and writes logs and
+        # checkpoints. Metrics are summed over ranks, so all ranks agree on them.
+        main = is_main_process()
+        run_dir = weights_dir = None
+        writer = None
+        if main:
+            run_dir = self.__get_run_dir(run_name=run_name)
+            os.makedirs(run_dir, exist_ok=True)
+            weights_dir = os.path.join(run_dir, "weights")
+            os.makedirs(weights_dir, exist_ok=True)
+
+            if run_meta is not None:
+                with open(os.path.join(run_dir, "run_meta.json"), "w") as f:
+                    json.dump(run_meta, f, indent=2)
+
+        # A mid-epoch checkpoint (see save_checkpoint below) restores the model,
+        # optimizer, scaler, RNGs and position in the epoch's sample order.
+        ckpt = load_checkpoint(resume_checkpoint, device) if resume_checkpoint else None
+        if ckpt is not None:
+            self.load_state_dict(ckpt["model"])
+            epoch_offset = ckpt["epochs_done"]
 
         self.to(device)
-
-        writer = SummaryWriter(log_dir=os.path.join(run_dir, "tensorboard"))
+        net = self
+        if dist.is_initialized():
+            net = DistributedDataParallel(self, device_ids=[device.index] if device.type == "cuda" else None)
 
         criterion = nn.BCEWithLogitsLoss()
         trainable_parameters = [p for p in self.parameters() if p.requires_grad]
         optimizer = torch.optim.Adam(trainable_parameters, lr=lr)
+        scaler = make_grad_scaler(device, amp)
         encoder_blocks = self.get_encoder_blocks()
 
-        if freeze_encoder:
+        if resume_state is not None:
+            state = torch.load(resume_state, map_location=device)
+            optimizer.load_state_dict(state["optimizer"])
+            # A run resumed with a different --amp keeps the optimizer state only.
+            if state.get("scaler") and scaler.is_enabled():
+                scaler.load_state_dict(state["scaler"])
+            if main:
+                print(f"[INFO] Restored optimizer/scaler state from: {resume_state}")
+
+        if freeze_encoder and main:
             trainable_count = sum(p.numel() for p in trainable_parameters)
             print(f"[INFO] Training decoder/head only. Trainable parameters: {trainable_count:,}")
 
         best_val_dice = -1.0
         best_tumor_dice = -1.0
         best_fluid_dice = -1.0
-
-        for epoch in range(1, num_epochs + 1):
-            print(f"\nEpoch {epoch}/{num_epochs}")
-            epoch_dir = os.path.join(run_dir, f"epoch_{epoch}")
-            os.makedirs(epoch_dir, exist_ok=True)
-            epoch_data = {'epoch_number': epoch}
-
-            # ── TRAIN ──────────────────────────────────────────────────────
+        global_step = 0
+        start_step = 0
+        train_sampler = train_loader.sampler if isinstance(train_loader.sampler, ResumableSampler) else None
+
+        if ckpt is not None:
+            optimizer.load_state_dict(ckpt["optimizer"])
+            if ckpt.get("scaler") and scaler.is_enabled():
+                scaler.load_state_dict(ckpt["scaler"])
+            # A new run directory gets the previous run's best*.pth, so it always
+            # ends with a best.pth even if no resumed epoch improves on it.
+            best_val_dice, best_tumor_dice, best_fluid_dice = carry_over_best_weights(
+                os.path.dirname(os.path.abspath(resume_checkpoint)), weights_dir, ckpt["best"])
+            global_step = ckpt["global_step"]
+            start_step = ckpt["step"]
+            restore_rng_state(ckpt["rng"])
+            if train_sampler is None:
+                raise ValueError("Mid-epoch resume needs a shuffled loader from build_loader (ResumableSampler)")
+            if main:
+                print(f"[INFO] Resuming epoch {epoch_offset + 1} at step {start_step} from: {resume_checkpoint}")
+
+        def warm_train(compiled):
+            # Forward and backward on zeros; BatchNorm statistics and gradients are
+            # restored afterwards, so warm-up does not change the training run.
+            buffers = {name: b.clone() for name, b in self.named_buffers()}
             self.train()
             if freeze_encoder:
                 for block in encoder_blocks:
                     block.eval()
-
-            train_loss = 0.0
-            for imgs, masks in tqdm(train_loader, desc=f"Epoch {epoch} - Training", leave=False):
-                imgs = imgs.to(device)
-                masks = masks.to(device)
-
-                optimizer.zero_grad()
-                preds = self(imgs)
-                loss = criterion(preds, masks)
-                loss.backward()
-                optimizer.step()
-
-                train_loss += loss.item()
-            train_loss /= len(train_loader)
-            epoch_data['train_loss'] = train_loss
-
-            # ── VAL ────────────────────────────────────────────────────────
+            try:
+                for shape in warmup_shapes(train_loader):
+                    with autocast(device, amp):
+                        out = compiled(torch.zeros(shape, device=device))
+                    out.float().mean().backward()
+            finally:
+                with torch.no_grad():
+                    for name, b in self.named_buffers():
+                        b.copy_(buffers[name])
+                optimizer.zero_grad(set_to_none=True)
+
+        def warm_eval(compiled):
             self.eval()
-            val_loss = 0.0
-            val_fluid_cm = None
-            val_tumor_cm = None
-            with torch.no_grad():
-                for imgs, masks in tqdm(val_loader, desc=f"Epoch {epoch} - Validation", leave=False):
-                    imgs = imgs.to(device)
-                    masks = masks.to(device)
-
-                    preds = self(imgs)
-                    loss = criterion(preds, masks)
-                    val_loss += loss.item()
-
-                    preds_bin = (torch.sigmoid(preds) > 0.5).float()
-                    f_cm, t_cm = get_confusion_matrices(masks, preds_bin)
-                    val_fluid_cm = f_cm if val_fluid_cm is None else val_fluid_cm + f_cm
-                    val_tumor_cm = t_cm if val_tumor_cm is None else val_tumor_cm + t_cm
-
-            val_loss /= len(val_loader)
-            epoch_data['val_loss'] = val_loss
-
-            fluid_m = metrics_from_confusion_matrix(val_fluid_cm)
-            tumor_m = metrics_from_confusion_matrix(val_tumor_cm)
-            val_dice_macro = (fluid_m['dice'] + tumor_m['dice']) / 2.0
-            val_iou_macro = (fluid_m['iou'] + tumor_m['iou']) / 2.0
-
-            epoch_data.update({
-                'val_fluid_dice': fluid_m['dice'], 'val_fluid_iou': fluid_m['iou'],
-                'val_tumor_dice': tumor_m['dice'], 'val_tumor_iou': tumor_m['iou'],
-                'val_dice_macro': val_dice_macro,  'val_iou_macro':  val_iou_macro,
-            })
-
-            with open(os.path.join(epoch_dir, "epoch_data.json"), "w") as f:
-                json.dump(epoch_data, f, indent=2)
-
-            # ── TENSORBOARD ────────────────────────────────────────────────
-            writer.add_scalar("Loss/train",         train_loss,     epoch)
-            writer.add_scalar("Loss/val",           val_loss,       epoch)
-            writer.add_scalar("Dice/val_fluid",     fluid_m['dice'], epoch)
-            writer.add_scalar("Dice/val_tumor",     tumor_m['dice'], epoch)
-            writer.add_scalar("Dice/val_macro",     val_dice_macro, epoch)
-            writer.add_scalar("IoU/val_fluid",      fluid_m['iou'],  epoch)
-            writer.add_scalar("IoU/val_tumor",      tumor_m['iou'],  epoch)
-            writer.add_scalar("IoU/val_macro",      val_iou_macro,  epoch)
-            writer.add_scalar("Recall/val_fluid",   fluid_m['recall'],  epoch)
-            writer.add_scalar("Recall/val_tumor",   tumor_m['recall'],  epoch)
-            writer.add_scalar("Precision/val_fluid",
-                              fluid_m['precision'], epoch)
-            writer.add_scalar("Precision/val_tumor",
-                              tumor_m['precision'], epoch)
-
-            torch.save(self.state_dict(), os.path.join(
-                weights_dir, 'last.pth'))
-            print(f"Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f} | "
-                  f"Dice fluid: {fluid_m['dice']:.4f} tumor: {tumor_m['dice']:.4f} macro: {val_dice_macro:.4f}")
-
-            if val_dice_macro > best_val_dice:
-                best_val_dice = val_dice_macro
-                torch.save(self.state_dict(), os.path.join(
-                    weights_dir, 'best.pth'))
-                print(
-                    f"✓ saved best.pth  (val_dice_macro={best_val_dice:.4f})")
-
-            if tumor_m['dice'] > best_tumor_dice:
-                best_tumor_dice = tumor_m['dice']
-                torch.save(self.state_dict(), os.path.join(
-                    weights_dir, 'best_tumor.pth'))
-                print(
-                    f"✓ saved best_tumor.pth  (val_tumor_dice={best_tumor_dice:.4f})")
-
-            if fluid_m['dice'] > best_fluid_dice:
-                best_fluid_dice = fluid_m['dice']
-                torch.save(self.state_dict(), os.path.join(
-                    weights_dir, 'best_fluid.pth'))
-                print(
-                    f"✓ saved best_fluid.pth  (val_fluid_dice={best_fluid_dice:.4f})")
-
-        writer.close()
-        print(
-            f"\nTraining complete. Best val Dice (macro): {best_val_dice:.4f} | "
-            f"Best tumor Dice: {best_tumor_dice:.4f} | Best fluid Dice: {best_fluid_dice:.4f}"
-        )
+            with torch.no_grad(), autocast(device, amp):
+                for shape in warmup_shapes(val_loader):
+                    compiled(torch.zeros(shape, device=device))
+
+        # Training goes through DDP; evaluation does not (ranks may run different
+        # numbers of validation batches), so each path gets its own compiled graph.
+        # Accumulated micro-batches only all-reduce their gradients on the last one.
+        ddp_net = net if net is not self else None
+        eager_net = net
+        eval_net = compile_with_warmup(self, compile, warm_eval, what="UNet (eval)")
+        net = compile_with_warmup(net, compile, warm_train, what="UNet (train)")
+        if net is eager_net:
+            compile = "off"  # the epoch log reports what actually ran
+
+        def save_checkpoint(epoch, step, loss_sum):
+            # Called on every rank at the same step; the partial epoch loss is summed
+            # over ranks and restored on rank 0 only.
+            partial = all_reduce_sum(loss_sum.detach().clone()).item()
+            if not main:
+                return
+            ckpt_writer.save({
+                "epochs_done": epoch_offset + epoch - 1,
+                "step": step,
+                "global_step": global_step,
+                "amp": amp,
+                "model": self.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
+                "rng": capture_rng_state(),
+                "best": (best_val_dice, best_tumor_dice, best_fluid_dice),
+                "train_loss_sum": partial,
+            }, os.path.join(weights_dir, CHECKPOINT_NAME))
+
+        # The handlers only record the signal; the loop checkpoints at the next step
+        # boundary and returns with "interrupted" and "stop_signal" set.
+        stop = {"signal": 0}
+
+        def request_stop(signum, frame):
+            stop["signal"] = signum
+
+        previous_handlers = {sig: signal.signal(sig, request_stop) for sig in CHECKPOINT_SIGNALS}
+
+        def should_stop(step):
+            if not dist.is_initialized():
+                return bool(stop["signal"])
+            if step % SIGNAL_POLL_STEPS:
+                return False
+            flag = torch.tensor(float(stop["signal"]), device=device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            stop["signal"] = int(flag.item())
+            return bool(stop["signal"])
+
+        profiler = None
+        if main:
+            writer = SummaryWriter(log_dir=os.path.join(run_dir, "tensorboard"))
+            ckpt_writer = CheckpointWriter()
+        # Handlers, profiler and writers are released even when training raises.
+        try:
+            if profile_steps > 0 and main:
+                # A few steps of the first epoch, after warm-up, viewable in TensorBoard
+                # (PyTorch Profiler tab) or chrome://tracing.
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if device.type == "cuda":
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                profiler = torch.profiler.profile(
+                    activities=activities,
+                    schedule=torch.profiler.schedule(wait=5, warmup=2, active=profile_steps, repeat=1),
+                    on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(run_dir, "profiler")),
+                )
+                profiler.start()
+
+            for epoch in range(1, num_epochs + 1):
+                if main:
+                    print(f"\nEpoch {epoch}/{num_epochs}")
+                # Epochs are numbered across resumed runs: epoch_N directories, epoch_data
+                # and TensorBoard count all epochs trained, and the sample order of an
+                # epoch does not depend on where training was restarted.
+                total_epoch = epoch_offset + epoch
+                epoch_data = {'epoch_number': total_epoch}
+                if isinstance(train_loader.sampler, DistributedSampler):
+                    train_loader.sampler.set_epoch(total_epoch)
+                first_step = 0
+                if ckpt is not None and epoch == 1 and start_step:
+                    first_step = start_step
+                    train_sampler.set_start(start_step * train_loader.batch_size)
+
+                # ── TRAIN ──────────────────────────────────────────────────────
+                self.train()
+                if freeze_encoder:
+                    for block in encoder_blocks:
+                        block.eval()
+
+                # Losses are summed on the device; .item() only runs every `log_every`
+                # steps and at the end of the epoch, so the host never waits for the GPU
+                # in between. (fp16 still syncs once per step inside scaler.step.)
+                train_loss_sum = torch.zeros((), device=device)
+                logged_loss_sum = 0.0
+                logged_step = first_step
+                train_images = 0
+                if first_step and main:
+                    train_loss_sum += ckpt["train_loss_sum"]
+                    logged_loss_sum = ckpt["train_loss_sum"]
+                interrupted = False
+                step = first_step
+                start = time.perf_counter()
+                steps_in_epoch = first_step + len(train_loader)
+                progress = tqdm(DevicePrefetcher(train_loader, device),
+                                desc=f"Epoch {epoch} - Training", leave=False, disable=not main,
+                                initial=first_step, total=steps_in_epoch)
+                for step, (imgs, masks) in enumerate(progress, first_step + 1):
+                    # The optimizer steps once per `grad_accum` batches (and on the last
+                    # batch of the epoch), on the mean of their gradients.
+                    group_start = (step - 1) // grad_accum * grad_accum
+                    group_end = min(group_start + grad_accum, steps_in_epoch)
+                    update = step == group_end
+                    sync = nullcontext() if update or ddp_net is None else ddp_net.no_sync()
+                    with sync:
+                        with autocast(device, amp):
+                            preds = net(imgs)
+                            loss = criterion(preds, masks)
+                        scaler.scale(loss / (group_end - group_start)).backward()
+                    if update:
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad()
+
+                    train_loss_sum += loss.detach().float()
+                    train_images += imgs.size(0)
+                    global_step += 1
+                    if profiler is not None:
+                        profiler.step()
+                    if main and log_every > 0 and step % log_every == 0:
+                        loss_sum = train_loss_sum.item()
+                        window_loss = (loss_sum - logged_loss_sum) / (step - logged_step)
+                        logged_loss_sum, logged_step = loss_sum, step
+                        progress.set_postfix(loss=f"{window_loss:.4f}")
+                        writer.add_scalar("Loss/train_step", window_loss, global_step)
+                    # Checkpoints hold no gradients, so they are only taken after an
+                    # optimizer step; signals are polled per optimizer step.
+                    if not update:
+                        continue
+                    if should_stop(-(-step // grad_accum)):
+                        save_checkpoint(epoch, step, train_loss_sum)
+                        interrupted = True
+                        break
+                    if checkpoint_every > 0 and group_end // checkpoint_every > group_start // checkpoint_every:
+                        save_checkpoint(epoch, step, train_loss_sum)
+                if profiler is not None:
+                    profiler.stop()
+                    profiler = None
+                if interrupted:
+                    if main:
+                        print(f"[INFO] Stop requested: saved {CHECKPOINT_NAME} at epoch {epoch} step {step}")
+                    break
+                totals = all_reduce_sum(torch.stack([
+                    train_loss_sum,
+                    torch.tensor(float(step), device=device),
+                    torch.tensor(float(train_images), device=device),
+                ])).tolist()
+                train_loss = totals[0] / totals[1]
+                train_images_per_s = totals[2] / (time.perf_counter() - start)
+                epoch_data['train_loss'] = train_loss
+                epoch_data['train_images_per_s'] = train_images_per_s
+
+                # ── VAL ────────────────────────────────────────────────────────
+                self.eval()
+                val_loss_sum = torch.zeros((), device=device)
+                val_cm = ConfusionAccumulator(num_classes=2, device=device)
+                with torch.no_grad(), autocast(device, amp):
+                    for imgs, masks in tqdm(DevicePrefetcher(val_loader, device),
+                                            desc=f"Epoch {epoch} - Validation", leave=False, disable=not main):
+                        preds = eval_net(imgs)
+                        loss = criterion(preds, masks)
+                        val_loss_sum += loss.float()
+
+                        val_cm.update(torch.sigmoid(preds), masks)
+
+                val_totals = all_reduce_sum(torch.stack([
+                    val_loss_sum, torch.tensor(float(len(val_loader)), device=device)])).tolist()
+                val_loss = val_totals[0] / max(val_totals[1], 1.0)
+                epoch_data['val_loss'] = val_loss
+
+                val_cm.all_reduce()
+                val_fluid_cm, val_tumor_cm = val_cm.compute()[0]
+                fluid_m = metrics_from_confusion_matrix(val_fluid_cm)
+                tumor_m = metrics_from_confusion_matrix(val_tumor_cm)
+                val_dice_macro = (fluid_m['dice'] + tumor_m['dice']) / 2.0
+                val_iou_macro = (fluid_m['iou'] + tumor_m['iou']) / 2.0
+
+                epoch_data.update({
+                    'val_fluid_dice': fluid_m['dice'], 'val_fluid_iou': fluid_m['iou'],
+                    'val_tumor_dice': tumor_m['dice'], 'val_tumor_iou': tumor_m['iou'],
+                    'val_dice_macro': val_dice_macro,  'val_iou_macro':  val_iou_macro,
+                })
+
+                weight_files = ['last.pth']
+                saved = []
+                if val_dice_macro > best_val_dice:
+                    best_val_dice = val_dice_macro
+                    weight_files.append('best.pth')
+                    saved.append(f"✓ saved best.pth  (val_dice_macro={best_val_dice:.4f})")
+
+                if tumor_m['dice'] > best_tumor_dice:
+                    best_tumor_dice = tumor_m['dice']
+                    weight_files.append('best_tumor.pth')
+                    saved.append(f"✓ saved best_tumor.pth  (val_tumor_dice={best_tumor_dice:.4f})")
+
+                if fluid_m['dice'] > best_fluid_dice:
+                    best_fluid_dice = fluid_m['dice']
+                    weight_files.append('best_fluid.pth')
+                    saved.append(f"✓ saved best_fluid.pth  (val_fluid_dice={best_fluid_dice:.4f})")
+
+                if main:
+                    epoch_dir = os.path.join(run_dir, f"epoch_{total_epoch}")
+                    os.makedirs(epoch_dir, exist_ok=True)
+                    ckpt_writer.save_json(epoch_data, os.path.join(epoch_dir, "epoch_data.json"))
+
+                    # ── TENSORBOARD ────────────────────────────────────────────
+                    writer.add_scalar("Loss/train",         train_loss,     total_epoch)
+                    writer.add_scalar("Throughput/train_images_per_s", train_images_per_s, total_epoch)
+                    writer.add_scalar("Loss/val",           val_loss,       total_epoch)
+                    writer.add_scalar("Dice/val_fluid",     fluid_m['dice'], total_epoch)
+                    writer.add_scalar("Dice/val_tumor",     tumor_m['dice'], total_epoch)
+                    writer.add_scalar("Dice/val_macro",     val_dice_macro, total_epoch)
+                    writer.add_scalar("IoU/val_fluid",      fluid_m['iou'],  total_epoch)
+                    writer.add_scalar("IoU/val_tumor",      tumor_m['iou'],  total_epoch)
+                    writer.add_scalar("IoU/val_macro",      val_iou_macro,  total_epoch)
+                    writer.add_scalar("Recall/val_fluid",   fluid_m['recall'],  total_epoch)
+                    writer.add_scalar("Recall/val_tumor",   tumor_m['recall'],  total_epoch)
+                    writer.add_scalar("Precision/val_fluid",
+                                      fluid_m['precision'], total_epoch)
+                    writer.add_scalar("Precision/val_tumor",
+                                      tumor_m['precision'], total_epoch)
+
+                    # One snapshot of the weights, written once for last.pth and linked to
+                    # every best*.pth this epoch improved.
+                    ckpt_writer.save(self.state_dict(), *(os.path.join(weights_dir, name) for name in weight_files))
+                    # Optimizer and GradScaler state next to last.pth, so a resumed run
+                    # continues with the same moments and loss scale.
+                    ckpt_writer.save({
+                        "epoch": total_epoch,
+                        "amp": amp,
+                        "optimizer": optimizer.state_dict(),
+                        "scaler": scaler.state_dict(),
+                    }, os.path.join(weights_dir, 'last_state.pth'))
+                    # The epoch is complete, so last.pth/last_state.pth supersede the
+                    # mid-epoch checkpoint.
+                    ckpt_writer.remove(os.path.join(weights_dir, CHECKPOINT_NAME))
+                    print(f"Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f} | "
+                          f"Dice fluid: {fluid_m['dice']:.4f} tumor: {tumor_m['dice']:.4f} macro: {val_dice_macro:.4f} | "
+                          f"{train_images_per_s:.1f} img/s (amp={amp}, compile={compile})")
+                    for line in saved:
+                        print(line)
+
+                if should_stop(SIGNAL_POLL_STEPS) and epoch < num_epochs:
+                    interrupted = True
+                    if main:
+                        print(f"[INFO] Stop requested: epoch {epoch} saved, exiting")
+                    break
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+            if main:
+                writer.close()
+                # Callers load best.pth right after training.
+                ckpt_writer.close()
+        if main and not interrupted:
+            print(
+                f"\nTraining complete. Best val Dice (macro): {best_val_dice:.4f} | "
+                f"Best tumor Dice: {best_tumor_dice:.4f} | Best fluid Dice: {best_fluid_dice:.4f}"
+            )
         return {
             "run_dir": run_dir,
             "weights_dir": weights_dir,
+            "interrupted": interrupted,
+            "stop_signal": stop["signal"] if interrupted else None,
             "best_val_dice": float(best_val_dice),
             "best_tumor_dice": float(best_tumor_dice),
             "best_fluid_dice": float(best_fluid_dice),
@@ -390,7 +1295,7 @@ class UNet(nn.Module):
             "FN": int(cn[1][0])
         }
 
-    def test_model(self, test_loader, device=None, run_name: str | None = None):
+    def test_model(self, test_loader, device=None, run_name: str | None = None, compile="off"):
         if device is None:
             device = torch.device(
                 "cuda" if torch.cuda.is_available() else "cpu")
@@ -401,26 +1306,28 @@ class UNet(nn.Module):
         self.to(device)
 
         self.eval()
-        fluid_cm = None
-        tumor_cm = None
-        with torch.no_grad():
-            for imgs, masks in tqdm(test_loader, desc=f"Testing: ", leave=False):
-                imgs = imgs.to(device)
-                masks = masks.to(device)
-                preds = self(imgs)
-                preds = torch.sigmoid(preds)
-                preds = (preds > 0.5).float()
-                fluid_cm_local, tumor_cm_local = get_confusion_matrices(
-                    masks, preds)
-                if fluid_cm is None:
-                    fluid_cm = fluid_cm_local
-                else:
-                    fluid_cm += fluid_cm_local
-                if tumor_cm is None:
-                    tumor_cm = tumor_cm_local
-                else:
-                    tumor_cm += tumor_cm_local
 
+        def warm_eval(compiled):
+            with torch.no_grad():
+                for shape in warmup_shapes(test_loader):
+                    compiled(torch.zeros(shape, device=device))
+
+        net = compile_with_warmup(self, compile, warm_eval)
+        if net is self:
+            compile = "off"
+        cm = ConfusionAccumulator(num_classes=2, device=device)
+        test_images = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            for imgs, masks in tqdm(DevicePrefetcher(test_loader, device), desc=f"Testing: ", leave=False):
+                preds = net(imgs)
+                cm.update(torch.sigmoid(preds), masks)
+                test_images += imgs.size(0)
+
+        fluid_cm, tumor_cm = cm.compute()[0]
+        test_seconds = time.perf_counter() - start
+        print(f"[INFO] Tested {test_images} images in {test_seconds:.1f} s: "
+              f"{test_images / test_seconds:.1f} img/s (compile={compile})")
         fluid_metrics = metrics_from_confusion_matrix(fluid_cm)
         tumor_metrics = metrics_from_confusion_matrix(tumor_cm)
 